@@ -0,0 +1,76 @@
+"""Import-time budget for GUI startup.
+
+Runs ``python -X importtime`` in a fresh interpreter on the modules the
+window needs and fails when a heavy dependency is pulled in eagerly or the
+project's own modules exceed the budget::
+
+    python -m benchmarks.importtime --budget-ms 150
+"""
+import os
+import sys
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Needed for conversion/enrichment only; must not load before first use
+HEAVY_MODULES = ('requests', 'mutagen', 'pyncm', 'Crypto', 'tqdm', 'multiprocessing', 'sqlite3')
+
+GUI_MODULES = ('ui.main_window',)
+# Fallback when QtMultimedia can't load (e.g. headless CI without PulseAudio)
+CORE_GUI_MODULES = ('core.metadata', 'core.playqueue', 'core.lyrics', 'core.metrics', 'core.session',
+                    'core.library')
+
+
+def measure(modules):
+    """Return ``{module: (self_us, cumulative_us)}`` or None if the import failed."""
+    code = ''.join(f'import {m}\n' for m in modules)
+    env = dict(os.environ, QT_QPA_PLATFORM=os.environ.get('QT_QPA_PLATFORM', 'offscreen'))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          cwd=ROOT, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        return None
+    timings = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings
+
+
+def check(budget_ms):
+    modules = GUI_MODULES
+    timings = measure(modules)
+    if timings is None:
+        print(f'could not import {", ".join(modules)}; checking core modules only', file=sys.stderr)
+        modules = CORE_GUI_MODULES
+        timings = measure(modules)
+        if timings is None:
+            print('import failed', file=sys.stderr)
+            return False
+
+    ok = True
+    loaded = sorted(m for m in timings if m.split('.')[0] in HEAVY_MODULES and '.' not in m)
+    if loaded:
+        print(f'FAIL heavy modules imported eagerly: {", ".join(loaded)}', file=sys.stderr)
+        ok = False
+
+    # Self time of our own packages only; Qt itself is outside our control
+    own_us = sum(t[0] for name, t in timings.items() if name.split('.')[0] in ('core', 'ui'))
+    total_us = max(t[1] for name, t in timings.items() if name in modules)
+    print(f'own modules: {own_us / 1000:.1f} ms (budget {budget_ms} ms), '
+          f'total with dependencies: {total_us / 1000:.1f} ms', file=sys.stderr)
+    if own_us / 1000 > budget_ms:
+        print('FAIL import-time budget exceeded', file=sys.stderr)
+        ok = False
+    return ok
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='check GUI import-time budget')
+    parser.add_argument('--budget-ms', metavar='', type=float, default=150.0,
+                        help='allowed self time of core/ui modules (default: 150)')
+    args = parser.parse_args()
+    sys.exit(0 if check(args.budget_ms) else 1)
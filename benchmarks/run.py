@@ -0,0 +1,272 @@
+"""Performance benchmarks over a synthetic NCM corpus.
+
+    python -m benchmarks.run                 # run and print results
+    python -m benchmarks.run --check         # fail if slower than baseline.json
+    python -m benchmarks.run --save          # record a new baseline
+
+Every benchmark is registered with ``@benchmark`` and returns one number.
+Results are compared against ``benchmarks/baseline.json``; a value that is
+worse than the baseline by more than ``--tolerance`` counts as a regression.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import platform
+import tempfile
+import statistics
+
+from core import ncmdump, ncmgen
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+BENCHMARKS = {}
+
+
+class Skip(Exception):
+    pass
+
+
+def benchmark(name, unit, higher_is_better=False):
+    def register(func):
+        BENCHMARKS[name] = (func, unit, higher_is_better)
+        return func
+    return register
+
+
+def median_time(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - t0)
+    return statistics.median(samples)
+
+
+class Context:
+    """Shared corpus and scratch directories for one benchmark run."""
+
+    def __init__(self, root, count, size, repeat):
+        self.root = root
+        self.count = count
+        self.size = size
+        self.repeat = repeat
+        self.corpus = ncmgen.make_corpus(os.path.join(root, 'ncm'), count, size, cover_size=64 << 10)
+        self.converted = None
+
+    def fresh_dir(self, name):
+        path = os.path.join(self.root, name)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        return path
+
+    def converted_files(self):
+        if self.converted is None:
+            out = self.fresh_dir('converted')
+            self.converted = [ncmdump.dump_single_file(p, out) for p in self.corpus]
+        return self.converted
+
+
+@benchmark('decrypt_mb_s', 'MB/s', higher_is_better=True)
+def bench_decrypt(ctx):
+    total = sum(os.path.getsize(p) for p in ctx.corpus)
+
+    def run():
+        out = ctx.fresh_dir('decrypt')
+        for p in ctx.corpus:
+            ncmdump.dump_single_file(p, out)
+
+    return total / median_time(run, ctx.repeat) / 2**20
+
+
+@benchmark('decrypt_sequential_mb_s', 'MB/s', higher_is_better=True)
+def bench_decrypt_sequential(ctx):
+    total = sum(os.path.getsize(p) for p in ctx.corpus)
+
+    def run():
+        # Through dump() with one worker, so the job tuples of its in-process loop are exercised too
+        out = ctx.fresh_dir('decrypt_sequential')
+        ncmdump.dump(*ctx.corpus, output_dir=out, n_workers=1, sequential=True)
+
+    return total / median_time(run, ctx.repeat) / 2**20
+
+
+@benchmark('sequential_cache_mb', 'MB')
+def bench_sequential_cache(ctx):
+    # Page cache left behind by a sequential run, source pages included
+    before = ncmdump.page_cache()
+    if before is None:
+        raise Skip('no /proc/meminfo')
+    out = ctx.fresh_dir('decrypt_sequential')
+    for p in ctx.corpus:
+        ncmdump.dump_single_file(p, out, sequential=True)
+    after = ncmdump.page_cache()
+    return max(0, after['cached'] - before['cached']) / 2**20
+
+
+@benchmark('header_parse_ms', 'ms')
+def bench_header_parse(ctx):
+    def run():
+        for p in ctx.corpus:
+            with open(p, 'rb') as f:
+                ncmdump.read_header(f)
+
+    return median_time(run, ctx.repeat * 5) / len(ctx.corpus) * 1000
+
+
+@benchmark('tag_write_ms', 'ms')
+def bench_tag_write(ctx):
+    from core.metadata import embed_metadata
+
+    lyrics = make_lrc(120)
+    cover = ncmgen.make_cover(200 << 10)
+    files = ctx.converted_files()
+
+    def run():
+        for p in files:
+            embed_metadata(p, 'Title', 'Artist', 'Album', lyrics, cover)
+
+    return median_time(run, ctx.repeat) / len(files) * 1000
+
+
+@benchmark('library_scan_ms', 'ms')
+def bench_library_scan(ctx):
+    from core.library import LibraryIndex
+
+    directory = os.path.dirname(ctx.converted_files()[0])
+
+    def run():
+        with LibraryIndex(':memory:') as library:
+            library.scan(directory)
+
+    return median_time(run, ctx.repeat) / len(ctx.corpus) * 1000
+
+
+@benchmark('lyrics_parse_ms', 'ms')
+def bench_lyrics_parse(ctx):
+    from core.lyrics import parse_lrc
+
+    lrc = make_lrc(300)
+    return median_time(lambda: parse_lrc(lrc), ctx.repeat * 20) * 1000
+
+
+@benchmark('lyrics_lookup_us', 'us')
+def bench_lyrics_lookup(ctx):
+    from core.lyrics import parse_lrc, line_at
+
+    times = [line['time'] for line in parse_lrc(make_lrc(300))]
+    positions = [random.randrange(times[-1] + 5000) for _ in range(10000)]
+
+    def run():
+        for pos in positions:
+            line_at(times, pos)
+
+    return median_time(run, ctx.repeat) / len(positions) * 1e6
+
+
+@benchmark('filter_playlist_ms', 'ms')
+def bench_filter_playlist(ctx):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    try:
+        from types import SimpleNamespace
+        from PySide6.QtWidgets import QApplication, QListWidget
+        from ui.main_window import NCMPlayerApp
+    except ImportError as e:
+        raise Skip(str(e))
+
+    app = QApplication.instance() or QApplication([])
+    widget = QListWidget()
+    for i in range(5000):
+        widget.addItem(f'Track {i:05d} - Synthetic Artist {i % 7}')
+    # Only the list filter; the lyrics search it triggers is a SQLite query of its own
+    window = SimpleNamespace(playlist_widget=widget, search_lyrics=lambda text: None)
+    queries = ['track 01', 'artist 3', 'no such song', '']
+
+    def run():
+        for q in queries:
+            NCMPlayerApp.filter_playlist(window, q)
+
+    result = median_time(run, ctx.repeat) / len(queries) * 1000
+    widget.deleteLater()
+    app.processEvents()
+    return result
+
+
+def make_lrc(lines):
+    return '\n'.join(f'[{i // 60:02d}:{i % 60:02d}.{(i * 37) % 100:02d}]line {i} of the song'
+                     for i in range(lines))
+
+
+def run_benchmarks(names, count, size, repeat):
+    results = {}
+    root = tempfile.mkdtemp(prefix='ncm-bench-')
+    try:
+        ctx = Context(root, count, size, repeat)
+        for name in names:
+            func, unit, higher_is_better = BENCHMARKS[name]
+            try:
+                value = func(ctx)
+            except Skip as e:
+                print(f'{name:<22} skipped ({e})', file=sys.stderr)
+                continue
+            results[name] = {'value': round(value, 4), 'unit': unit, 'higher_is_better': higher_is_better}
+            print(f'{name:<22} {value:12.4f} {unit}', file=sys.stderr)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return the names of benchmarks that regressed beyond ``tolerance``."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if not base or not base['value']:
+            continue
+        ratio = result['value'] / base['value']
+        worse = ratio < 1 - tolerance if result['higher_is_better'] else ratio > 1 + tolerance
+        status = 'REGRESSION' if worse else 'ok'
+        print(f'{name:<22} {ratio:6.2f}x baseline  {status}', file=sys.stderr)
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='pyNCMDUMP / OpenCloud Music benchmarks')
+    parser.add_argument('names', nargs='*', help=f'benchmarks to run (default: all of {", ".join(BENCHMARKS)})')
+    parser.add_argument('-n', '--count', metavar='', type=int, default=8, help='corpus files (default: 8)')
+    parser.add_argument('-s', '--size', metavar='', type=ncmgen.parse_size, default='2M',
+                        help='audio size per corpus file (default: 2M)')
+    parser.add_argument('-r', '--repeat', metavar='', type=int, default=3, help='repetitions per benchmark (default: 3)')
+    parser.add_argument('--baseline', metavar='', default=BASELINE_PATH, help='baseline file')
+    parser.add_argument('--tolerance', metavar='', type=float, default=0.3,
+                        help='allowed relative slowdown before --check fails (default: 0.3)')
+    parser.add_argument('--check', action='store_true', help='exit non-zero on regressions against the baseline')
+    parser.add_argument('--save', action='store_true', help='write results as the new baseline')
+    args = parser.parse_args()
+
+    ncmdump.log.setLevel(logging.WARNING)
+    unknown = [n for n in args.names if n not in BENCHMARKS]
+    if unknown:
+        parser.error(f'unknown benchmark(s): {", ".join(unknown)}')
+
+    config = {'count': args.count, 'size': args.size, 'repeat': args.repeat}
+    results = run_benchmarks(args.names or list(BENCHMARKS), args.count, args.size, args.repeat)
+    report = {'config': config, 'python': platform.python_version(), 'machine': platform.machine(), 'results': results}
+    print(json.dumps(report, indent=2))
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+    if args.check:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != config:
+            print('warning: baseline was recorded with a different corpus config', file=sys.stderr)
+        sys.exit(1 if compare(results, baseline, args.tolerance) else 0)
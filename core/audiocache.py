@@ -0,0 +1,92 @@
+"""Byte-budgeted LRU of recently played tracks.
+
+Replaying a track or going back to the previous one can then be served
+from memory instead of re-reading ``output/`` (often a network share).
+The GUI enables it with ``NCM_AUDIO_CACHE_MB``.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from core.metrics import metrics
+
+ENV_VAR = 'NCM_AUDIO_CACHE_MB'
+
+
+class AudioCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """Cached bytes of ``path`` (and mark them recently used), or None."""
+        with self.lock:
+            data = self.entries.get(path)
+            if data is None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(path)
+                self.hits += 1
+        metrics.inc('audio_cache_total', result='miss' if data is None else 'hit')
+        return data
+
+    def fits(self, size):
+        # One track taking most of the budget would just evict everything else
+        return size <= self.max_bytes // 2
+
+    def put(self, path, data):
+        if not self.fits(len(data)):
+            return False
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[path] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                metrics.inc('audio_cache_evictions_total')
+        return True
+
+    def load(self, path):
+        """Bytes of ``path``, read into the cache unless they're there already.
+
+        Returns None for files too big to cache, without reading them.
+        """
+        with self.lock:
+            data = self.entries.get(path)
+        if data is not None:
+            return data
+        if not self.fits(os.path.getsize(path)):
+            return None
+        with metrics.stage('audio_cache_fill'), open(path, 'rb') as f:
+            data = f.read()
+        self.put(path, data)
+        return data
+
+    def discard(self, path):
+        with self.lock:
+            data = self.entries.pop(path, None)
+            if data is not None:
+                self.size -= len(data)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'bytes': self.size, 'max_bytes': self.max_bytes, 'entries': len(self.entries)}
+
+
+def from_env():
+    """An ``AudioCache`` sized by ``NCM_AUDIO_CACHE_MB``, or None when unset or 0."""
+    try:
+        megabytes = float(os.environ.get(ENV_VAR) or 0)
+    except ValueError:
+        return None
+    return AudioCache(int(megabytes * 2**20)) if megabytes > 0 else None
@@ -0,0 +1,133 @@
+"""Pick the number of concurrent decrypt jobs from measured throughput.
+
+The best worker count depends on the machine: local NVMe is CPU bound and
+tops out near the core count, NFS clients are I/O bound and want more jobs
+in flight than cores. ``WorkerTuner`` measures MB/s over short windows
+while a batch runs and hill-climbs the concurrency level toward the
+fastest one. Once both neighbours of the best level measure slower it
+holds there, and re-probes now and then in case conditions change.
+
+The chosen level and the measured curve are saved as JSON, and the next
+run on the same output directory starts from that level.
+"""
+import os
+import json
+import time
+import socket
+import logging
+
+TUNE_NAME = '.autotune.json'
+WINDOW_SECONDS = 2.0
+MIN_SAMPLES = 2
+REPROBE_WINDOWS = 10
+
+log = logging.getLogger(__name__)
+
+
+class WorkerTuner:
+    def __init__(self, max_workers, start=None, window=WINDOW_SECONDS, path=None):
+        self.max_workers = max(1, max_workers)
+        self.window = window
+        self.path = path
+        previous = self._load()
+        if start is None:
+            start = previous.get('level') or max(1, self.max_workers // 2)
+        self.level = min(max(1, start), self.max_workers)
+        self.samples = {}
+        self.curve = []
+        self.held = 0
+        self.started = time.perf_counter()
+        self._reset_window()
+
+    def _load(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _reset_window(self):
+        self.window_start = time.perf_counter()
+        self.window_bytes = 0
+        self.window_files = 0
+
+    def mean(self, level):
+        values = self.samples.get(level)
+        return sum(values) / len(values) if values else 0.0
+
+    @property
+    def best(self):
+        return max(self.samples, key=self.mean) if self.samples else self.level
+
+    def record(self, nbytes, level):
+        """A job submitted at ``level`` finished ``nbytes``; returns the level to run at now."""
+        if level != self.level:
+            return self.level  # started before the last change: doesn't describe this level
+        self.window_bytes += nbytes
+        self.window_files += 1
+        elapsed = time.perf_counter() - self.window_start
+        if elapsed >= self.window and self.window_files >= self.level:
+            mb_s = self._close_window()
+            new_level = self._next_level()
+            if new_level != self.level:
+                log.info(f'Workers {self.level} -> {new_level} ({mb_s:.1f} MB/s at {self.level})')
+            self.level = new_level
+            self._reset_window()
+        return self.level
+
+    def _close_window(self):
+        elapsed = time.perf_counter() - self.window_start
+        mb_s = self.window_bytes / elapsed / 2**20 if elapsed else 0.0
+        self.samples.setdefault(self.level, []).append(mb_s)
+        self.curve.append({'t': round(time.perf_counter() - self.started, 3), 'level': self.level,
+                           'mb_s': round(mb_s, 3), 'files': self.window_files})
+        return mb_s
+
+    def _next_level(self):
+        best = self.best
+        for candidate in (best + 1, best - 1):
+            if 1 <= candidate <= self.max_workers and len(self.samples.get(candidate, ())) < MIN_SAMPLES:
+                return candidate
+        if best != self.level and len(self.samples.get(best, ())) < MIN_SAMPLES:
+            return best
+        # Both neighbours are known to be slower; stay, but look again now and then
+        self.held += 1
+        if self.held >= REPROBE_WINDOWS:
+            self.held = 0
+            for level in (best - 1, best + 1):
+                self.samples.pop(level, None)
+        return best
+
+    def summary(self):
+        return {
+            'host': socket.gethostname(),
+            'level': self.best,
+            'max_workers': self.max_workers,
+            'levels': {str(level): round(self.mean(level), 3) for level in sorted(self.samples)},
+            'curve': self.curve,
+        }
+
+    def save(self):
+        if self.window_files:
+            # Runs shorter than a window still leave one data point
+            self._close_window()
+            self._reset_window()
+        summary = self.summary()
+        log.info(f'Best worker count {summary["level"]} ({self.mean(summary["level"]):.1f} MB/s)')
+        if self.path:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(summary, f, indent=1)
+            os.replace(tmp, self.path)
+        return summary
+
+
+def tune_path(output_dir):
+    return os.path.join(output_dir, TUNE_NAME)
+
+
+def max_auto_workers():
+    # I/O-bound runs gain from more jobs in flight than cores
+    return 2 * (os.cpu_count() or 1)
@@ -0,0 +1,344 @@
+"""Headless import pipeline: decrypt -> tag -> library index.
+
+Runs the same conversion, enrichment and indexing steps as the GUI without
+touching Qt, and reports progress as one JSON object per line on stdout::
+
+    python -m core.batch ~/Music/ncm -o output --workers 8 --tag-workers 4
+
+``--retag`` instead fills in the tags converted tracks in ``output`` lack::
+
+    python -m core.batch --retag -o output
+"""
+import os
+import sys
+import json
+import time
+import queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from core import ncmdump, profiling, covers, autotune
+from core.metadata import update_and_embed_metadata, PARTIAL
+from core.library import LibraryIndex
+from core.journal import Journal, journal_path
+from core.metrics import metrics
+
+STAGES = ('decrypt', 'tag', 'index')
+RETAG_JOURNAL = '.retag.jsonl'
+
+
+class JsonReporter:
+    """Writes pipeline events as JSON lines."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def emit(self, event, **fields):
+        fields['event'] = event
+        self.stream.write(json.dumps(fields, ensure_ascii=False) + '\n')
+        self.stream.flush()
+
+
+def _convert(filepath, output_dir, split_threads, sequential=False):
+    # Runs in a worker process; ship its metrics back with the result
+    return ncmdump.dump_single_file(filepath, output_dir, split_threads, sequential=sequential), metrics.drain()
+
+
+def run_pipeline(paths, output_dir='output', workers=None, tag_workers=4,
+                 tag=True, index=True, db_path=None, reporter=None, include=None, exclude=None,
+                 profile=None, split_threads=None, sources=None, resume=True, sequential=False,
+                 inode_order=False):
+    """Convert every ``.ncm`` under ``paths`` into ``output_dir``.
+
+    Decryption runs in ``workers`` processes, tagging (network bound) in
+    ``tag_workers`` threads, and indexing on the calling thread so there is
+    a single SQLite writer. Sources are fed to the pool while the directory
+    walk is still running. ``sources`` replaces the walk with any iterable
+    of ``(filepath, size)``; a ``None`` item is an idle tick used by
+    long-running sources (see ``core.watch``) to let finished work through.
+    With ``resume`` finished stages are journaled in ``output_dir`` and a
+    rerun continues each source at its first unfinished stage. With
+    ``workers='auto'`` the number of decrypt jobs in flight follows
+    ``autotune.WorkerTuner``. ``sequential`` and ``inode_order`` select the
+    I/O mode of ``ncmdump.dump`` for spinning disks and network shares; the
+    summary then reports how much the page cache grew. Returns the summary
+    dict that is also emitted.
+    """
+    reporter = reporter or JsonReporter()
+    tuner = None
+    if workers == 'auto':
+        tuner = autotune.WorkerTuner(autotune.max_auto_workers(), path=autotune.tune_path(output_dir))
+        workers = tuner.max_workers
+    workers = workers or os.cpu_count() or 1
+    split_threads = split_threads or ncmdump.default_split_threads(workers)
+    os.makedirs(output_dir, exist_ok=True)
+    if tag:
+        covers.use_directory(os.path.join(output_dir, 'covers'))
+    library = LibraryIndex(db_path or os.path.join(output_dir, 'library.db')) if index else None
+    journal = Journal(journal_path(output_dir)) if resume else None
+    # converted file -> its .ncm, for journaling the tag stage
+    source_of = {}
+
+    sizes = {}
+    counts = dict.fromkeys(STAGES, 0)
+    stage_time = dict.fromkeys(STAGES, 0.0)
+    errors = 0
+    bytes_done = 0
+    cache_before = ncmdump.page_cache()
+    start = time.perf_counter()
+    reporter.emit('start', workers=workers, tag_workers=tag_workers if tag else 0, output_dir=output_dir)
+
+    def progress(stage, path, t0, **extra):
+        counts[stage] += 1
+        stage_time[stage] += time.perf_counter() - t0
+        reporter.emit('progress', stage=stage, path=path, done=counts[stage], queued=len(sizes),
+                      elapsed=round(time.perf_counter() - start, 3), **extra)
+
+    def fail(stage, path, exc):
+        nonlocal errors
+        errors += 1
+        reporter.emit('error', stage=stage, path=path, error=f'{type(exc).__name__}: {exc}')
+
+    # Completed futures of both pools land here and are handled on this thread
+    finished = queue.Queue()
+    outstanding = 0
+    decrypting = {}
+
+    def submit(pool, stage, path, fn, *args):
+        nonlocal outstanding
+        outstanding += 1
+        if stage == 'decrypt':
+            decrypting[path] = tuner.level if tuner is not None else workers
+        t0 = time.perf_counter()
+        pool.submit(fn, *args).add_done_callback(lambda f: finished.put((stage, path, t0, f)))
+
+    def handle(stage, path, t0, future):
+        nonlocal outstanding, bytes_done
+        outstanding -= 1
+        level = decrypting.pop(path, None) if stage == 'decrypt' else None
+        try:
+            result = future.result()
+        except Exception as e:
+            fail(stage, path, e)
+            return
+
+        if stage == 'decrypt':
+            result, worker_metrics = result
+            metrics.merge(worker_metrics)
+            if not result:
+                # Skipped because the output already exists
+                reporter.emit('skip', stage=stage, path=path)
+                return
+            bytes_done += sizes[path]
+            if tuner is not None:
+                tuner.record(sizes[path], level)
+            progress(stage, path, t0, output=result)
+            source_of[result] = path
+            if journal is not None:
+                journal.record('decrypt', path, result)
+            if tag and result.endswith('.mp3'):
+                submit(tag_pool, 'tag', result, update_and_embed_metadata, result, '', '')
+            elif library is not None:
+                t1 = time.perf_counter()
+                library.add_file(result)
+                progress('index', result, t1)
+        elif stage == 'tag':
+            if result is None:
+                # Lookup or write failed; left out of the journal so a rerun tags it again
+                fail(stage, path, RuntimeError('metadata lookup failed'))
+            else:
+                progress(stage, path, t0)
+                # A partial result (lyrics or cover lookup failed) is retried on the next run too
+                if journal is not None and result is not PARTIAL:
+                    journal.record('tag', source_of.get(path, path), path)
+            if library is not None:
+                t1 = time.perf_counter()
+                library.add_file(path)
+                progress('index', path, t1)
+
+    with profiling.profile_run(profiling.profile_root(profile)) as profile_dir, \
+            ProcessPoolExecutor(max_workers=workers, initializer=ncmdump.init_worker, initargs=(profile_dir,)) as decrypt_pool, \
+            ThreadPoolExecutor(max_workers=max(1, tag_workers)) as tag_pool:
+        if sources is None:
+            inodes = {} if inode_order else None
+            sources = (item for p in paths
+                       for item in ncmdump.iter_files(p, include=include, exclude=exclude, inodes=inodes))
+            if inode_order:
+                sources = ncmdump._inode_order(sources, inodes)
+        for item in sources:
+            if item is not None:
+                fp, size = item
+                converted = journal.stage_target(fp, 'decrypt') if journal is not None else None
+                if not converted or not os.path.exists(converted):
+                    sizes[fp] = size
+                    submit(decrypt_pool, 'decrypt', fp, _convert, fp, output_dir, split_threads, sequential)
+                elif tag and converted.endswith('.mp3') and journal.stage_target(fp, 'tag') is None:
+                    # Interrupted between decrypt and tag: pick up at tagging
+                    source_of[converted] = fp
+                    submit(tag_pool, 'tag', converted, update_and_embed_metadata, converted, '', '')
+                else:
+                    reporter.emit('skip', stage='journal', path=fp)
+                # Bound the work in flight so a huge walk doesn't queue everything up front
+                while outstanding >= workers * 4 or (tuner is not None and len(decrypting) >= tuner.level):
+                    handle(*finished.get())
+            while not finished.empty():
+                handle(*finished.get())
+
+        while outstanding:
+            handle(*finished.get())
+
+    if library is not None:
+        library.close()
+    if journal is not None:
+        journal.close()
+
+    elapsed = time.perf_counter() - start
+    summary = {
+        'files': counts['decrypt'],
+        'total': len(sizes),
+        'errors': errors,
+        'bytes': bytes_done,
+        'elapsed': round(elapsed, 3),
+        'files_per_s': round(counts['decrypt'] / elapsed, 3) if elapsed else 0.0,
+        'mb_per_s': round(bytes_done / elapsed / 2**20, 3) if elapsed else 0.0,
+        'stages': {s: {'count': counts[s], 'seconds': round(stage_time[s], 3)} for s in STAGES},
+    }
+    cache_after = ncmdump.page_cache()
+    if cache_before and cache_after:
+        summary['page_cache_mb'] = {
+            'grown': round((cache_after['cached'] - cache_before['cached']) / 2**20, 1),
+            'dirty': round(cache_after['dirty'] / 2**20, 1),
+        }
+    if tuner is not None:
+        tuning = tuner.save()
+        reporter.emit('autotune', **tuning)
+        summary['workers'] = tuning['level']
+    reporter.emit('summary', **summary)
+    return summary
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return f'{st.st_size}:{st.st_mtime_ns}'
+
+
+def retag_library(output_dir='output', tag_workers=4, index=True, db_path=None, reporter=None):
+    """Fill in the tags converted ``.mp3`` files under ``output_dir`` lack.
+
+    Only missing fields are fetched and written; complete files cost one
+    tag read and no request. Files unchanged since their last pass (size
+    and mtime journaled in ``output_dir``) aren't opened at all, so a rerun
+    over a mostly finished library only touches what's new or edited. A
+    file whose lyrics or cover lookup failed isn't journaled, so the next
+    pass asks for them again.
+    Returns the summary dict that is also emitted.
+    """
+    reporter = reporter or JsonReporter()
+    covers.use_directory(os.path.join(output_dir, 'covers'))
+    library = LibraryIndex(db_path or os.path.join(output_dir, 'library.db')) if index else None
+    counts = {'updated': 0, 'unchanged': 0, 'untouched': 0, 'errors': 0}
+    start = time.perf_counter()
+    reporter.emit('start', tag_workers=tag_workers, output_dir=output_dir, mode='retag')
+
+    def handle(path, future):
+        result = future.result()
+        if result is None:
+            counts['errors'] += 1
+            reporter.emit('error', stage='retag', path=path, error='metadata lookup failed')
+            return
+        counts['updated' if result else 'unchanged'] += 1
+        if result is not PARTIAL:
+            journal.record('retag', path, _stamp(path))
+        if result and library is not None:
+            library.add_file(path)
+        reporter.emit('progress', stage='retag', path=path, updated=bool(result), partial=result is PARTIAL,
+                      done=counts['updated'] + counts['unchanged'], elapsed=round(time.perf_counter() - start, 3))
+
+    with Journal(os.path.join(output_dir, RETAG_JOURNAL)) as journal, \
+            ThreadPoolExecutor(max_workers=max(1, tag_workers)) as tag_pool:
+        inflight = {}
+        for root, dirs, files in os.walk(output_dir):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for name in sorted(files):
+                if not name.lower().endswith('.mp3'):
+                    continue
+                path = os.path.join(root, name)
+                if journal.stage_target(path, 'retag') == _stamp(path):
+                    counts['untouched'] += 1
+                    continue
+                inflight[tag_pool.submit(update_and_embed_metadata, path, '', '', missing_only=True)] = path
+                while len(inflight) >= tag_workers * 4:
+                    done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        handle(inflight.pop(future), future)
+        for future in list(inflight):
+            handle(inflight.pop(future), future)
+
+    if library is not None:
+        library.close()
+    elapsed = time.perf_counter() - start
+    summary = dict(counts, files=sum(counts.values()) - counts['errors'], elapsed=round(elapsed, 3))
+    reporter.emit('summary', **summary)
+    return summary
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='headless decrypt/tag/index pipeline')
+    parser.add_argument('paths', metavar='paths', type=str, nargs='*',
+                        help='one or more .ncm files or directories')
+    parser.add_argument('-o', '--output', metavar='', type=str, default='output',
+                        help='directory for converted files (default: output)')
+    parser.add_argument('-w', '--workers', metavar='', type=lambda value: value if value == 'auto' else int(value),
+                        default=None, help='decrypt processes, or "auto" to tune from measured throughput '
+                                           '(default: CPU count)')
+    parser.add_argument('-t', '--tag-workers', metavar='', type=int, default=4,
+                        help='concurrent metadata lookups (default: 4)')
+    parser.add_argument('--split-threads', metavar='', type=int, default=None,
+                        help='threads per file for very large payloads (default: CPU count / workers)')
+    parser.add_argument('--sequential', action='store_true',
+                        help='large reads, no page cache left behind and batched fsync, for spinning disks '
+                             'and network shares')
+    parser.add_argument('--inode-order', action='store_true',
+                        help='list the whole tree first and convert in inode (roughly on-disk) order')
+    parser.add_argument('--cover-size', metavar='', type=int, default=covers.COVER_SIZE,
+                        help=f'cover size in pixels to request (default: {covers.COVER_SIZE})')
+    parser.add_argument('--cover-bytes', metavar='', type=int, default=covers.COVER_MAX_BYTES,
+                        help=f're-encode covers larger than this many bytes, needs Pillow (default: {covers.COVER_MAX_BYTES})')
+    parser.add_argument('--db', metavar='', type=str, default=None,
+                        help='library index path (default: <output>/library.db)')
+    parser.add_argument('-i', '--include', metavar='', type=str, action='append',
+                        help='only convert files matching this glob pattern (repeatable)')
+    parser.add_argument('-x', '--exclude', metavar='', type=str, action='append',
+                        help='skip files and directories matching this glob pattern (repeatable)')
+    parser.add_argument('--metrics-out', metavar='', type=str, default=None,
+                        help='write per-stage metrics to this file (.prom for Prometheus text, JSON otherwise)')
+    parser.add_argument('--profile', metavar='', type=str, default=None,
+                        help=f'write cProfile/tracemalloc results for every process here (or set {profiling.ENV_VAR})')
+    parser.add_argument('--no-tag', action='store_true', help='skip online metadata lookup')
+    parser.add_argument('--no-index', action='store_true', help='skip the library index')
+    parser.add_argument('--no-resume', action='store_true',
+                        help='ignore and don\'t write the journal of finished files in the output directory')
+    parser.add_argument('--retag', action='store_true',
+                        help='instead of converting, fetch only the tags converted files in the output directory lack')
+    args = parser.parse_args()
+    if not args.paths and not args.retag:
+        parser.error('paths are required unless --retag is given')
+
+    covers.configure(os.path.join(args.output, 'covers'), args.cover_size, args.cover_bytes)
+    if args.retag:
+        summary = retag_library(args.output, tag_workers=args.tag_workers, index=not args.no_index, db_path=args.db)
+        if args.metrics_out:
+            metrics.dump(args.metrics_out, summary=summary)
+        sys.exit(1 if summary['errors'] else 0)
+    # Keep stdout machine readable; ncmdump's own log goes to stderr
+    summary = run_pipeline(
+        args.paths, output_dir=args.output, workers=args.workers, tag_workers=args.tag_workers,
+        tag=not args.no_tag, index=not args.no_index, db_path=args.db,
+        include=args.include, exclude=args.exclude, profile=args.profile,
+        split_threads=args.split_threads, resume=not args.no_resume,
+        sequential=args.sequential, inode_order=args.inode_order
+    )
+    if args.metrics_out:
+        metrics.dump(args.metrics_out, summary=summary)
+    sys.exit(1 if summary['errors'] else 0)
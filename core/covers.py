@@ -0,0 +1,215 @@
+"""Album covers: downloaded once per album, size-bounded, stored by content hash.
+
+NetEase serves resized covers when ``?param=<W>y<H>`` is appended to
+``picUrl``, so covers are requested at ``max_size`` pixels instead of the
+multi-MB original. If the result is still over ``max_bytes`` it is
+re-encoded as a smaller JPEG (only when Pillow is installed; without it
+the byte budget is inactive and a warning says so once).
+
+Blobs live under ``<directory>/<sha1>.<jpg|png>`` and ``albums.json`` maps
+album ids to them, so every track of an album reuses one download, across runs
+as well as within a batch.
+"""
+import os
+import json
+import hashlib
+import logging
+import threading
+
+from core.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+COVER_DIR = os.path.join('output', 'covers')
+COVER_SIZE = 500
+COVER_MAX_BYTES = 200 * 1024
+PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+
+_warned_no_pillow = False
+
+
+def image_format(data):
+    """``(extension, mime type)`` of cover bytes, by magic number; JPEG unless it's a PNG."""
+    if data[:len(PNG_MAGIC)] == PNG_MAGIC:
+        return 'png', 'image/png'
+    return 'jpg', 'image/jpeg'
+
+
+def sized_url(pic_url, size):
+    """``pic_url`` asking the image server for a ``size`` x ``size`` version."""
+    if not size:
+        return pic_url
+    sep = '&' if '?' in pic_url else '?'
+    return f'{pic_url}{sep}param={size}y{size}'
+
+
+def shrink(data, max_size=COVER_SIZE, max_bytes=COVER_MAX_BYTES):
+    """Re-encode ``data`` as a JPEG no larger than ``max_size`` px / ``max_bytes``.
+
+    Returns ``data`` unchanged when it already fits, when Pillow isn't
+    installed, or when it can't be decoded.
+    """
+    global _warned_no_pillow
+    if not max_bytes or len(data) <= max_bytes:
+        return data
+    try:
+        from PIL import Image
+    except ImportError:
+        if not _warned_no_pillow:
+            _warned_no_pillow = True
+            log.warning(f'Pillow is not installed: covers over {max_bytes} bytes are stored as downloaded')
+        return data
+
+    import io
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.thumbnail((max_size, max_size))
+        image = image.convert('RGB')
+    except Exception as e:
+        log.warning(f'Cannot decode cover for re-encoding: {e}')
+        return data
+
+    best = data
+    for quality in (90, 80, 70, 60, 50, 40):
+        out = io.BytesIO()
+        image.save(out, format='JPEG', quality=quality, optimize=True)
+        best = out.getvalue()
+        if len(best) <= max_bytes:
+            break
+    return best if len(best) < len(data) else data
+
+
+class CoverStore:
+    """Thread-safe album-id -> cover cache; concurrent lookups of one album share a download."""
+
+    def __init__(self, directory=COVER_DIR, max_size=COVER_SIZE, max_bytes=COVER_MAX_BYTES):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, 'albums.json')
+        self.lock = threading.Lock()
+        self.inflight = {}
+        try:
+            with open(self.index_path, encoding='utf-8') as f:
+                self.albums = json.load(f)
+        except (OSError, ValueError):
+            self.albums = {}
+
+    def _blob_path(self, name):
+        # Entries written before the extension was recorded are bare JPEG digests
+        return os.path.join(self.directory, name if '.' in name else f'{name}.jpg')
+
+    def _read(self, album_id):
+        name = self.albums.get(album_id)
+        if name is None:
+            return None
+        try:
+            with open(self._blob_path(name), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _save_locked(self, album_id, data):
+        name = f'{hashlib.sha1(data).hexdigest()}.{image_format(data)[0]}'
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._blob_path(name)
+        if not os.path.exists(path):
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+        self.albums[album_id] = name
+        with open(self.index_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.albums, f)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def cached(self, album_id):
+        """The stored cover for ``album_id``, or None. Never touches the network."""
+        if album_id is None:
+            return None
+        with self.lock:
+            return self._read(str(album_id))
+
+    def get(self, album_id, pic_url):
+        """Cover bytes for ``album_id``, downloading ``pic_url`` only on a miss."""
+        if album_id is None:
+            return self.download(pic_url)
+        album_id = str(album_id)
+        with self.lock:
+            data = self._read(album_id)
+            if data is not None:
+                metrics.inc('cover_cache_total', result='hit')
+                return data
+            pending = self.inflight.get(album_id)
+            owner = pending is None
+            if owner:
+                pending = self.inflight[album_id] = threading.Event()
+
+        if not owner:
+            # Another track of the same album is downloading it right now
+            pending.wait()
+            metrics.inc('cover_cache_total', result='shared')
+            with self.lock:
+                return self._read(album_id)
+
+        metrics.inc('cover_cache_total', result='miss')
+        try:
+            data = self.download(pic_url)
+            if data:
+                with self.lock:
+                    self._save_locked(album_id, data)
+            return data
+        finally:
+            with self.lock:
+                del self.inflight[album_id]
+            pending.set()
+
+    def download(self, pic_url):
+        import requests
+
+        if not pic_url:
+            return None
+        with metrics.stage('cover_download'):
+            response = requests.get(sized_url(pic_url, self.max_size), timeout=10)
+            response.raise_for_status()
+            data = response.content
+        metrics.add_bytes('cover_download', len(data))
+        with metrics.stage('cover_reencode'):
+            data = shrink(data, self.max_size, self.max_bytes)
+        metrics.add_bytes('cover_stored', len(data))
+        return data
+
+
+_default_store = None
+_default_lock = threading.Lock()
+
+
+def configure(directory=None, max_size=None, max_bytes=None):
+    """Replace the process-wide store used by ``metadata.update_and_embed_metadata``."""
+    global _default_store
+    with _default_lock:
+        _default_store = CoverStore(
+            directory or COVER_DIR,
+            COVER_SIZE if max_size is None else max_size,
+            COVER_MAX_BYTES if max_bytes is None else max_bytes,
+        )
+    return _default_store
+
+
+def use_directory(directory):
+    """Point the process-wide store at ``directory``, keeping its size limits.
+
+    Entry points call this with ``<output_dir>/covers`` so covers end up
+    next to the converted files rather than under the working directory.
+    """
+    store = default_store()
+    if os.path.abspath(store.directory) != os.path.abspath(directory):
+        store = configure(directory, store.max_size, store.max_bytes)
+    return store
+
+
+def default_store():
+    global _default_store
+    with _default_lock:
+        if _default_store is None:
+            _default_store = CoverStore()
+        return _default_store
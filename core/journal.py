@@ -0,0 +1,56 @@
+import os
+import json
+import threading
+
+JOURNAL_NAME = '.journal.jsonl'
+
+
+class Journal:
+    """Append-only record of finished pipeline stages, one JSON object per line.
+
+    An interrupted batch reads it back on the next run and continues with
+    the first stage each source hasn't finished, without re-reading
+    outputs. A lost tail after a crash only means those stages run again;
+    outputs themselves are written atomically.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = {}
+        try:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line
+                    self.done.setdefault(entry['source'], {})[entry['stage']] = entry.get('target')
+        except OSError:
+            pass
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def stage_target(self, source, stage):
+        """The output recorded for ``source`` at ``stage``, or None if it isn't done."""
+        return self.done.get(source, {}).get(stage)
+
+    def record(self, stage, source, target=None):
+        with self.lock:
+            self.done.setdefault(source, {})[stage] = target
+            self.file.write(json.dumps({'stage': stage, 'source': source, 'target': target},
+                                       ensure_ascii=False) + '\n')
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def journal_path(output_dir):
+    return os.path.join(output_dir, JOURNAL_NAME)
@@ -0,0 +1,314 @@
+"""Coordinator-free conversion of one shared tree by several machines.
+
+Every node walks the same source tree and writes into the same output
+directory, typically both on NFS. Before converting a file, a node claims
+it by creating ``<output>/.leases/<key>.lease`` with ``O_CREAT | O_EXCL``.
+This is atomic on local filesystems and NFSv3+, so only one node gets
+each file. While a node works, a heartbeat thread touches its lease files.
+A lease whose mtime hasn't moved for ``ttl`` seconds, as timed by the
+node that is watching it, belongs to a dead node. The watcher renames the
+lease away and claims the file itself. Timing it locally means clock skew
+between nodes doesn't matter.
+
+A finished file is never converted twice: outputs only appear under their
+final name once complete, and a file whose output exists is skipped. Each
+lease writes its own ``<output>.<token>.part``, and a node renames it into
+place only while it still holds the lease, so a node that stalled past the
+TTL can neither clobber nor publish over the node that took its file. The
+taking node adopts the old part, so a large file taken over from a dead
+node resumes from that node's checkpoint. Try it locally by starting a few processes on one tree::
+
+    python -m core.lease ~/ncm -o /tmp/out -w 2 &
+    python -m core.lease ~/ncm -o /tmp/out -w 2 &
+"""
+import os
+import json
+import time
+import socket
+import hashlib
+import logging
+import threading
+from functools import partial
+from collections import deque, namedtuple
+from uuid import uuid4
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from core import ncmdump
+from core.metrics import metrics
+
+LEASE_DIR = '.leases'
+LEASE_TTL = 60.0
+# How often a node with nothing to do looks at files other nodes hold
+IDLE_POLL = 1.0
+
+log = logging.getLogger(__name__)
+
+# ``previous`` is the token of the expired lease this one replaced, if any
+Lease = namedtuple('Lease', ['path', 'token', 'previous'])
+
+
+def _lease_token(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f).get('token')
+    except (OSError, ValueError):
+        return None
+
+
+def _holds(path, token):
+    return _lease_token(path) == token
+
+
+class LeaseTable:
+    """Lease files in ``directory``, held by this node until released."""
+
+    def __init__(self, directory, node=None, ttl=LEASE_TTL, heartbeat=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.node = node or f'{socket.gethostname()}:{os.getpid()}'
+        self.ttl = ttl
+        self.heartbeat = heartbeat or ttl / 4
+        self.lock = threading.Lock()
+        self.held = {}
+        self.seen = {}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._beat, name='lease-heartbeat', daemon=True)
+        self.thread.start()
+
+    def lease_path(self, source):
+        # Outputs are named after the source's basename, so leases are too;
+        # nodes may mount the share at different paths
+        key = hashlib.sha1(os.path.basename(source).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + '.lease')
+
+    def _stamp(self, path):
+        st = os.stat(path)
+        return st.st_ino, st.st_mtime_ns
+
+    def claim(self, source):
+        """Take the lease for ``source``; returns a ``Lease``, or None if another node holds it."""
+        path = self.lease_path(source)
+        previous = None
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self._expired(path):
+                    return None
+                previous = self._break(path)
+                if previous is False:
+                    return None
+                continue
+            token = uuid4().hex
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'node': self.node, 'token': token, 'source': source}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            with self.lock:
+                self.held[path] = token
+            return Lease(path, token, previous)
+        return None
+
+    def _expired(self, path):
+        try:
+            stamp = self._stamp(path)
+        except FileNotFoundError:
+            return True
+        now = time.monotonic()
+        seen = self.seen.get(path)
+        if seen is None or seen[0] != stamp:
+            self.seen[path] = (stamp, now)
+            return False
+        return now - seen[1] >= self.ttl
+
+    def _break(self, path):
+        """Move an expired lease out of the way and return its token; False if its owner turned out to be alive."""
+        stale = f'{path}.{uuid4().hex}.stale'
+        try:
+            os.rename(path, stale)
+        except FileNotFoundError:
+            return None  # released or broken by someone else meanwhile
+        seen = self.seen.pop(path, None)
+        if seen is not None and self._stamp(stale) != seen[0]:
+            # Heartbeat landed between our check and the rename: put it back
+            try:
+                os.link(stale, path)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+        log.warning(f'Lease "{path}" expired, taking over from {self._owner_name(stale)}')
+        token = _lease_token(stale)
+        os.remove(stale)
+        return token
+
+    def _owner_name(self, path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f).get('node')
+        except (OSError, ValueError):
+            return 'unknown node'
+
+    def release(self, path):
+        with self.lock:
+            token = self.held.pop(path, None)
+        if token is None:
+            return
+        # Rename first so we never delete a lease another node just took over
+        stale = f'{path}.{uuid4().hex}.stale'
+        try:
+            os.rename(path, stale)
+        except FileNotFoundError:
+            return
+        if _lease_token(stale) != token:
+            try:
+                os.link(stale, path)
+            except FileExistsError:
+                pass
+        os.remove(stale)
+
+    def _beat(self):
+        while not self.stop_event.wait(self.heartbeat):
+            with self.lock:
+                held = list(self.held.items())
+            for path, token in held:
+                try:
+                    if _lease_token(path) != token:
+                        raise FileNotFoundError(path)
+                    os.utime(path)
+                except FileNotFoundError:
+                    # We stalled past the TTL and another node took over. The
+                    # job finishes into its own part, which is then dropped.
+                    with self.lock:
+                        self.held.pop(path, None)
+                    log.warning(f'Lost lease "{path}" to another node')
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        with self.lock:
+            paths = list(self.held)
+        for path in paths:
+            self.release(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _converted(filepath, output_dir):
+    stem = os.path.join(output_dir, os.path.basename(filepath)[:-4])
+    return os.path.isfile(stem + '.mp3') or os.path.isfile(stem + '.flac')
+
+
+def _part_suffix(token):
+    return f'.{token}{ncmdump.PART_SUFFIX}'
+
+
+def _shared_job(job):
+    filepath, size, output_dir, split_threads, sequential, lease = job
+    if lease.previous:
+        # Carry on from the expired owner's part and checkpoint. If that node
+        # is only stalled, its writes land in the same bytes and its own
+        # rename finds nothing to publish.
+        stem = os.path.join(output_dir, os.path.basename(filepath)[:-4])
+        for ext in ('.mp3', '.flac'):
+            for suffix in ('', ncmdump.CHECKPOINT_SUFFIX):
+                try:
+                    os.rename(stem + ext + _part_suffix(lease.previous) + suffix,
+                              stem + ext + _part_suffix(lease.token) + suffix)
+                except FileNotFoundError:
+                    pass
+    target = ncmdump.dump_single_file(filepath, output_dir, split_threads, sequential=sequential,
+                                      part_suffix=_part_suffix(lease.token),
+                                      owned=partial(_holds, lease.path, lease.token))
+    return filepath, size, target, metrics.drain()
+
+
+def dump_shared(*paths, output_dir, n_workers=None, include=None, exclude=None, split_threads=1,
+                ttl=LEASE_TTL, heartbeat=None, node=None, sequential=False):
+    """Convert ``paths`` into ``output_dir`` alongside other nodes doing the same.
+
+    Returns this node's outputs once every file is converted by some node.
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    os.makedirs(output_dir, exist_ok=True)
+    files = [item for p in paths for item in ncmdump.iter_files(p, include=include, exclude=exclude)]
+    pending = deque(ncmdump._largest_first(iter(files), len(files) or 1))
+    outputs = []
+    inflight = {}
+
+    with LeaseTable(os.path.join(output_dir, LEASE_DIR), node=node, ttl=ttl, heartbeat=heartbeat) as table, \
+            ProcessPoolExecutor(max_workers=n_workers, initializer=ncmdump.init_worker) as pool:
+        log.info(f'Node {table.node}: {len(pending)} file(s) in the shared tree, {n_workers} workers')
+        while pending or inflight:
+            # One pass over what's left: claim work for free workers, put
+            # files other nodes hold at the back to look at again later
+            for _ in range(len(pending)):
+                if len(inflight) >= n_workers:
+                    break
+                fp, size = pending.popleft()
+                if _converted(fp, output_dir):
+                    continue
+                lease = table.claim(fp)
+                if lease is None:
+                    pending.append((fp, size))
+                    continue
+                job = (fp, size, output_dir, split_threads, sequential, lease)
+                inflight[pool.submit(_shared_job, job)] = (fp, lease)
+
+            if not inflight:
+                # Everything left is held elsewhere; look again soon so the
+                # last files don't wait a whole heartbeat once they're done
+                time.sleep(min(table.heartbeat, IDLE_POLL))
+                continue
+            done, _ = wait(inflight, timeout=table.heartbeat, return_when=FIRST_COMPLETED)
+            for future in done:
+                fp, lease = inflight.pop(future)
+                try:
+                    _, _, target, worker_metrics = future.result()
+                    metrics.merge(worker_metrics)
+                    if target:
+                        outputs.append(target)
+                except Exception as e:
+                    metrics.error('decrypt', e)
+                    log.error(f'Failed to convert "{fp}": {type(e).__name__}: {e}')
+                finally:
+                    table.release(lease.path)
+    log.info(f'Node {table.node}: converted {len(outputs)} file(s)')
+    return outputs
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    log.setLevel(logging.INFO)
+    log.addHandler(ncmdump.handler)
+    parser = ArgumentParser(description='convert a shared tree together with other nodes')
+    parser.add_argument('paths', metavar='paths', type=str, nargs='+', help='one or more paths to source files')
+    parser.add_argument('-o', '--output', metavar='', type=str, required=True,
+                        help='shared directory for converted files and leases')
+    parser.add_argument('-w', '--workers', metavar='', type=int, default=None,
+                        help='decrypt processes on this node (default: CPU count)')
+    parser.add_argument('-i', '--include', metavar='', type=str, action='append',
+                        help='only convert files matching this glob pattern (repeatable)')
+    parser.add_argument('-x', '--exclude', metavar='', type=str, action='append',
+                        help='skip files and directories matching this glob pattern (repeatable)')
+    parser.add_argument('--split-threads', metavar='', type=int, default=1,
+                        help=f'threads per file for payloads over {ncmdump.SPLIT_THRESHOLD >> 20} MiB (default: 1)')
+    parser.add_argument('--ttl', metavar='', type=float, default=LEASE_TTL,
+                        help=f'seconds without a heartbeat before a lease is taken over (default: {LEASE_TTL:g})')
+    parser.add_argument('--node', metavar='', type=str, default=None,
+                        help='name of this node in lease files (default: host:pid)')
+    parser.add_argument('--sequential', action='store_true',
+                        help='large reads, no page cache left behind and batched fsync (see ncmdump --sequential)')
+    parser.add_argument('--metrics-out', metavar='', type=str, default=None,
+                        help='write per-stage metrics to this file (.prom for Prometheus text, JSON otherwise)')
+    args = parser.parse_args()
+    dump_shared(*args.paths, output_dir=args.output, n_workers=args.workers, include=args.include,
+                exclude=args.exclude, split_threads=args.split_threads, ttl=args.ttl, node=args.node,
+                sequential=args.sequential)
+    if args.metrics_out:
+        metrics.dump(args.metrics_out)
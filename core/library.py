@@ -0,0 +1,175 @@
+import os
+import threading
+
+from core.lyrics import parse_lrc
+from core.metadata import get_song_metadata
+
+AUDIO_EXTENSIONS = ('.mp3', '.flac')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    path     TEXT PRIMARY KEY,
+    title    TEXT NOT NULL,
+    artist   TEXT NOT NULL,
+    album    TEXT NOT NULL DEFAULT '',
+    duration REAL NOT NULL DEFAULT 0,
+    size     INTEGER NOT NULL DEFAULT 0,
+    mtime    REAL NOT NULL DEFAULT 0,
+    lyrics   TEXT
+);
+CREATE TABLE IF NOT EXISTS lyric_lines (
+    id   INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS lyric_lines_path ON lyric_lines (path);
+"""
+
+# Trigram tokens match any substring, which CJK lyrics need: the unicode61
+# tokenizer would treat a whole line of Chinese as a single word
+LYRICS_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS lyrics_fts
+    USING fts5(text, content='lyric_lines', content_rowid='id', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS lyric_lines_ai AFTER INSERT ON lyric_lines BEGIN
+    INSERT INTO lyrics_fts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS lyric_lines_ad AFTER DELETE ON lyric_lines BEGIN
+    INSERT INTO lyrics_fts (lyrics_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+"""
+SCHEMA_VERSION = 1
+
+
+class LibraryIndex:
+    """SQLite index of converted tracks, keyed by file path.
+
+    Rows remember the file's size and mtime so a rescan only re-reads tags
+    of files that changed since they were indexed. Lyrics are split into
+    timed lines and kept in a full-text index for ``search_lyrics``.
+    """
+
+    def __init__(self, db_path):
+        import sqlite3
+
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        try:
+            self.conn.executescript(LYRICS_FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            # SQLite without FTS5 or the trigram tokenizer (< 3.34): search scans lyric_lines
+            self.fts = False
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            # Index lyrics of tracks added before lyric search existed
+            for path, lyrics in self.conn.execute('SELECT path, lyrics FROM tracks').fetchall():
+                self._index_lyrics(path, lyrics)
+            self.conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def is_current(self, path, st=None):
+        st = st or os.stat(path)
+        with self.lock:
+            row = self.conn.execute('SELECT size, mtime FROM tracks WHERE path = ?', (path,)).fetchone()
+        return row is not None and row[0] == st.st_size and row[1] == st.st_mtime
+
+    def _index_lyrics(self, path, lyrics):
+        self.conn.execute('DELETE FROM lyric_lines WHERE path = ?', (path,))
+        self.conn.executemany(
+            'INSERT INTO lyric_lines (path, time, text) VALUES (?, ?, ?)',
+            [(path, line['time'], line['text']) for line in parse_lrc(lyrics)]
+        )
+
+    def add(self, metadata, st=None):
+        st = st or os.stat(metadata['path'])
+        lyrics = metadata.get('lyrics')
+        with self.lock:
+            row = self.conn.execute('SELECT lyrics FROM tracks WHERE path = ?', (metadata['path'],)).fetchone()
+            if row is None or row[0] != lyrics:
+                self._index_lyrics(metadata['path'], lyrics)
+            self.conn.execute(
+                'INSERT OR REPLACE INTO tracks (path, title, artist, album, duration, size, mtime, lyrics) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (metadata['path'], metadata['title'], metadata['artist'], metadata.get('album', ''),
+                 metadata.get('duration') or 0, st.st_size, st.st_mtime, lyrics)
+            )
+            self.conn.commit()
+
+    def add_file(self, path):
+        """Read tags from ``path`` and index it. Returns the metadata or None."""
+        metadata = get_song_metadata(path)
+        if metadata:
+            self.add(metadata)
+        return metadata
+
+    def remove(self, path):
+        with self.lock:
+            self.conn.execute('DELETE FROM tracks WHERE path = ?', (path,))
+            self.conn.execute('DELETE FROM lyric_lines WHERE path = ?', (path,))
+            self.conn.commit()
+
+    def scan(self, directory):
+        """Index new or changed tracks under ``directory`` and drop vanished ones."""
+        seen = set()
+        updated = 0
+        for entry in os.scandir(directory):
+            if not entry.is_file() or not entry.name.lower().endswith(AUDIO_EXTENSIONS):
+                continue
+            seen.add(entry.path)
+            st = entry.stat()
+            if self.is_current(entry.path, st):
+                continue
+            metadata = get_song_metadata(entry.path)
+            if metadata:
+                self.add(metadata, st)
+                updated += 1
+        for path in [t['path'] for t in self.tracks()]:
+            if os.path.dirname(path) == directory and path not in seen:
+                self.remove(path)
+        return updated
+
+    def tracks(self):
+        with self.lock:
+            cursor = self.conn.execute(
+                'SELECT path, title, artist, album, duration, lyrics FROM tracks ORDER BY path'
+            )
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def search_lyrics(self, query, limit=20):
+        """Lyric lines containing ``query``, best matches first.
+
+        Returns ``[{'path', 'title', 'artist', 'time', 'text'}]`` with the
+        line's start ``time`` in ms, ready for seeking.
+        """
+        query = query.strip()
+        if not query:
+            return []
+        select = 'SELECT l.path, t.title, t.artist, l.time, l.text FROM '
+        if self.fts and len(query) >= 3:
+            sql = (select + 'lyrics_fts JOIN lyric_lines l ON l.id = lyrics_fts.rowid '
+                   'JOIN tracks t ON t.path = l.path WHERE lyrics_fts MATCH ? ORDER BY lyrics_fts.rank LIMIT ?')
+            args = ('"' + query.replace('"', '""') + '"', limit)
+        else:
+            # Trigrams can't match fewer than three characters
+            pattern = '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            sql = (select + "lyric_lines l JOIN tracks t ON t.path = l.path WHERE l.text LIKE ? ESCAPE '\\' "
+                   'ORDER BY t.title, l.time LIMIT ?')
+            args = (pattern, limit)
+        with self.lock:
+            cursor = self.conn.execute(sql, args)
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
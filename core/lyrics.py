@@ -0,0 +1,36 @@
+import re
+from bisect import bisect_right
+
+TIME_REGEX = re.compile(r'\[(\d{2}):(\d{2})\.(\d{2,3})\]')
+
+
+def parse_lrc(lrc_content):
+    """Parse LRC text into ``[{'time': ms, 'text': line}]`` sorted by time."""
+    parsed = []
+    if not lrc_content:
+        return parsed
+
+    for line in lrc_content.split('\n'):
+        text = TIME_REGEX.sub('', line).strip()
+        if not text:
+            continue
+
+        for match in TIME_REGEX.finditer(line):
+            minutes = int(match.group(1))
+            seconds = int(match.group(2))
+            ms_str = match.group(3).ljust(3, '0')
+            ms = int(ms_str)
+
+            time_in_ms = (minutes * 60 + seconds) * 1000 + ms
+            parsed.append({'time': time_in_ms, 'text': text})
+
+    parsed.sort(key=lambda x: x['time'])
+    return parsed
+
+
+def line_at(times, position):
+    """Index of the lyric line active at ``position`` ms, or -1 before the first line.
+
+    ``times`` is the sorted list of line start times from ``parse_lrc``.
+    """
+    return bisect_right(times, position) - 1
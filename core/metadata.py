@@ -1,89 +1,186 @@
 import os
-import shutil
-import traceback
-import requests
-from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, APIC, USLT, TIT2, TPE1, TALB
-from pyncm.apis import cloudsearch, track
+import time
+import logging
 
-# The ncmdump script is in the same directory, so a direct import should work
-# when the app is run from the project root.
-from core import ncmdump
+# requests, mutagen, pyncm and ncmdump (Crypto, tqdm) are imported inside the
+# functions that use them so that opening the GUI doesn't pay for them.
+from core.metrics import metrics
+from core import covers, tagreader
+
+log = logging.getLogger(__name__)
 
 
 def get_song_metadata(song_path):
+    """Title, artist, album, duration and lyrics of ``song_path``, or None.
+
+    Uses the single-pass ``tagreader`` (a few KB per file) and falls back to
+    mutagen for tags it doesn't handle. ``lyrics_ref``/``cover_ref`` point at
+    the raw frames so ``get_cover_data_from_tags`` can skip the tag walk.
+    """
+    t0 = time.perf_counter()
     try:
-        audio = MP3(song_path, ID3=ID3)
-        tag = audio.tags
-        
+        info = tagreader.read_tags(song_path)
+        if info is None:
+            return _get_song_metadata_mutagen(song_path)
+
         metadata = {
             "path": song_path,
-            "title": str(tag.get('TIT2', [os.path.basename(song_path).rsplit('.', 1)[0]])[0]),
-            "artist": str(tag.get('TPE1', ['未知艺术家'])[0]),
-            "duration": audio.info.length,
+            "title": info.get('title') or os.path.basename(song_path).rsplit('.', 1)[0],
+            "artist": info.get('artist') or '未知艺术家',
+            "album": info.get('album', ''),
+            "duration": info['duration'],
             "lyrics": None,
-            "cover_pixmap": None
+            "cover_pixmap": None,
+            "lyrics_ref": info.get('lyrics_ref'),
+            "cover_ref": info.get('cover_ref'),
         }
-
-        for key in tag.keys():
-            if key.startswith('USLT'):
-                metadata['lyrics'] = tag[key].text
-                break
-
-        # This part requires Qt, so we handle it in the main UI thread after loading
-        # for key in tag.keys():
-        #     if key.startswith('APIC:'):
-        #         img_data = tag[key].data
-        #         pixmap = QPixmap()
-        #         pixmap.loadFromData(img_data)
-        #         metadata['cover_pixmap'] = pixmap.scaled(200, 200, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        #         break
-        
+        if metadata['lyrics_ref']:
+            metadata['lyrics'] = tagreader.load_lyrics(song_path, metadata['lyrics_ref'])
         return metadata
     except Exception as e:
-        traceback.print_exc()
+        metrics.error('tag_read', e)
+        log.exception(f'Reading tags failed for "{song_path}"')
         return None
+    finally:
+        metrics.add_time('tag_read', time.perf_counter() - t0)
+
+def _get_song_metadata_mutagen(song_path):
+    from mutagen.mp3 import MP3
+    from mutagen.id3 import ID3
+
+    audio = MP3(song_path, ID3=ID3)
+    tag = audio.tags
+
+    metadata = {
+        "path": song_path,
+        "title": str(tag.get('TIT2', [os.path.basename(song_path).rsplit('.', 1)[0]])[0]),
+        "artist": str(tag.get('TPE1', ['未知艺术家'])[0]),
+        "album": str(tag.get('TALB', [''])[0]),
+        "duration": audio.info.length,
+        "lyrics": None,
+        "cover_pixmap": None
+    }
+
+    for key in tag.keys():
+        if key.startswith('USLT'):
+            metadata['lyrics'] = tag[key].text
+            break
 
-def get_cover_data_from_tags(song_path):
+    return metadata
+
+def get_cover_data_from_tags(song_path, cover_ref=None):
     try:
-        audio = MP3(song_path, ID3=ID3)
-        tag = audio.tags
-        for key in tag.keys():
-            if key.startswith('APIC:'):
-                return tag[key].data
+        if cover_ref is None:
+            info = tagreader.read_tags(song_path)
+            if info is None:
+                return _get_cover_data_mutagen(song_path)
+            cover_ref = info.get('cover_ref')
+        return tagreader.load_cover(song_path, cover_ref) if cover_ref else None
     except Exception:
         return None
+
+def _get_cover_data_mutagen(song_path):
+    from mutagen.mp3 import MP3
+    from mutagen.id3 import ID3
+
+    audio = MP3(song_path, ID3=ID3)
+    tag = audio.tags
+    for key in tag.keys():
+        if key.startswith('APIC:'):
+            return tag[key].data
     return None
 
-def convert_ncm_to_mp3(ncm_path):
-    source_dir = os.path.dirname(ncm_path)
+class ConversionCancelled(Exception):
+    pass
+
+def convert_ncm_to_mp3(ncm_path, progress=None, cancel=None):
+    # Decrypt straight into output/ without chdir, so several conversions can
+    # run side by side. ``progress(n)`` gets the bytes written per block;
+    # setting the ``cancel`` event stops mid-file and removes the partial output.
+    from core import ncmdump
+
     output_dir = 'output'
-    if not os.path.exists(output_dir): os.makedirs(output_dir)
+    if not os.path.exists(output_dir): os.makedirs(output_dir, exist_ok=True)
+
+    def on_block(n):
+        if cancel is not None and cancel.is_set():
+            raise ConversionCancelled(ncm_path)
+        if progress is not None:
+            progress(n)
 
-    original_cwd = os.getcwd()
     try:
-        # ncmdump seems to work best when run from the file's directory
-        if source_dir: os.chdir(source_dir)
-        ncmdump.dump(os.path.basename(ncm_path))
-    except Exception:
-        traceback.print_exc()
+        target = ncmdump.dump_single_file(ncm_path, output_dir, progress=on_block)
+    except ConversionCancelled:
+        log.info(f'Conversion of "{ncm_path}" cancelled')
+        return None
+    except Exception as e:
+        metrics.error('convert', e)
+        log.exception(f'Converting "{ncm_path}" failed')
         return None
-    finally:
-        os.chdir(original_cwd)
 
-    mp3_file = os.path.basename(ncm_path).replace('.ncm', '.mp3')
-    original_converted_path = os.path.join(source_dir, mp3_file)
+    if target and target.endswith('.mp3'):
+        return target
+    return None
 
-    if os.path.exists(original_converted_path):
-        destination_path = os.path.join(output_dir, os.path.basename(original_converted_path))
+ENRICH_FIELDS = ('title', 'artist', 'album', 'lyrics', 'cover')
+# Some tags were written, but a lyrics or cover lookup failed and may succeed later
+PARTIAL = 'partial'
+
+
+def update_and_embed_metadata(mp3_path, title, artist, missing_only=False, cancel=None):
+    """Look up ``mp3_path`` online and tag it.
+
+    By default every tag is replaced. With ``missing_only`` the existing
+    tags are kept, only the fields they lack are fetched and written, and a
+    file with nothing missing is left alone without any network request.
+    Returns True if tags were written, False if there was nothing to do or
+    no match, None on failure. If the lyrics or cover lookup fails the
+    result is ``PARTIAL`` when other tags were written and None otherwise,
+    so callers know to try the file again. Once ``cancel`` (a
+    ``threading.Event``) is set, lookups still in flight finish but nothing
+    is written.
+    """
+    with metrics.track_file(mp3_path, kind='enrich'):
+        if not missing_only:
+            return _update_and_embed_metadata(mp3_path, title, artist, cancel=cancel)
         try:
-            shutil.move(original_converted_path, destination_path)
-        except shutil.Error: # File might already exist
-            os.remove(original_converted_path)
-        return destination_path
-    return None
+            existing = _existing_tags(mp3_path)
+        except Exception as e:
+            metrics.error('tag_read', e)
+            log.exception(f'Reading tags failed for "{mp3_path}"')
+            return None
+        missing = {field for field in ENRICH_FIELDS if not existing.get(field)}
+        if not missing:
+            metrics.inc('enrich_skipped_total')
+            return False
+        for field in missing:
+            metrics.inc('enrich_missing_total', field=field)
+        return _update_and_embed_metadata(mp3_path, existing.get('title') or title,
+                                          existing.get('artist') or artist, missing, cancel)
+
+def _existing_tags(mp3_path):
+    """Which fields ``mp3_path`` already has: title/artist/album text, lyrics/cover truthiness."""
+    info = tagreader.read_tags(mp3_path)
+    if info is not None:
+        return dict(info, lyrics=info.get('lyrics_ref'), cover=info.get('cover_ref'))
+
+    from mutagen.id3 import ID3, ID3NoHeaderError
+
+    try:
+        tag = ID3(mp3_path)
+    except ID3NoHeaderError:
+        return {}
+    return {
+        'title': str(tag.get('TIT2', [''])[0]),
+        'artist': str(tag.get('TPE1', [''])[0]),
+        'album': str(tag.get('TALB', [''])[0]),
+        'lyrics': bool(tag.getall('USLT')),
+        'cover': bool(tag.getall('APIC')),
+    }
+
+def _update_and_embed_metadata(mp3_path, title, artist, missing=None, cancel=None):
+    from pyncm.apis import cloudsearch, track
 
-def update_and_embed_metadata(mp3_path, title, artist):
     try:
         filename = os.path.basename(mp3_path).rsplit('.', 1)[0]
         if not title or not artist: # If empty, use filename
@@ -95,47 +192,113 @@ def update_and_embed_metadata(mp3_path, title, artist):
                 title = parts[0]
                 artist = ""
 
-        search_result = cloudsearch.GetSearchResult(keyword=f"{title} {artist}", limit=1)
+        with metrics.stage('search'):
+            search_result = cloudsearch.GetSearchResult(keyword=f"{title} {artist}", limit=1)
         songs = search_result.get('result', {}).get('songs')
-        if not songs: return
+        if not songs:
+            metrics.inc('search_misses_total')
+            return False
         
         song_info = songs[0]
         song_id = song_info.get('id')
-        if not song_id: return
+        if not song_id: return False
         
         title_from_api = song_info.get('name', title)
         artist_str = '/'.join(a['name'] for a in song_info.get('ar', [])) or artist
         album_str = song_info.get('al', {}).get('name', '')
         
+        # Lyrics and cover are optional: a failed lookup doesn't stop the other
+        # tags, but is reported so the file gets another try
+        failed = []
         lyrics = None
         try:
-            lrc_result = track.GetTrackLyrics(song_id)
-            lyrics = lrc_result.get('lrc', {}).get('lyric')
-        except Exception: pass
+            if missing is None or 'lyrics' in missing:
+                with metrics.stage('lyrics'):
+                    lrc_result = track.GetTrackLyrics(song_id)
+                lyrics = lrc_result.get('lrc', {}).get('lyric')
+        except Exception as e:
+            failed.append('lyrics')
+            log.warning(f'Lyrics lookup failed for "{mp3_path}": {e}')
 
+        # One download per album: later tracks reuse the stored, size-bounded cover
         cover_data = None
+        album = song_info.get('al') or {}
+        store = covers.default_store()
         try:
-            track_detail = track.GetTrackDetail(song_id)
-            pic_url = track_detail['songs'][0]['al']['picUrl']
-            if pic_url:
-                response = requests.get(pic_url, timeout=10)
-                response.raise_for_status()
-                cover_data = response.content
-        except Exception: pass
-            
-        audio = MP3(mp3_path)
-        try:
-            audio.delete()
-        except: pass
-        audio.tags = ID3()
-        audio.tags.add(TIT2(encoding=3, text=title_from_api))
-        audio.tags.add(TPE1(encoding=3, text=artist_str))
-        audio.tags.add(TALB(encoding=3, text=album_str))
-        if lyrics:
-            audio.tags.add(USLT(encoding=3, lang='XXX', desc='Lyrics', text=lyrics))
-        if cover_data:
-            audio.tags.add(APIC(encoding=3, mime='image/jpeg', type=3, desc='Cover', data=cover_data))
-        
-        audio.save(v2_version=3)
+            if missing is None or 'cover' in missing:
+                cover_data = store.cached(album.get('id'))
+                if cover_data is None:
+                    pic_url = album.get('picUrl')
+                    if not pic_url:
+                        with metrics.stage('track_detail'):
+                            track_detail = track.GetTrackDetail(song_id)
+                        pic_url = track_detail['songs'][0]['al']['picUrl']
+                    cover_data = store.get(album.get('id'), pic_url)
+        except Exception as e:
+            failed.append('cover')
+            log.warning(f'Cover download failed for "{mp3_path}": {e}')
+
+        if cancel is not None and cancel.is_set():
+            log.info(f'Tagging of "{mp3_path}" cancelled')
+            return False
+        with metrics.stage('tag_save'):
+            if missing is None:
+                embed_metadata(mp3_path, title_from_api, artist_str, album_str, lyrics, cover_data)
+                written = True
+            else:
+                found = {'title': title_from_api, 'artist': artist_str, 'album': album_str,
+                         'lyrics': lyrics, 'cover_data': cover_data}
+                written = update_tags(mp3_path, **{k: v for k, v in found.items()
+                                                   if v and k.replace('_data', '') in missing})
+        if failed:
+            return PARTIAL if written else None
+        return written
     except Exception as e:
-        traceback.print_exc() 
\ No newline at end of file
+        log.exception(f'Updating metadata failed for "{mp3_path}"')
+        return None
+
+def embed_metadata(mp3_path, title, artist, album, lyrics=None, cover_data=None):
+    """Replace the ID3 tag of ``mp3_path`` with the given fields."""
+    from mutagen.mp3 import MP3
+    from mutagen.id3 import ID3, APIC, USLT, TIT2, TPE1, TALB
+
+    audio = MP3(mp3_path)
+    try:
+        audio.delete()
+    except: pass
+    audio.tags = ID3()
+    audio.tags.add(TIT2(encoding=3, text=title))
+    audio.tags.add(TPE1(encoding=3, text=artist))
+    audio.tags.add(TALB(encoding=3, text=album))
+    if lyrics:
+        audio.tags.add(USLT(encoding=3, lang='XXX', desc='Lyrics', text=lyrics))
+    if cover_data:
+        audio.tags.add(APIC(encoding=3, mime=covers.image_format(cover_data)[1], type=3, desc='Cover', data=cover_data))
+    
+    audio.save(v2_version=3) 
+
+def update_tags(mp3_path, title=None, artist=None, album=None, lyrics=None, cover_data=None):
+    """Add or replace just the given frames, keeping the rest of the tag.
+
+    mutagen rewrites the tag in place when it still fits in the existing
+    padding, so the audio data isn't copied. Returns True if anything was set.
+    """
+    from mutagen.id3 import ID3, ID3NoHeaderError, APIC, USLT, TIT2, TPE1, TALB
+
+    try:
+        tags = ID3(mp3_path)
+        v2_version = 4 if tags.version >= (2, 4, 0) else 3
+    except ID3NoHeaderError:
+        tags, v2_version = ID3(), 3
+    frames = [TIT2(encoding=3, text=title) if title else None,
+              TPE1(encoding=3, text=artist) if artist else None,
+              TALB(encoding=3, text=album) if album else None,
+              USLT(encoding=3, lang='XXX', desc='Lyrics', text=lyrics) if lyrics else None,
+              APIC(encoding=3, mime=covers.image_format(cover_data)[1], type=3, desc='Cover', data=cover_data)
+              if cover_data else None]
+    frames = [frame for frame in frames if frame is not None]
+    for frame in frames:
+        tags.setall(frame.FrameID, [frame])
+    if frames:
+        tags.save(mp3_path, v2_version=v2_version)
+    return bool(frames)
@@ -0,0 +1,249 @@
+"""Per-stage timing and byte counters for conversion and enrichment.
+
+A process-wide ``metrics`` registry holds counters and histograms keyed by
+name and labels. Code under measurement wraps work in ``metrics.stage()``;
+when a ``metrics.track_file()`` block is active on the same thread, stage
+times and byte counts are also collected into a per-file record.
+
+Pool workers ship their registry back with ``drain()`` and the parent
+folds it in with ``merge()``, so batch totals cover every process.
+"""
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Histogram:
+    def __init__(self, buckets=SECONDS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bucket bound below which ``q`` of the observations fall."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            seen += n
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def to_dict(self):
+        return {'buckets': list(self.buckets), 'counts': list(self.counts), 'count': self.count, 'sum': self.sum}
+
+    def merge(self, data):
+        if tuple(data['buckets']) != self.buckets:
+            raise ValueError('histogram bucket mismatch')
+        self.counts = [a + b for a, b in zip(self.counts, data['counts'])]
+        self.count += data['count']
+        self.sum += data['sum']
+
+
+class FileRecord:
+    def __init__(self, path):
+        self.path = path
+        self.stages = {}
+        self.bytes = {}
+        self.error = None
+
+    def to_dict(self):
+        return {'path': self.path, 'stages': self.stages, 'bytes': self.bytes, 'error': self.error}
+
+
+class Metrics:
+    def __init__(self, max_files=1000):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counters = {}
+        self.histograms = {}
+        self.files = deque(maxlen=max_files)
+
+    # --- primitives ---
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(value)
+
+    # --- stage / file helpers ---
+
+    @property
+    def current_file(self):
+        return getattr(self.local, 'record', None)
+
+    def add_time(self, stage, seconds):
+        self.observe('stage_seconds', seconds, stage=stage)
+        record = self.current_file
+        if record is not None:
+            record.stages[stage] = record.stages.get(stage, 0.0) + seconds
+
+    def add_bytes(self, kind, n):
+        self.inc('bytes_total', n, kind=kind)
+        record = self.current_file
+        if record is not None:
+            record.bytes[kind] = record.bytes.get(kind, 0) + n
+
+    def error(self, stage, exc=None):
+        self.inc('errors_total', stage=stage)
+        record = self.current_file
+        if record is not None and record.error is None:
+            record.error = f'{stage}: {type(exc).__name__}: {exc}' if exc else stage
+
+    @contextmanager
+    def stage(self, stage):
+        t0 = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.error(stage, e)
+            raise
+        finally:
+            self.add_time(stage, time.perf_counter() - t0)
+
+    @contextmanager
+    def track_file(self, path, kind='file'):
+        """Collect the stages run on this thread into one per-file record."""
+        outer = self.current_file
+        if outer is not None:
+            # Nested call for the same work (e.g. dump -> dump_single_file)
+            yield outer
+            return
+        record = FileRecord(path)
+        self.local.record = record
+        t0 = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self.local.record = None
+            record.stages['total'] = time.perf_counter() - t0
+            self.observe('file_seconds', record.stages['total'], kind=kind)
+            self.inc('files_total', kind=kind, status='error' if record.error else 'ok')
+            with self.lock:
+                self.files.append(record.to_dict())
+
+    # --- export ---
+
+    def _snapshot_locked(self):
+        return {
+            'counters': [[name, dict(labels), value] for (name, labels), value in self.counters.items()],
+            'histograms': [[name, dict(labels), h.to_dict()] for (name, labels), h in self.histograms.items()],
+            'files': list(self.files),
+        }
+
+    def snapshot(self):
+        with self.lock:
+            return self._snapshot_locked()
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.files.clear()
+
+    def drain(self):
+        """Snapshot and reset in one step (used to ship worker metrics to the parent)."""
+        with self.lock:
+            snap = self._snapshot_locked()
+            self.counters.clear()
+            self.histograms.clear()
+            self.files.clear()
+        return snap
+
+    def merge(self, snap):
+        with self.lock:
+            for name, labels, value in snap['counters']:
+                key = _key(name, labels)
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, data in snap['histograms']:
+                key = _key(name, labels)
+                hist = self.histograms.get(key)
+                if hist is None:
+                    hist = self.histograms[key] = Histogram(data['buckets'])
+                hist.merge(data)
+            self.files.extend(snap['files'])
+
+    def stage_summary(self):
+        """``{stage: {count, total, mean, p50, p95}}`` from the stage histograms."""
+        summary = {}
+        with self.lock:
+            for (name, labels), hist in self.histograms.items():
+                if name != 'stage_seconds' or not hist.count:
+                    continue
+                summary[dict(labels)['stage']] = {
+                    'count': hist.count,
+                    'total': hist.sum,
+                    'mean': hist.sum / hist.count,
+                    'p50': hist.quantile(0.5),
+                    'p95': hist.quantile(0.95),
+                }
+        return summary
+
+    def to_json(self, **extra):
+        data = self.snapshot()
+        data['stages'] = self.stage_summary()
+        data.update(extra)
+        return json.dumps(data, ensure_ascii=False, indent=2)
+
+    def to_prometheus(self, prefix='ncm_'):
+        def fmt_labels(labels, **more):
+            labels = dict(labels, **more)
+            if not labels:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+        lines = []
+        snap = self.snapshot()
+        for name in sorted({c[0] for c in snap['counters']}):
+            lines.append(f'# TYPE {prefix}{name} counter')
+            for cname, labels, value in snap['counters']:
+                if cname == name:
+                    lines.append(f'{prefix}{name}{fmt_labels(labels)} {value}')
+        for name in sorted({h[0] for h in snap['histograms']}):
+            lines.append(f'# TYPE {prefix}{name} histogram')
+            for hname, labels, data in snap['histograms']:
+                if hname != name:
+                    continue
+                cumulative = 0
+                for bound, n in zip(data['buckets'] + ['+Inf'], data['counts']):
+                    cumulative += n
+                    lines.append(f'{prefix}{name}_bucket{fmt_labels(labels, le=bound)} {cumulative}')
+                lines.append(f'{prefix}{name}_sum{fmt_labels(labels)} {data["sum"]}')
+                lines.append(f'{prefix}{name}_count{fmt_labels(labels)} {data["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path, **extra):
+        """Write to ``path``: Prometheus text for ``*.prom``/``*.txt``, JSON otherwise."""
+        text = self.to_prometheus() if path.endswith(('.prom', '.txt')) else self.to_json(**extra)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+
+metrics = Metrics()
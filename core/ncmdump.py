@@ -3,12 +3,23 @@ import json
 import base64
 import struct
 import logging
+import time
+import heapq
 import binascii
-from glob import glob
-from tqdm.auto import tqdm
+import threading
+from fnmatch import fnmatch
 from textwrap import dedent
-from Crypto.Cipher import AES
-from multiprocessing import Pool
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from core import profiling, autotune
+    from core.metrics import metrics
+except ImportError:
+    # Run as a plain script (python core/ncmdump.py)
+    import profiling
+    import autotune
+    from metrics import metrics
 
 
 class TqdmLoggingHandler(logging.StreamHandler):
@@ -19,9 +30,11 @@ class TqdmLoggingHandler(logging.StreamHandler):
     # https://github.com/tqdm/tqdm/blob/f86104a1f30c38e6f80bfd8fb16d5fcde1e7749f/tqdm/std.py#L614-L620
 
     def emit(self, record):
+        from tqdm.auto import tqdm
+
         try:
             msg = self.format(record)
-            tqdm.write(msg, end=self.terminator)
+            tqdm.write(msg, file=self.stream, end=self.terminator)
         except RecursionError:
             raise
         except Exception:
@@ -36,13 +49,370 @@ datefmt = '%Y-%m-%d %H:%M:%S'
 handler.setFormatter(logging.Formatter(fmt, datefmt))
 log.addHandler(handler)
 
+# hex to str
+CORE_KEY = binascii.a2b_hex('687A4852416D736F356B496E62617857')
+META_KEY = binascii.a2b_hex('2331346C6A6B5F215C5D2630553C2728')
+
+# ECB ciphers are stateless, so one pair per process is enough
+_ciphers = None
+
+
+def get_ciphers():
+    global _ciphers
+    if _ciphers is None:
+        from Crypto.Cipher import AES
+
+        _ciphers = (AES.new(CORE_KEY, AES.MODE_ECB), AES.new(META_KEY, AES.MODE_ECB))
+    return _ciphers
+
+
+NcmHeader = namedtuple('NcmHeader', ['key_box', 'meta_data', 'image_data', 'audio_offset'])
+
+MAGIC = b'CTENFDAM'
+BLOCK_SIZE = 0x8000
+# Payloads at least this big are split across threads when split_threads > 1
+# and written in RANGE_BYTES pieces that are checkpointed for resuming
+SPLIT_THRESHOLD = 64 << 20
+RANGE_BYTES = 16 << 20
+# Sequential I/O mode (spinning disks, network shares): bigger reads, pages
+# dropped behind the cursor in WRITEBACK_BYTES steps, one fsync per
+# SYNC_BYTES of checkpointed ranges instead of one per range
+SEQUENTIAL_BLOCK_SIZE = 1 << 20
+WRITEBACK_BYTES = 8 << 20
+SYNC_BYTES = 64 << 20
+# Outputs are written here first and renamed into place when complete
+PART_SUFFIX = '.part'
+CHECKPOINT_SUFFIX = '.ckpt'
+unpad = lambda s: s[0:-(s[-1] if isinstance(s[-1], int) else ord(s[-1]))]
+
+
+def build_key_box(key_data):
+    """RC4-style key scheduling over the decrypted track key."""
+    key_length = len(key_data)
+    key_box = bytearray(range(256))
+
+    c = 0
+    last_byte = 0
+    key_offset = 0
+    for i in range(256):
+        swap = key_box[i]
+        c = (swap + last_byte + key_data[key_offset]) & 0xff
+        key_offset += 1
+        if key_offset >= key_length:
+            key_offset = 0
+        key_box[i] = key_box[c]
+        key_box[c] = swap
+        last_byte = c
+    return key_box
+
+
+def read_header(f):
+    """Parse everything before the audio payload and leave ``f`` positioned at it."""
+    core_cryptor, meta_cryptor = get_ciphers()
+    with metrics.stage('key_box'):
+        header = f.read(8)
+
+        # str to hex
+        assert binascii.b2a_hex(header) == b'4354454e4644414d'
+        f.seek(2, 1)
+        key_length = f.read(4)
+        key_length = struct.unpack('<I', bytes(key_length))[0]
+        key_data = f.read(key_length)
+        key_data_array = bytearray(key_data)
+        for i in range(0, len(key_data_array)):
+            key_data_array[i] ^= 0x64
+        key_data = bytes(key_data_array)
+        key_data = unpad(core_cryptor.decrypt(key_data))[17:]
+        key_box = build_key_box(bytearray(key_data))
+
+    with metrics.stage('meta'):
+        meta_length = f.read(4)
+        meta_length = struct.unpack('<I', bytes(meta_length))[0]
+        meta_data = f.read(meta_length)
+        meta_data_array = bytearray(meta_data)
+        for i in range(0, len(meta_data_array)):
+            meta_data_array[i] ^= 0x63
+        meta_data = bytes(meta_data_array)
+        meta_data = base64.b64decode(meta_data[22:])
+        meta_data = unpad(meta_cryptor.decrypt(meta_data)).decode('utf-8')[6:]
+        meta_data = json.loads(meta_data)
+
+    with metrics.stage('cover_read'):
+        crc32 = f.read(4)
+        crc32 = struct.unpack('<I', bytes(crc32))[0]
+        f.seek(5, 1)
+        image_size = f.read(4)
+        image_size = struct.unpack('<I', bytes(image_size))[0]
+        image_data = f.read(image_size)
+    metrics.add_bytes('cover_read', len(image_data))
+    return NcmHeader(key_box, meta_data, image_data, f.tell())
+
+
+def read_audio_offset(f):
+    """Where the audio payload of ``f`` starts, found by skipping the header sections.
+
+    Unlike ``read_header`` nothing is read beyond the length fields.
+    """
+    if f.read(8) != b'CTENFDAM':
+        raise ValueError('not an NCM file')
+    f.seek(2, 1)
+    for _ in range(2):
+        # Key, then metadata: a length and that many bytes
+        length = struct.unpack('<I', f.read(4))[0]
+        f.seek(length, 1)
+    f.seek(4 + 5, 1)  # crc32 and the gap before the cover
+    image_size = struct.unpack('<I', f.read(4))[0]
+    return f.tell() + image_size
+
+
+def make_keystream(key_box):
+    """One 256-byte period of the audio keystream.
+
+    The keystream byte for payload offset ``i`` depends only on ``(i + 1) & 0xff``,
+    so it repeats every 256 bytes. The period is rotated here so that offset
+    ``i`` uses ``keystream[i & 0xff]``.
+    """
+    stream = bytes(key_box[(key_box[j] + key_box[(key_box[j] + j) & 0xff]) & 0xff] for j in range(256))
+    return stream[1:] + stream[:1]
+
+
+def apply_keystream(buf, offset, keystream):
+    """XOR ``buf`` (payload bytes starting at ``offset``) with the keystream, in place.
+
+    ``buf`` must be writable (bytearray or memoryview). The XOR runs in C
+    and releases the GIL, so several threads can decrypt at once.
+    """
+    from Crypto.Util.strxor import strxor
+
+    k = offset & 0xff
+    n = len(buf)
+    strxor(buf, (keystream * ((k + n) // 256 + 1))[k:k + n], buf)
+
+
+class Checkpoint:
+    """Completed ranges of a large ``.part`` output, saved next to it.
+
+    A range is only recorded after its bytes are fsynced, so after a crash
+    the next run redoes at most the ranges that were in flight. The saved
+    state is ignored if the source file changed in between.
+    """
+
+    def __init__(self, part_filename, source):
+        st = os.stat(source)
+        self.path = part_filename + CHECKPOINT_SUFFIX
+        self.source = {'source': os.path.abspath(source), 'size': st.st_size,
+                       'mtime_ns': st.st_mtime_ns, 'range': RANGE_BYTES}
+        self.lock = threading.Lock()
+        self.done = set()
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            if all(data.get(k) == v for k, v in self.source.items()):
+                self.done = set(data['done'])
+        except (OSError, ValueError, KeyError):
+            pass
 
-def dump_single_file(filepath):
+    def commit(self, *indices):
+        with self.lock:
+            self.done.update(indices)
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(dict(self.source, done=sorted(self.done)), f)
+            os.replace(self.path + '.tmp', self.path)
+
+    def reset(self):
+        self.done.clear()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _fadvise(f, offset, length, advice):
+    """``posix_fadvise`` where the platform has it; a hint, so failures are ignored."""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), offset, length, getattr(os, 'POSIX_FADV_' + advice))
+        except OSError:
+            pass
+
+
+def _settle(path, sync):
+    """fsync ``path`` if asked, then drop its (now clean) pages from the page cache."""
+    with open(path, 'rb' if not sync else 'r+b') as f:
+        if sync:
+            os.fsync(f.fileno())
+        _fadvise(f, 0, 0, 'DONTNEED')
+
+
+def page_cache():
+    """``{'cached': bytes, 'dirty': bytes}`` from /proc/meminfo, or None where there is none."""
+    usage = {}
+    try:
+        with open('/proc/meminfo', encoding='ascii') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in ('Cached', 'Dirty'):
+                    usage[name.lower()] = int(value.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        return None
+    return usage if len(usage) == 2 else None
+
+
+def _decrypt_range(filepath, target_filename, audio_offset, start, end, keystream, progress=None,
+                   sequential=False):
+    """Decrypt payload bytes ``[start, end)`` into the same offsets of the pre-sized target.
+
+    In sequential mode the range is read in SEQUENTIAL_BLOCK_SIZE blocks and
+    pages are dropped behind the cursor, and the caller does the fsync.
+    """
+    read_time = xor_time = write_time = 0.0
+    block = SEQUENTIAL_BLOCK_SIZE if sequential else BLOCK_SIZE
+    buf = bytearray(block)
+    pos = start
+    # Windows before ``dropped`` are gone from the cache; ``flushed`` is
+    # where the newest window whose writeback was started ends
+    dropped = flushed = start
+    with open(filepath, 'rb') as f, open(target_filename, 'r+b') as m:
+        if sequential:
+            _fadvise(f, audio_offset + start, end - start, 'SEQUENTIAL')
+        f.seek(audio_offset + start)
+        m.seek(start)
+        while pos < end:
+            t0 = time.perf_counter()
+            n = f.readinto(memoryview(buf)[:min(block, end - pos)])
+            t1 = time.perf_counter()
+            read_time += t1 - t0
+            if not n:
+                break
+            chunk = memoryview(buf)[:n]
+            apply_keystream(chunk, pos, keystream)
+            t2 = time.perf_counter()
+            m.write(chunk)
+            xor_time += t2 - t1
+            pos += n
+            if sequential and pos - flushed >= WRITEBACK_BYTES:
+                # DONTNEED starts writeback of the newest window and drops
+                # the previous one, which has been written back meanwhile
+                m.flush()
+                _fadvise(m, dropped, pos - dropped, 'DONTNEED')
+                _fadvise(f, audio_offset + dropped, pos - dropped, 'DONTNEED')
+                dropped, flushed = flushed, pos
+            write_time += time.perf_counter() - t2
+            if progress is not None:
+                progress(n)
+        t2 = time.perf_counter()
+        m.flush()
+        if sequential:
+            _fadvise(m, dropped, pos - dropped, 'DONTNEED')
+            _fadvise(f, audio_offset + dropped, pos - dropped, 'DONTNEED')
+        else:
+            # Durable before it is checkpointed or renamed into place
+            os.fsync(m.fileno())
+        write_time += time.perf_counter() - t2
+    return read_time, xor_time, write_time, pos - start
+
+
+def decrypt_audio(filepath, target_filename, header, n_threads=1, progress=None, checkpoint=None,
+                  sequential=False):
+    """Decrypt the audio payload of ``filepath`` into ``target_filename``.
+
+    With ``n_threads > 1`` the payload is split into block-aligned ranges that
+    are decrypted concurrently and written in place into a pre-sized output.
+    ``progress(n)`` is called after every block with the bytes just written
+    (possibly from several threads); an exception raised from it aborts.
+    With a ``Checkpoint`` the ranges are RANGE_BYTES long and the ones it
+    already lists are skipped.
+
+    ``sequential`` is for spinning disks and network shares: one thread
+    reads front to back with large blocks, cache pages of both files are
+    dropped as it goes, and ranges are fsynced (then checkpointed) in
+    batches of SYNC_BYTES rather than one by one.
+    """
+    if sequential:
+        n_threads = 1
+    audio_length = os.path.getsize(filepath) - header.audio_offset
+    keystream = make_keystream(header.key_box)
+    if checkpoint is not None and checkpoint.done:
+        try:
+            if os.path.getsize(target_filename) != audio_length:
+                checkpoint.reset()
+        except OSError:
+            checkpoint.reset()
+    if checkpoint is None or not checkpoint.done:
+        with open(target_filename, 'wb') as m:
+            m.truncate(audio_length)
+
+    if checkpoint is not None:
+        step = RANGE_BYTES
+    elif n_threads > 1:
+        # A few ranges per thread so an uneven disk doesn't leave threads idle
+        step = -(-audio_length // (n_threads * 4))
+        step = max(BLOCK_SIZE, -(-step // BLOCK_SIZE) * BLOCK_SIZE)
+    else:
+        step = max(1, audio_length)
+    ranges = [(start, min(start + step, audio_length)) for start in range(0, audio_length, step)]
+    todo = [i for i in range(len(ranges)) if checkpoint is None or i not in checkpoint.done]
+    if len(todo) < len(ranges):
+        resumed = sum(end - start for i, (start, end) in enumerate(ranges) if i not in todo)
+        log.info(f'Resuming "{filepath}" after {resumed >> 20} MiB')
+        metrics.add_bytes('audio_resumed', resumed)
+        if progress is not None:
+            progress(resumed)
+
+    def run(i):
+        start, end = ranges[i]
+        result = _decrypt_range(filepath, target_filename, header.audio_offset, start, end, keystream, progress)
+        if checkpoint is not None:
+            checkpoint.commit(i)
+        return result
+
+    def run_sequential():
+        results, unsynced = [], []
+        for i in todo:
+            start, end = ranges[i]
+            results.append(_decrypt_range(filepath, target_filename, header.audio_offset, start, end, keystream,
+                                          progress, sequential=True))
+            unsynced.append(i)
+            if i == todo[-1] or sum(ranges[j][1] - ranges[j][0] for j in unsynced) >= SYNC_BYTES:
+                t0 = time.perf_counter()
+                _settle(target_filename, sync=True)
+                results.append((0.0, 0.0, time.perf_counter() - t0, 0))
+                if checkpoint is not None:
+                    checkpoint.commit(*unsynced)
+                unsynced = []
+        _settle(filepath, sync=False)
+        return results
+
+    if sequential:
+        results = run_sequential()
+    elif n_threads > 1 and len(todo) > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            results = list(executor.map(run, todo))
+    else:
+        results = [run(i) for i in todo]
+
+    read_time, xor_time, write_time, n_bytes = (sum(col) for col in zip(*results)) if results else (0, 0, 0, 0)
+    metrics.add_time('audio_read', read_time)
+    metrics.add_time('audio_xor', xor_time)
+    metrics.add_time('audio_write', write_time)
+    metrics.add_bytes('audio', n_bytes)
+
+
+def dump_single_file(filepath, output_dir=None, split_threads=1, split_threshold=SPLIT_THRESHOLD, progress=None,
+                     sequential=False, part_suffix=PART_SUFFIX, owned=None):
+    """Convert one ``.ncm``; returns the output path, or None if it was skipped.
+
+    The output is written to ``<target><part_suffix>`` and renamed into
+    place when complete. ``owned()``, if given, is asked just before that
+    rename; when it returns False the partial output is dropped instead.
+    """
     try:
 
-        filename = filepath.split('/')[-1]
+        filename = os.path.basename(filepath)
         if not filename.endswith('.ncm'): return
         filename = filename[:-4]
+        if output_dir is not None:
+            filename = os.path.join(output_dir, filename)
         for ftype in ['mp3', 'flac']:
             fname = f'{filename}.{ftype}'
             if os.path.isfile(fname):
@@ -51,73 +421,37 @@ def dump_single_file(filepath):
 
         log.info(f'Converting "{filepath}"')
 
-        # hex to str
-        core_key = binascii.a2b_hex('687A4852416D736F356B496E62617857')
-        meta_key = binascii.a2b_hex('2331346C6A6B5F215C5D2630553C2728')
-        unpad = lambda s: s[0:-(s[-1] if isinstance(s[-1], int) else ord(s[-1]))]
-        with open(filepath, 'rb') as f:
-            header = f.read(8)
-            
-            # str to hex
-            assert binascii.b2a_hex(header) == b'4354454e4644414d'
-            f.seek(2, 1)
-            key_length = f.read(4)
-            key_length = struct.unpack('<I', bytes(key_length))[0]
-            key_data = f.read(key_length)
-            key_data_array = bytearray(key_data)
-            for i in range(0, len(key_data_array)):
-                key_data_array[i] ^= 0x64
-            key_data = bytes(key_data_array)
-            cryptor = AES.new(core_key, AES.MODE_ECB)
-            key_data = unpad(cryptor.decrypt(key_data))[17:]
-            key_length = len(key_data)
-            key_data = bytearray(key_data)
-            key_box = bytearray(range(256))
-
-            c = 0
-            last_byte = 0
-            key_offset = 0
-            for i in range(256):
-                swap = key_box[i]
-                c = (swap + last_byte + key_data[key_offset]) & 0xff
-                key_offset += 1
-                if key_offset >= key_length:
-                    key_offset = 0
-                key_box[i] = key_box[c]
-                key_box[c] = swap
-                last_byte = c
-
-            meta_length = f.read(4)
-            meta_length = struct.unpack('<I', bytes(meta_length))[0]
-            meta_data = f.read(meta_length)
-            meta_data_array = bytearray(meta_data)
-            for i in range(0, len(meta_data_array)):
-                meta_data_array[i] ^= 0x63
-            meta_data = bytes(meta_data_array)
-            meta_data = base64.b64decode(meta_data[22:])
-            cryptor = AES.new(meta_key, AES.MODE_ECB)
-            meta_data = unpad(cryptor.decrypt(meta_data)).decode('utf-8')[6:]
-            meta_data = json.loads(meta_data)
-
-            crc32 = f.read(4)
-            crc32 = struct.unpack('<I', bytes(crc32))[0]
-            f.seek(5, 1)
-            image_size = f.read(4)
-            image_size = struct.unpack('<I', bytes(image_size))[0]
-            image_data = f.read(image_size)
-            target_filename = filename + '.' + meta_data['format']
-
-            with open(target_filename, 'wb') as m:
-                chunk = bytearray()
-                while True:
-                    chunk = bytearray(f.read(0x8000))
-                    chunk_length = len(chunk)
-                    if not chunk:
-                        break
-                    for i in range(1, chunk_length + 1):
-                        j = i & 0xff
-                        chunk[i - 1] ^= key_box[(key_box[j] + key_box[(key_box[j] + j) & 0xff]) & 0xff]
-                    m.write(chunk)
+        with metrics.track_file(filepath, kind='decrypt'):
+            with open(filepath, 'rb') as f:
+                header = read_header(f)
+            target_filename = filename + '.' + header.meta_data['format']
+            # Only complete files ever appear under the final name
+            part_filename = target_filename + part_suffix
+
+            large = os.path.getsize(filepath) - header.audio_offset >= split_threshold
+            checkpoint = Checkpoint(part_filename, filepath) if large else None
+
+            def discard():
+                if os.path.exists(part_filename):
+                    os.remove(part_filename)
+                if checkpoint is not None:
+                    checkpoint.remove()
+
+            try:
+                decrypt_audio(filepath, part_filename, header, split_threads if large else 1, progress, checkpoint,
+                              sequential)
+            except Exception:
+                # Failed or cancelled: drop the partial output. An interrupt
+                # (or a crash) leaves it and its checkpoint for the next run.
+                discard()
+                raise
+            if owned is not None and not owned():
+                log.warning(f'No longer responsible for "{filepath}", dropping its output')
+                discard()
+                return
+            os.replace(part_filename, target_filename)
+            if checkpoint is not None:
+                checkpoint.remove()
         log.info(f'Converted file saved at "{target_filename}"')
         return target_filename
 
@@ -126,18 +460,184 @@ def dump_single_file(filepath):
         quit()
 
 
-def list_filepaths(path):
+def _matches(relpath, patterns):
+    name = relpath.rsplit('/', 1)[-1]
+    return any(fnmatch(relpath, pat) or fnmatch(name, pat) for pat in patterns)
+
+
+def iter_files(path, extensions=('.ncm',), include=None, exclude=None, min_size=0, follow_symlinks=True,
+               inodes=None):
+    """Lazily yield ``(filepath, size)`` for files under ``path``.
+
+    Walks with ``os.scandir`` so the extension, pattern and size filters run
+    on directory-entry data before anything else touches the file. Patterns
+    are fnmatch-style and tested against both the name and the path relative
+    to ``path``; ``exclude`` also prunes whole directories. Every directory
+    is walked at most once (tracked by device/inode), which breaks symlink
+    loops and skips links to directories seen elsewhere in the tree. If
+    ``inodes`` is a dict it receives the inode number of every yielded
+    file, taken from the stat the walk already does for the size.
+    """
+    if extensions is not None:
+        extensions = tuple(ext.lower() for ext in extensions)
+
+    def wanted(relpath, entry_name, size):
+        if extensions is not None and not entry_name.lower().endswith(extensions):
+            return False
+        if include and not _matches(relpath, include):
+            return False
+        if exclude and _matches(relpath, exclude):
+            return False
+        return size >= min_size
+
     if os.path.isfile(path):
-        return [path]
-    elif os.path.isdir(path):
-        return [fp for p in glob(f'{path}/*') for fp in list_filepaths(p)]
-    else:
+        st = os.stat(path)
+        if wanted(os.path.basename(path), os.path.basename(path), st.st_size):
+            if inodes is not None:
+                inodes[path] = st.st_ino
+            yield path, st.st_size
+        return
+    if not os.path.isdir(path):
         raise ValueError(f'path not recognized: {path}')
 
+    root_st = os.stat(path)
+    visited = {(root_st.st_dev, root_st.st_ino)}
+    stack = [(path, '')]
+    while stack:
+        directory, reldir = stack.pop()
+        try:
+            entries = sorted(os.scandir(directory), key=lambda e: e.name)
+        except OSError as e:
+            log.warning(f'Cannot list "{directory}": {e}')
+            continue
+        subdirs = []
+        for entry in entries:
+            relpath = f'{reldir}{entry.name}'
+            try:
+                if entry.is_dir(follow_symlinks=follow_symlinks):
+                    if exclude and _matches(relpath, exclude):
+                        continue
+                    # Every directory, not just symlinks: a link to an
+                    # ancestor would otherwise walk that ancestor again
+                    st = entry.stat(follow_symlinks=follow_symlinks)
+                    if (st.st_dev, st.st_ino) in visited:
+                        continue
+                    visited.add((st.st_dev, st.st_ino))
+                    subdirs.append((entry.path, relpath + '/'))
+                elif entry.is_file(follow_symlinks=follow_symlinks):
+                    if extensions is not None and not entry.name.lower().endswith(extensions):
+                        continue
+                    st = entry.stat(follow_symlinks=follow_symlinks)
+                    if wanted(relpath, entry.name, st.st_size):
+                        if inodes is not None:
+                            inodes[entry.path] = st.st_ino
+                        yield entry.path, st.st_size
+            except OSError as e:
+                log.warning(f'Cannot stat "{entry.path}": {e}')
+        # Reverse so subdirectories are visited in name order
+        stack.extend(reversed(subdirs))
+
+
+def list_filepaths(path):
+    return [fp for fp, _ in iter_files(path, extensions=None)]
+
+
+def _largest_first(entries, window):
+    """Reorder a stream of ``(filepath, size)`` largest-first within a sliding window."""
+    heap = []
+    for i, (fp, size) in enumerate(entries):
+        heapq.heappush(heap, (-size, i, fp))
+        if len(heap) >= window:
+            neg_size, _, fp = heapq.heappop(heap)
+            yield fp, -neg_size
+    while heap:
+        neg_size, _, fp = heapq.heappop(heap)
+        yield fp, -neg_size
+
+
+def _inode_order(entries, inodes):
+    """Sort ``(filepath, size)`` by inode number, a cheap stand-in for position on disk.
+
+    ``inodes`` is the dict ``iter_files`` fills while ``entries`` is consumed.
+    """
+    entries = list(entries)  # runs the walk, which fills ``inodes``
+    entries.sort(key=lambda entry: inodes.get(entry[0], 0))
+    return entries
 
-def dump(*paths, output_dir=None, n_workers=None):
+
+def default_split_threads(n_workers):
+    """Threads per large file when ``n_workers`` processes decrypt at once.
+
+    Only used for payloads over SPLIT_THRESHOLD, typically hi-res FLACs.
+    Shares the cores between workers, so a batch of them doesn't run a
+    thread per core in every process.
+    """
+    return max(1, (os.cpu_count() or 1) // max(1, n_workers))
+
+
+def init_worker(profile_dir=None):
+    """Pool initializer: warm the ciphers and start per-worker profiling if asked."""
+    get_ciphers()
+    if profile_dir:
+        profiling.start_worker(profile_dir)
+
+
+def _dump_job(job):
+    filepath, size, output_dir, split_threads, sequential = job
+    target = dump_single_file(filepath, output_dir, split_threads, sequential=sequential)
+    # Hand this worker's measurements to the parent along with the result
+    return filepath, size, target, metrics.drain()
+
+
+def _dump_tuned(jobs, tuner, progress, profile_dir):
+    import queue
+    from multiprocessing import Pool
+
+    outputs = []
+    done = queue.Queue()
+    inflight = 0
+
+    def handle(result, level):
+        nonlocal inflight
+        inflight -= 1
+        if isinstance(result, BaseException):
+            raise result
+        _, size, target, worker_metrics = result
+        metrics.merge(worker_metrics)
+        progress.update(size)
+        if target:
+            outputs.append(target)
+            tuner.record(size, level)
+
+    with Pool(processes=tuner.max_workers, initializer=init_worker, initargs=(profile_dir,)) as p:
+        for job in jobs:
+            # Only as many jobs in flight as the tuner currently allows
+            while inflight >= tuner.level:
+                handle(*done.get())
+            level = tuner.level
+            p.apply_async(_dump_job, (job,), callback=lambda r, level=level: done.put((r, level)),
+                          error_callback=lambda e: done.put((e, None)))
+            inflight += 1
+        while inflight:
+            handle(*done.get())
+        p.close()
+        p.join()
+    return outputs
+
+
+def dump(*paths, output_dir=None, n_workers=None, include=None, exclude=None, window=256, profile=None,
+         split_threads=None, sequential=False, inode_order=False):
+    if n_workers == 'auto':
+        tuner = autotune.WorkerTuner(autotune.max_auto_workers(), path=autotune.tune_path(output_dir or '.'))
+        n_workers = tuner.max_workers
+    else:
+        tuner = None
     if n_workers is None:
-        n_workers = 1
+        n_workers = os.cpu_count() or 1
+        if all(os.path.isfile(p) for p in paths):
+            n_workers = min(n_workers, len(paths))
+    if split_threads is None:
+        split_threads = default_split_threads(n_workers)
     header = dedent(r'''
                    _  _  ___ __  __ ___  _   _ __  __ ___
          _ __ _  _| \| |/ __|  \/  |   \| | | |  \/  | _ \
@@ -150,15 +650,64 @@ def dump(*paths, output_dir=None, n_workers=None):
     for line in header.split('\n'):
         log.info(line)
 
-    all_filepaths = [fp for p in paths for fp in list_filepaths(p)]
-    if n_workers > 1:
-        log.info(f'Running pyNCMDUMP with up to {n_workers} parallel workers')
-        with Pool(processes=n_workers) as p:
-            list(p.map(dump_single_file, all_filepaths))
-    else:
-        log.info('Running pyNCMDUMP on single-worker mode')
-        for fp in tqdm(all_filepaths, leave=False): dump_single_file(fp)
+    from tqdm.auto import tqdm
+    from multiprocessing import Pool
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    progress = tqdm(total=0, unit='B', unit_scale=True, unit_divisor=1024, leave=False)
+
+    inodes = {} if inode_order else None
+
+    def discovered():
+        for p in paths:
+            for fp, size in iter_files(p, include=include, exclude=exclude, inodes=inodes):
+                progress.total += size
+                progress.refresh()
+                yield fp, size
+
+    # Files stream in as the walk goes; within each window of pending files
+    # the largest go first so a few huge FLACs don't end up alone at the tail
+    # With inode_order the whole tree is listed first and converted in
+    # roughly on-disk order instead, so a spinning disk seeks less
+    ordered = _inode_order(discovered(), inodes) if inode_order else _largest_first(discovered(), window)
+    jobs = ((fp, size, output_dir, split_threads, sequential) for fp, size in ordered)
+
+    outputs = []
+    cache_before = page_cache()
+    started = time.perf_counter()
+    with progress, profiling.profile_run(profiling.profile_root(profile)) as profile_dir:
+        if tuner is not None:
+            log.info(f'Running pyNCMDUMP with {tuner.level} workers, tuned between 1 and {n_workers}')
+            outputs = _dump_tuned(jobs, tuner, progress, profile_dir)
+            tuner.save()
+        elif n_workers > 1:
+            log.info(f'Running pyNCMDUMP with up to {n_workers} parallel workers')
+            with Pool(processes=n_workers, initializer=init_worker, initargs=(profile_dir,)) as p:
+                # chunksize=1 keeps the size ordering and hands out work as workers free up
+                for _, size, target, worker_metrics in p.imap_unordered(_dump_job, jobs, chunksize=1):
+                    metrics.merge(worker_metrics)
+                    progress.update(size)
+                    if target: outputs.append(target)
+                # Let workers exit normally (rather than terminate) so their exit hooks run
+                p.close()
+                p.join()
+        else:
+            log.info('Running pyNCMDUMP on single-worker mode')
+            for filepath, size, *_ in jobs:
+                target = dump_single_file(filepath, output_dir, split_threads, sequential=sequential)
+                progress.update(size)
+                if target: outputs.append(target)
+    elapsed = time.perf_counter() - started
+    log.info(f'Converted {progress.n / 2**20:.1f} MiB in {elapsed:.1f}s '
+             f'({progress.n / 2**20 / elapsed if elapsed else 0:.1f} MiB/s)')
+    cache_after = page_cache()
+    if cache_before and cache_after:
+        log.info(f'Page cache grew by {(cache_after["cached"] - cache_before["cached"]) / 2**20:.1f} MiB, '
+                 f'{cache_after["dirty"] / 2**20:.1f} MiB dirty')
     log.info('All finished')
+    return outputs
 
 
 if __name__ == '__main__':
@@ -175,9 +724,67 @@ if __name__ == '__main__':
     parser.add_argument(
         '-w', '--workers',
         metavar='',
+        type=lambda value: value if value == 'auto' else int(value),
+        help='parallel convertion when set to more than 1 workers, or "auto" to tune it from measured '
+             'throughput (default: CPU count)',
+        default=None
+    )
+    parser.add_argument(
+        '-i', '--include',
+        metavar='',
+        type=str,
+        action='append',
+        help='only convert files matching this glob pattern (repeatable)'
+    )
+    parser.add_argument(
+        '-x', '--exclude',
+        metavar='',
+        type=str,
+        action='append',
+        help='skip files and directories matching this glob pattern (repeatable)'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        metavar='',
+        type=str,
+        help='directory for converted files (default: current directory)',
+        default=None
+    )
+    parser.add_argument(
+        '--split-threads',
+        metavar='',
         type=int,
-        help=f'parallel convertion when set to more than 1 workers (default: 1)',
-        default=1
+        help=f'threads per file for payloads over {SPLIT_THRESHOLD >> 20} MiB (default: CPU count / workers)',
+        default=None
+    )
+    parser.add_argument(
+        '--sequential',
+        action='store_true',
+        help='sequential I/O for spinning disks and network shares: large reads, no page cache left behind, '
+             'batched fsync'
+    )
+    parser.add_argument(
+        '--inode-order',
+        action='store_true',
+        help='list the whole tree first and convert in inode (roughly on-disk) order'
+    )
+    parser.add_argument(
+        '--metrics-out',
+        metavar='',
+        type=str,
+        help='write per-stage metrics to this file (.prom for Prometheus text, JSON otherwise)',
+        default=None
+    )
+    parser.add_argument(
+        '--profile',
+        metavar='',
+        type=str,
+        help=f'write cProfile/tracemalloc results for every process here (or set {profiling.ENV_VAR})',
+        default=None
     )
     args = parser.parse_args()
-    dump(*args.paths, n_workers=args.workers)
\ No newline at end of file
+    dump(*args.paths, output_dir=args.output, n_workers=args.workers, include=args.include, exclude=args.exclude,
+         profile=args.profile, split_threads=args.split_threads, sequential=args.sequential,
+         inode_order=args.inode_order)
+    if args.metrics_out:
+        metrics.dump(args.metrics_out)
\ No newline at end of file
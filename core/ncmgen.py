@@ -0,0 +1,134 @@
+"""Synthetic ``.ncm`` files for benchmarks and fixtures.
+
+This is the inverse of ``ncmdump.dump_single_file``: it wraps a playable
+payload (silent MPEG frames or a minimal FLAC stream) in the NCM container
+with an encrypted key block, AES-encrypted metadata and an optional cover::
+
+    python -m core.ncmgen corpus/ --count 50 --size 8M --format flac
+"""
+import os
+import json
+import base64
+import random
+import struct
+import zlib
+
+from core import ncmdump
+
+# One MPEG-1 Layer III frame header: 128 kbps, 44.1 kHz, stereo, no CRC.
+# Frame length is 144 * 128000 / 44100 = 417 bytes.
+MP3_FRAME = b'\xff\xfb\x90\x64' + bytes(413)
+MP3_FRAME_SECONDS = 1152 / 44100
+FLAC_SAMPLE_RATE = 44100
+
+
+def _pad(data):
+    n = 16 - len(data) % 16
+    return data + bytes([n]) * n
+
+
+def make_mp3_payload(size):
+    """Silent CBR MP3 of roughly ``size`` bytes."""
+    return MP3_FRAME * max(1, size // len(MP3_FRAME))
+
+
+def make_flac_payload(size):
+    """``fLaC`` stream with a valid STREAMINFO and filler frames of ``size`` bytes."""
+    seconds = max(1, size // 100000)
+    streaminfo = bytearray(34)
+    struct.pack_into('>HH', streaminfo, 0, 4096, 4096)
+    # 20-bit sample rate, 3-bit channels-1, 5-bit bps-1, 36-bit total samples
+    packed = (FLAC_SAMPLE_RATE << 44) | (1 << 41) | (15 << 36) | (seconds * FLAC_SAMPLE_RATE)
+    streaminfo[10:18] = packed.to_bytes(8, 'big')
+    block_header = bytes([0x80]) + len(streaminfo).to_bytes(3, 'big')
+    head = b'fLaC' + block_header + bytes(streaminfo)
+    return head + bytes(max(0, size - len(head)))
+
+
+def make_cover(size):
+    """Bytes that start like a JPEG; only the size matters to the pipeline."""
+    if not size:
+        return b''
+    return b'\xff\xd8\xff\xe0' + os.urandom(max(0, size - 6)) + b'\xff\xd9'
+
+
+def build_ncm(audio, meta, cover=b'', key=None):
+    """Return the bytes of an ``.ncm`` container holding ``audio``."""
+    core_cryptor, meta_cryptor = ncmdump.get_ciphers()
+    key = key or os.urandom(16).hex().encode()
+
+    key_block = bytearray(core_cryptor.encrypt(_pad(b'neteasecloudmusic' + key)))
+    for i in range(len(key_block)):
+        key_block[i] ^= 0x64
+
+    meta_plain = b'music:' + json.dumps(meta, ensure_ascii=False).encode('utf-8')
+    meta_block = bytearray(b"163 key(Don't modify):" + base64.b64encode(meta_cryptor.encrypt(_pad(meta_plain))))
+    for i in range(len(meta_block)):
+        meta_block[i] ^= 0x63
+
+    # The audio cipher is a plain XOR stream, so encrypting is the same operation
+    encrypted = bytearray(audio)
+    ncmdump.apply_keystream(encrypted, 0, ncmdump.make_keystream(ncmdump.build_key_box(bytearray(key))))
+
+    return b''.join([
+        ncmdump.MAGIC, b'\x01\x00',
+        struct.pack('<I', len(key_block)), bytes(key_block),
+        struct.pack('<I', len(meta_block)), bytes(meta_block),
+        struct.pack('<I', zlib.crc32(cover)), bytes(5),
+        struct.pack('<I', len(cover)), cover,
+        encrypted,
+    ])
+
+
+def write_ncm(path, size=1 << 20, fmt='mp3', title=None, artist=None, cover_size=0):
+    """Write one synthetic ``.ncm`` at ``path`` with an audio payload of about ``size`` bytes."""
+    payload = make_mp3_payload(size) if fmt == 'mp3' else make_flac_payload(size)
+    name = os.path.basename(path).rsplit('.', 1)[0]
+    meta = {
+        'musicName': title or name,
+        'artist': [[artist or 'Synthetic', 0]],
+        'album': 'Synthetic Corpus',
+        'format': fmt,
+        'bitrate': 128000,
+    }
+    with open(path, 'wb') as f:
+        f.write(build_ncm(payload, meta, make_cover(cover_size)))
+    return path
+
+
+def make_corpus(directory, count=10, size=1 << 20, fmt='mp3', cover_size=0, jitter=0.0, seed=0):
+    """Write ``count`` files into ``directory``; ``jitter`` varies sizes by up to that fraction."""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        file_size = int(size * (1 + rng.uniform(-jitter, jitter)))
+        path = os.path.join(directory, f'Synthetic Artist {i % 7} - Track {i:05d}.ncm')
+        paths.append(write_ncm(path, file_size, fmt, title=f'Track {i:05d}',
+                               artist=f'Synthetic Artist {i % 7}', cover_size=cover_size))
+    return paths
+
+
+def parse_size(text):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    text = text.strip().upper()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='generate synthetic .ncm files')
+    parser.add_argument('directory', type=str, help='output directory')
+    parser.add_argument('-n', '--count', metavar='', type=int, default=10, help='number of files (default: 10)')
+    parser.add_argument('-s', '--size', metavar='', type=parse_size, default='1M',
+                        help='approximate audio size per file, e.g. 512K, 8M (default: 1M)')
+    parser.add_argument('-f', '--format', metavar='', choices=['mp3', 'flac'], default='mp3',
+                        help='payload format: mp3 or flac (default: mp3)')
+    parser.add_argument('--cover', metavar='', type=parse_size, default='0', help='embedded cover size (default: none)')
+    parser.add_argument('--jitter', metavar='', type=float, default=0.0, help='relative size variation (default: 0)')
+    args = parser.parse_args()
+    for path in make_corpus(args.directory, args.count, args.size, args.format, args.cover, args.jitter):
+        print(path)
@@ -0,0 +1,194 @@
+import random
+from collections import deque
+
+
+class PlaybackQueue:
+    """Play order over playlist indices.
+
+    The queue keeps a permutation of ``range(size)`` and a cursor into it.
+    In sequential mode the permutation is the identity; in shuffle mode it
+    is a Fisher-Yates shuffle, so a full cycle visits every song exactly
+    once. ``pos`` is the inverse permutation, which makes jumps O(1).
+
+    Back/forward history records what was actually played (including
+    manual picks) so ``prev``/``next`` retrace it before moving on.
+    """
+
+    def __init__(self, size=0, shuffle=False, history_size=500, rng=None):
+        self.rng = rng or random.Random()
+        self.shuffle = shuffle
+        self.order = list(range(size))
+        self.pos = list(range(size))
+        self.cursor = -1
+        self.back = deque(maxlen=history_size)
+        self.forward = []
+        if shuffle:
+            self._reshuffle()
+
+    def __len__(self):
+        return len(self.order)
+
+    @property
+    def current(self):
+        if 0 <= self.cursor < len(self.order):
+            return self.order[self.cursor]
+        return -1
+
+    # --- permutation helpers ---
+
+    def _swap(self, i, j):
+        order, pos = self.order, self.pos
+        order[i], order[j] = order[j], order[i]
+        pos[order[i]] = i
+        pos[order[j]] = j
+
+    def _reshuffle(self, first=None, avoid=None):
+        """Start a new cycle, optionally pinning ``first`` to position 0."""
+        self.rng.shuffle(self.order)
+        for i, index in enumerate(self.order):
+            self.pos[index] = i
+        if first is not None:
+            self._swap(0, self.pos[first])
+        elif avoid is not None and len(self.order) > 1 and self.order[0] == avoid:
+            # Don't play the same song twice across a cycle boundary
+            self._swap(0, self.rng.randrange(1, len(self.order)))
+
+    def _move_to_cursor(self, index):
+        """Make ``index`` current without breaking the no-repeat guarantee."""
+        p = self.pos[index]
+        if not self.shuffle:
+            self.cursor = p
+        elif p > self.cursor:
+            # Unplayed: pull it forward to the next slot
+            self.cursor += 1
+            self._swap(self.cursor, p)
+        elif p < self.cursor:
+            # Already played this cycle: trade places with the current song
+            self._swap(self.cursor, p)
+
+    def _push_history(self):
+        if self.cursor >= 0:
+            self.back.append(self.current)
+
+    # --- navigation ---
+
+    def jump(self, index):
+        """Play ``index`` now (user picked it from the list)."""
+        if not 0 <= index < len(self.order):
+            return -1
+        if index != self.current:
+            self._push_history()
+            self.forward.clear()
+        self._move_to_cursor(index)
+        return index
+
+    def next(self):
+        if not self.order:
+            return -1
+        self._push_history()
+        if self.forward:
+            index = self.forward.pop()
+            self._move_to_cursor(index)
+            return index
+
+        if self.cursor + 1 < len(self.order):
+            self.cursor += 1
+        else:
+            if self.shuffle:
+                self._reshuffle(avoid=self.current)
+            self.cursor = 0
+        return self.current
+
+    def prev(self):
+        if not self.order:
+            return -1
+        if self.back:
+            index = self.back.pop()
+            if self.cursor >= 0:
+                self.forward.append(self.current)
+            self._move_to_cursor(index)
+            return index
+
+        # No history yet: step backwards through the play order
+        self.cursor = (self.cursor - 1) % len(self.order)
+        return self.current
+
+    def set_shuffle(self, shuffle):
+        if shuffle == self.shuffle:
+            return
+        self.shuffle = shuffle
+        current = self.current
+        if shuffle:
+            self._reshuffle(first=current if current >= 0 else None)
+            self.cursor = 0 if current >= 0 else -1
+        else:
+            self.order = list(range(len(self.order)))
+            self.pos = list(range(len(self.order)))
+            self.cursor = current
+
+    # --- playlist updates ---
+
+    def append(self, count=1):
+        """Register ``count`` songs appended to the end of the playlist."""
+        for _ in range(count):
+            index = len(self.order)
+            self.order.append(index)
+            self.pos.append(index)
+            if self.shuffle:
+                # Drop the new song somewhere in the unplayed part of the cycle
+                self._swap(index, self.rng.randint(self.cursor + 1, index))
+
+    def remove(self, index):
+        """Register removal of playlist row ``index``.
+
+        Rows after ``index`` shift down by one, so this is a single linear
+        pass; it does not reshuffle or reset the cycle.
+        """
+        if not 0 <= index < len(self.order):
+            return
+        p = self.pos[index]
+        del self.order[p]
+        if p <= self.cursor:
+            self.cursor -= 1
+
+        renumber = lambda i: i - 1 if i > index else i
+        self.order = [renumber(i) for i in self.order]
+        self.pos = [0] * len(self.order)
+        for i, j in enumerate(self.order):
+            self.pos[j] = i
+        self.back = deque((renumber(i) for i in self.back if i != index), maxlen=self.back.maxlen)
+        self.forward = [renumber(i) for i in self.forward if i != index]
+
+    # --- persistence ---
+
+    def state(self):
+        return {
+            'shuffle': self.shuffle,
+            'order': list(self.order),
+            'cursor': self.cursor,
+            'back': list(self.back),
+            'forward': list(self.forward),
+        }
+
+    @classmethod
+    def from_state(cls, state, size, history_size=500, rng=None):
+        """Rebuild a queue saved with ``state()``, or a fresh one if it doesn't fit ``size``."""
+        queue = cls(size, shuffle=bool(state.get('shuffle')), history_size=history_size, rng=rng)
+        order = state.get('order') or []
+        if sorted(order) != list(range(size)):
+            return queue
+        queue.order = list(order)
+        for i, index in enumerate(order):
+            queue.pos[index] = i
+        cursor = state.get('cursor', -1)
+        queue.cursor = cursor if -1 <= cursor < size else -1
+        queue.back.extend(i for i in state.get('back') or [] if 0 <= i < size)
+        queue.forward = [i for i in state.get('forward') or [] if 0 <= i < size]
+        return queue
+
+    def clear(self):
+        self.order.clear()
+        self.pos.clear()
+        self.cursor = -1
+        self.back.clear()
+        self.forward.clear()
@@ -0,0 +1,122 @@
+"""Opt-in cProfile + tracemalloc for batch conversions.
+
+Enabled with ``--profile DIR`` on the ``ncmdump``/``core.batch`` CLIs or
+with the ``NCMDUMP_PROFILE=DIR`` environment variable (which also covers
+imports started from the GUI). Each run gets its own directory under
+``DIR`` holding one ``.prof`` and one ``.mem`` snapshot per process,
+a ``merged.prof`` and a top-N ``summary.txt``::
+
+    NCMDUMP_PROFILE=profiles python -m core.batch ~/ncm -o out
+    python -m pstats profiles/run-20240101-120000-1234/merged.prof
+"""
+import io
+import os
+import glob
+import time
+import pstats
+import logging
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+
+ENV_VAR = 'NCMDUMP_PROFILE'
+
+log = logging.getLogger(__name__)
+
+
+def profile_root(value=None):
+    """The profiling directory from the CLI flag or the environment, or None."""
+    return value or os.environ.get(ENV_VAR) or None
+
+
+class ProcessProfiler:
+    """Profiles the current process and writes its results into ``run_dir``."""
+
+    def __init__(self, run_dir, label):
+        self.run_dir = run_dir
+        self.label = label
+        self.profiler = cProfile.Profile()
+        self.stopped = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+        else:
+            # Forked workers inherit the parent's traces; only keep our own
+            tracemalloc.clear_traces()
+        self.profiler.enable()
+        return self
+
+    def stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.profiler.disable()
+        stem = os.path.join(self.run_dir, f'{self.label}-{os.getpid()}')
+        # Snapshot first so the profiler's own dump doesn't show up in it
+        tracemalloc.take_snapshot().dump(stem + '.mem')
+        tracemalloc.stop()
+        self.profiler.dump_stats(stem + '.prof')
+
+
+def start_worker(run_dir):
+    """Pool initializer hook: profile this worker until it exits cleanly."""
+    from multiprocessing import util
+
+    profiler = ProcessProfiler(run_dir, 'worker').start()
+    # Runs from multiprocessing's exit handler when the worker shuts down
+    util.Finalize(profiler, profiler.stop, exitpriority=100)
+
+
+def summarize(run_dir, top=30):
+    """Merge every process's results in ``run_dir`` and write ``summary.txt``."""
+    prof_files = sorted(glob.glob(os.path.join(run_dir, '*-*.prof')))
+    mem_files = sorted(glob.glob(os.path.join(run_dir, '*-*.mem')))
+    out = io.StringIO()
+    out.write(f'{len(prof_files)} process profile(s), {len(mem_files)} memory snapshot(s)\n\n')
+
+    if prof_files:
+        stats = pstats.Stats(*prof_files, stream=out)
+        stats.dump_stats(os.path.join(run_dir, 'merged.prof'))
+        stats.strip_dirs()
+        out.write(f'=== Top {top} by cumulative time ===\n')
+        stats.sort_stats('cumulative').print_stats(top)
+        out.write(f'=== Top {top} by own time ===\n')
+        stats.sort_stats('tottime').print_stats(top)
+
+    if mem_files:
+        totals = {}
+        for path in mem_files:
+            for stat in tracemalloc.Snapshot.load(path).statistics('lineno'):
+                frame = stat.traceback[0]
+                key = f'{frame.filename}:{frame.lineno}'
+                size, count = totals.get(key, (0, 0))
+                totals[key] = (size + stat.size, count + stat.count)
+        out.write(f'=== Top {top} live allocations at exit, all processes ===\n')
+        for key, (size, count) in sorted(totals.items(), key=lambda kv: -kv[1][0])[:top]:
+            out.write(f'{size / 1024:10.1f} KiB {count:8d} blocks  {key}\n')
+
+    summary_path = os.path.join(run_dir, 'summary.txt')
+    with open(summary_path, 'w', encoding='utf-8') as f:
+        f.write(out.getvalue())
+    return summary_path
+
+
+@contextmanager
+def profile_run(root, top=30):
+    """Profile the calling process for the duration of the block.
+
+    Yields the run directory (or None when ``root`` is falsy) so callers can
+    pass it to their pool initializers via ``start_worker``.
+    """
+    if not root:
+        yield None
+        return
+    run_dir = os.path.join(root, time.strftime('run-%Y%m%d-%H%M%S') + f'-{os.getpid()}')
+    os.makedirs(run_dir, exist_ok=True)
+    profiler = ProcessProfiler(run_dir, 'main').start()
+    try:
+        yield run_dir
+    finally:
+        profiler.stop()
+        log.info(f'Profile summary written to "{summarize(run_dir, top)}"')
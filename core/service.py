@@ -0,0 +1,379 @@
+"""Long-running conversion service with a small local HTTP API.
+
+Keeps a warm decrypt process pool and tagging threads so jobs don't pay
+interpreter and import start-up, and serves them over TCP on localhost or
+a Unix socket::
+
+    python -m core.service --port 8765
+    curl -s -X POST localhost:8765/jobs -H 'X-Client: alice' \\
+         -d '{"paths": ["/music/ncm"], "output_dir": "alice"}'
+    curl -sN localhost:8765/jobs/1/events
+
+Endpoints (JSON bodies and responses; events are JSON lines):
+
+    POST   /jobs              {"paths": [...], "output_dir"?: str, "tag"?: bool}
+    GET    /jobs              all jobs of the calling client
+    GET    /jobs/<id>         status and results
+    GET    /jobs/<id>/events  progress events, streamed until the job ends
+    DELETE /jobs/<id>         cancel files that haven't started
+    GET    /health, /metrics  liveness, Prometheus text
+
+A job's ``output_dir`` is a relative path under the service's ``--output``
+directory; jobs without one write straight into it. Clients are told
+apart by the ``X-Client`` header. Each client gets at most
+``client_limit`` files in flight and ``max_jobs`` unfinished jobs, so one
+large import can't starve everybody else.
+"""
+import os
+import json
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from core import ncmdump, covers
+from core.batch import _convert
+from core.metadata import update_and_embed_metadata
+from core.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+KEEP_FINISHED_JOBS = 1000
+MAX_BODY_BYTES = 1 << 20
+STATUS_TEXT = {200: 'OK', 202: 'Accepted', 206: 'Partial Content', 400: 'Bad Request', 404: 'Not Found',
+               405: 'Method Not Allowed', 413: 'Payload Too Large', 416: 'Range Not Satisfiable',
+               429: 'Too Many Requests', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Job:
+    def __init__(self, job_id, client, paths, output_dir, tag):
+        self.id = job_id
+        self.client = client
+        self.paths = paths
+        self.output_dir = output_dir
+        self.tag = tag
+        self.state = 'queued'
+        self.cancelled = False
+        self.files = 0
+        self.results = {}
+        self.errors = {}
+        self.events = []
+        self.changed = asyncio.Condition()
+
+    @property
+    def finished(self):
+        return self.state in ('done', 'cancelled')
+
+    async def emit(self, event, **fields):
+        fields['event'] = event
+        fields['job'] = self.id
+        self.events.append(fields)
+        async with self.changed:
+            self.changed.notify_all()
+
+    def to_dict(self):
+        return {'id': self.id, 'client': self.client, 'state': self.state, 'paths': self.paths,
+                'output_dir': self.output_dir, 'files': self.files, 'results': self.results,
+                'errors': self.errors}
+
+
+async def read_request(reader):
+    """Read one request; returns ``(method, path, headers, body)`` with lower-case header names."""
+    try:
+        request_line = (await reader.readline()).decode('latin-1').strip()
+        if not request_line and reader.at_eof():
+            # Closed before sending (another) request
+            raise asyncio.IncompleteReadError(b'', None)
+        method, path, _ = request_line.split(' ', 2)
+    except ValueError:
+        raise HttpError(400, 'malformed request line')
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1')
+        if line in ('\r\n', '\n', ''):
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get('content-length') or 0)
+        if length < 0:
+            raise ValueError(length)
+    except ValueError:
+        raise HttpError(400, 'malformed Content-Length')
+    if length > MAX_BODY_BYTES:
+        raise HttpError(413, 'request body too large')
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), path.split('?', 1)[0], headers, body
+
+
+def _warm_imports():
+    # Tagging runs in this process; pay for its imports once, at start-up
+    try:
+        import requests, mutagen.id3, pyncm.apis  # noqa: F401
+    except ImportError as e:
+        log.warning(f'Tagging unavailable: {e}')
+
+
+class ConversionService:
+    def __init__(self, workers=None, tag_workers=4, client_limit=2, max_jobs=16,
+                 output_dir='output', split_threads=1):
+        self.workers = workers or os.cpu_count() or 1
+        self.tag_workers = tag_workers
+        self.client_limit = client_limit
+        self.max_jobs = max_jobs
+        self.output_dir = output_dir
+        self.split_threads = split_threads
+        self.jobs = OrderedDict()
+        self.ids = itertools.count(1)
+        self.client_slots = {}
+        self.decrypt_pool = None
+        self.tag_pool = None
+        self.server = None
+
+    # --- lifecycle ---
+
+    async def start(self, host='127.0.0.1', port=8765, unix_path=None):
+        loop = asyncio.get_running_loop()
+        self.decrypt_pool = ProcessPoolExecutor(max_workers=self.workers, initializer=ncmdump.init_worker)
+        self.tag_pool = ThreadPoolExecutor(max_workers=max(1, self.tag_workers))
+        # Spawn every worker now rather than on the first job
+        await asyncio.gather(*(loop.run_in_executor(self.decrypt_pool, os.getpid) for _ in range(self.workers)))
+        await loop.run_in_executor(self.tag_pool, _warm_imports)
+        # One cover store for every job, all of which write under output_dir
+        covers.use_directory(os.path.join(self.output_dir, 'covers'))
+
+        if unix_path:
+            if os.path.exists(unix_path):
+                os.remove(unix_path)
+            self.server = await asyncio.start_unix_server(self.handle_connection, path=unix_path)
+            log.info(f'Listening on unix:{unix_path} with {self.workers} workers')
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host, port)
+            port = self.server.sockets[0].getsockname()[1]
+            log.info(f'Listening on http://{host}:{port} with {self.workers} workers')
+        return self.server
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for job in self.jobs.values():
+            job.cancelled = True
+        if self.tag_pool is not None:
+            self.tag_pool.shutdown(wait=True)
+        if self.decrypt_pool is not None:
+            self.decrypt_pool.shutdown(wait=True)
+
+    # --- jobs ---
+
+    def submit(self, client, body):
+        paths = body.get('paths')
+        if not isinstance(paths, list) or not paths or not all(isinstance(p, str) for p in paths):
+            raise HttpError(400, '"paths" must be a non-empty list of strings')
+        active = sum(1 for j in self.jobs.values() if j.client == client and not j.finished)
+        if active >= self.max_jobs:
+            raise HttpError(429, f'client "{client}" already has {active} unfinished jobs')
+
+        tag = body.get('tag', True)
+        if not isinstance(tag, bool):
+            raise HttpError(400, '"tag" must be true or false')
+        output_dir = self.resolve_output(body.get('output_dir'))
+        job = Job(next(self.ids), client, paths, output_dir, tag)
+        self.jobs[job.id] = job
+        while len(self.jobs) > KEEP_FINISHED_JOBS:
+            oldest = next(iter(self.jobs.values()))
+            if not oldest.finished:
+                break
+            self.jobs.popitem(last=False)
+        asyncio.get_running_loop().create_task(self.run_job(job))
+        return job
+
+    def resolve_output(self, output_dir):
+        """Where a job asking for ``output_dir`` writes; never outside the service's output directory."""
+        if output_dir is None or output_dir == '':
+            return self.output_dir
+        if not isinstance(output_dir, str):
+            raise HttpError(400, '"output_dir" must be a string')
+        if os.path.isabs(output_dir) or '..' in output_dir.replace('\\', '/').split('/'):
+            raise HttpError(400, '"output_dir" must be a relative path without ".."')
+        root = os.path.realpath(self.output_dir)
+        resolved = os.path.realpath(os.path.join(root, output_dir))
+        if os.path.commonpath([root, resolved]) != root:
+            # A symlink inside the output directory pointing elsewhere
+            raise HttpError(400, '"output_dir" must stay inside the output directory')
+        return os.path.join(self.output_dir, output_dir)
+
+    def _slots(self, client):
+        slots = self.client_slots.get(client)
+        if slots is None:
+            slots = self.client_slots[client] = asyncio.Semaphore(self.client_limit)
+        return slots
+
+    async def run_job(self, job):
+        loop = asyncio.get_running_loop()
+        job.state = 'running'
+        await job.emit('start', paths=job.paths, output_dir=job.output_dir)
+        os.makedirs(job.output_dir, exist_ok=True)
+
+        def walk():
+            return [item for p in job.paths for item in ncmdump.iter_files(p)]
+
+        try:
+            files = await loop.run_in_executor(self.tag_pool, walk)
+        except (OSError, ValueError) as e:
+            job.errors['paths'] = str(e)
+            files = []
+        job.files = len(files)
+
+        slots = self._slots(job.client)
+        await asyncio.gather(*(self.run_file(job, fp, slots) for fp, _ in files))
+        job.state = 'cancelled' if job.cancelled else 'done'
+        await job.emit('summary', files=job.files, converted=len(job.results), errors=len(job.errors),
+                       state=job.state)
+
+    async def run_file(self, job, filepath, slots):
+        loop = asyncio.get_running_loop()
+        async with slots:
+            if job.cancelled:
+                await job.emit('skip', path=filepath, reason='cancelled')
+                return
+            try:
+                target, worker_metrics = await loop.run_in_executor(
+                    self.decrypt_pool, _convert, filepath, job.output_dir, self.split_threads)
+                metrics.merge(worker_metrics)
+                if not target:
+                    await job.emit('skip', stage='decrypt', path=filepath, reason='exists')
+                    return
+                await job.emit('progress', stage='decrypt', path=filepath, output=target)
+                if job.tag and target.endswith('.mp3'):
+                    await loop.run_in_executor(self.tag_pool, update_and_embed_metadata, target, '', '')
+                    await job.emit('progress', stage='tag', path=filepath, output=target)
+                job.results[filepath] = target
+            except Exception as e:
+                job.errors[filepath] = f'{type(e).__name__}: {e}'
+                await job.emit('error', path=filepath, error=job.errors[filepath])
+
+    def cancel(self, job):
+        job.cancelled = True
+
+    # --- HTTP ---
+
+    async def handle_connection(self, reader, writer):
+        try:
+            method, path, headers, body = await read_request(reader)
+            await self.dispatch(method, path, headers, body, writer)
+        except HttpError as e:
+            await self.respond(writer, e.status, {'error': str(e)})
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            log.exception('Request failed')
+            await self.respond(writer, 500, {'error': f'{type(e).__name__}: {e}'})
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, path, headers, body, writer):
+        client = headers.get('x-client') or 'anonymous'
+        parts = [p for p in path.split('/') if p]
+
+        if parts == ['health']:
+            return await self.respond(writer, 200, {'status': 'ok', 'workers': self.workers, 'jobs': len(self.jobs)})
+        if parts == ['metrics']:
+            return await self.respond(writer, 200, metrics.to_prometheus(), 'text/plain; version=0.0.4')
+        if parts == ['jobs']:
+            if method == 'GET':
+                return await self.respond(writer, 200, [j.to_dict() for j in self.jobs.values() if j.client == client])
+            if method != 'POST':
+                raise HttpError(405, 'use GET or POST')
+            try:
+                data = json.loads(body or b'{}')
+            except ValueError:
+                raise HttpError(400, 'body is not JSON')
+            if not isinstance(data, dict):
+                raise HttpError(400, 'body must be a JSON object')
+            job = self.submit(client, data)
+            return await self.respond(writer, 202, job.to_dict())
+
+        if len(parts) in (2, 3) and parts[0] == 'jobs' and parts[1].isdigit():
+            job = self.jobs.get(int(parts[1]))
+            if job is None or job.client != client:
+                raise HttpError(404, 'no such job')
+            if len(parts) == 3 and parts[2] == 'events' and method == 'GET':
+                return await self.stream_events(job, writer)
+            if len(parts) == 2 and method == 'GET':
+                return await self.respond(writer, 200, job.to_dict())
+            if len(parts) == 2 and method == 'DELETE':
+                self.cancel(job)
+                return await self.respond(writer, 200, job.to_dict())
+        raise HttpError(404, 'not found')
+
+    async def respond(self, writer, status, payload, content_type='application/json'):
+        if not isinstance(payload, str):
+            payload = json.dumps(payload, ensure_ascii=False)
+        data = payload.encode('utf-8')
+        writer.write(f'HTTP/1.1 {status} {STATUS_TEXT.get(status, "Error")}\r\n'
+                     f'Content-Type: {content_type}\r\nContent-Length: {len(data)}\r\n'
+                     'Connection: close\r\n\r\n'.encode('latin-1') + data)
+        await writer.drain()
+
+    async def stream_events(self, job, writer):
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n'
+                     b'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n')
+        sent = 0
+        while True:
+            while sent < len(job.events):
+                line = (json.dumps(job.events[sent], ensure_ascii=False) + '\n').encode('utf-8')
+                writer.write(f'{len(line):x}\r\n'.encode('latin-1') + line + b'\r\n')
+                sent += 1
+            await writer.drain()
+            if job.finished and sent == len(job.events):
+                break
+            async with job.changed:
+                await job.changed.wait_for(lambda: len(job.events) > sent or job.finished)
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+
+async def serve(host='127.0.0.1', port=8765, unix_path=None, **kwargs):
+    import signal
+
+    service = ConversionService(**kwargs)
+    await service.start(host, port, unix_path)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    await service.close()
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    log.setLevel(logging.INFO)
+    log.addHandler(ncmdump.handler)
+    parser = ArgumentParser(description='long-running conversion service with a local HTTP API')
+    parser.add_argument('--host', metavar='', type=str, default='127.0.0.1', help='address to bind (default: 127.0.0.1)')
+    parser.add_argument('--port', metavar='', type=int, default=8765, help='TCP port (default: 8765)')
+    parser.add_argument('--unix', metavar='', type=str, default=None, help='listen on this Unix socket instead of TCP')
+    parser.add_argument('-o', '--output', metavar='', type=str, default='output',
+                        help='output directory; jobs may only pick a subdirectory of it (default: output)')
+    parser.add_argument('-w', '--workers', metavar='', type=int, default=None,
+                        help='decrypt processes (default: CPU count)')
+    parser.add_argument('-t', '--tag-workers', metavar='', type=int, default=4,
+                        help='concurrent metadata lookups (default: 4)')
+    parser.add_argument('--client-limit', metavar='', type=int, default=2,
+                        help='files in flight per client (default: 2)')
+    parser.add_argument('--max-jobs', metavar='', type=int, default=16,
+                        help='unfinished jobs per client (default: 16)')
+    args = parser.parse_args()
+
+    asyncio.run(serve(args.host, args.port, args.unix, workers=args.workers, tag_workers=args.tag_workers,
+                      client_limit=args.client_limit, max_jobs=args.max_jobs, output_dir=args.output))
@@ -0,0 +1,79 @@
+from array import array
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS playlist (
+    row      INTEGER PRIMARY KEY,
+    path     TEXT NOT NULL,
+    title    TEXT NOT NULL,
+    artist   TEXT NOT NULL,
+    album    TEXT NOT NULL DEFAULT '',
+    duration REAL NOT NULL DEFAULT 0,
+    lyrics   TEXT
+);
+CREATE TABLE IF NOT EXISTS state (
+    key   TEXT PRIMARY KEY,
+    value
+);
+"""
+
+PLAYLIST_FIELDS = ('path', 'title', 'artist', 'album', 'duration', 'lyrics')
+# Queue index lists are stored as packed int32 blobs
+BLOB_KEYS = ('order', 'back', 'forward')
+
+
+def _pack(values):
+    return array('i', values).tobytes()
+
+
+def _unpack(blob):
+    values = array('i')
+    values.frombytes(blob or b'')
+    return values.tolist()
+
+
+class SessionStore:
+    """Last player session: playlist rows with their tags, queue and transport state.
+
+    Everything needed to show the playlist and resume the last track is
+    stored here, so startup doesn't have to open any audio file.
+    """
+
+    def __init__(self, db_path):
+        import sqlite3
+
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def save(self, playlist, **state):
+        """Replace the stored playlist and update ``state`` in one transaction."""
+        with self.conn:
+            self.conn.execute('DELETE FROM playlist')
+            self.conn.executemany(
+                'INSERT INTO playlist (row, path, title, artist, album, duration, lyrics) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                ((row, song['path'], song['title'], song['artist'], song.get('album') or '',
+                  song.get('duration') or 0, song.get('lyrics')) for row, song in enumerate(playlist))
+            )
+            self._write_state(state)
+
+    def save_state(self, **state):
+        with self.conn:
+            self._write_state(state)
+
+    def _write_state(self, state):
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)',
+            ((key, _pack(value) if key in BLOB_KEYS else value) for key, value in state.items())
+        )
+
+    def load(self):
+        """Return ``(playlist, state)``; both empty when nothing was saved."""
+        cursor = self.conn.execute(f'SELECT {", ".join(PLAYLIST_FIELDS)} FROM playlist ORDER BY row')
+        playlist = [dict(zip(PLAYLIST_FIELDS, row), cover_pixmap=None) for row in cursor]
+        state = {}
+        for key, value in self.conn.execute('SELECT key, value FROM state'):
+            state[key] = _unpack(value) if key in BLOB_KEYS else value
+        return playlist, state
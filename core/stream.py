@@ -0,0 +1,308 @@
+"""Stream the library and ``.ncm`` files to other devices on the LAN.
+
+Converted tracks are served as they are and ``.ncm`` files are decrypted
+on the fly, both with HTTP ``Range`` support. The NCM keystream depends
+only on the payload offset, so when a player seeks, decryption starts at
+the requested byte instead of at the beginning of the file. A stream
+holds a single block in memory and waits for the client to take it
+before reading the next one, so slow clients cost no more memory than
+fast ones::
+
+    python -m core.stream output ~/ncm --host 0.0.0.0
+    curl -s localhost:8766/tracks
+    vlc http://<host>:8766/playlist.m3u
+
+Endpoints:
+
+    GET        /tracks               playable files under every root, as JSON
+    GET        /playlist.m3u         the same as an M3U playlist
+    GET, HEAD  /stream/<n>/<path>    a file under root ``n``, honouring Range
+    GET        /health, /metrics     liveness, Prometheus text
+
+Connections are kept alive between requests, since players seek with
+many short range requests.
+"""
+import os
+import json
+import struct
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from urllib.parse import quote, unquote
+
+from core import ncmdump
+from core.metrics import metrics
+from core.service import HttpError, STATUS_TEXT, read_request
+
+log = logging.getLogger(__name__)
+
+BLOCK_SIZE = 64 << 10
+# Per connection; writes wait for the client once this much is unsent
+WRITE_BUFFER_BYTES = 256 << 10
+HEADER_CACHE_SIZE = 256
+EXTENSIONS = ('.mp3', '.flac', '.ncm')
+CONTENT_TYPES = {'mp3': 'audio/mpeg', 'flac': 'audio/flac'}
+
+
+def parse_range(value, size):
+    """``(start, end)`` of a ``Range`` header (end exclusive).
+
+    Returns None when the whole file should be sent: no header, a unit
+    other than bytes, or several ranges (which a 200 answers as well).
+    Raises ValueError if the range lies outside a file of ``size`` bytes.
+    """
+    if not value:
+        return None
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    try:
+        if not first:
+            # Suffix range: the last N bytes
+            start, end = max(0, size - int(last)), size
+        else:
+            start = int(first)
+            end = min(size, int(last) + 1) if last else size
+    except ValueError:
+        return None
+    if start >= size or start >= end:
+        raise ValueError(f'{value} outside {size} bytes')
+    return start, end
+
+
+class StreamServer:
+    def __init__(self, roots, max_streams=32):
+        self.roots = [os.path.realpath(root) for root in roots]
+        self.max_streams = max_streams
+        self.streams = 0
+        self.lock = threading.Lock()
+        self.headers = OrderedDict()
+        self.connections = {}
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=8766):
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        port = self.server.sockets[0].getsockname()[1]
+        log.info(f'Streaming {", ".join(self.roots)} on http://{host}:{port}')
+        return self.server
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        # Hang up idle keep-alive connections and let their handlers finish
+        for writer in self.connections.values():
+            writer.transport.abort()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+
+    # --- files ---
+
+    def list_tracks(self):
+        """Playable files under every root; ``size`` is what a full GET returns, i.e. the payload of an ``.ncm``."""
+        tracks = []
+        for n, root in enumerate(self.roots):
+            for filepath, size in ncmdump.iter_files(root, extensions=EXTENSIONS):
+                relpath = os.path.relpath(filepath, root).replace(os.sep, '/')
+                name, ext = os.path.splitext(os.path.basename(filepath))
+                if ext.lower() == '.ncm':
+                    try:
+                        with open(filepath, 'rb') as f:
+                            size -= ncmdump.read_audio_offset(f)
+                    except (OSError, ValueError, struct.error) as e:
+                        log.warning(f'Skipping unreadable "{filepath}": {e}')
+                        continue
+                tracks.append({'name': name, 'format': ext[1:].lower(), 'size': size,
+                               'url': f'/stream/{n}/{quote(relpath)}'})
+        return tracks
+
+    def resolve(self, parts):
+        """The file ``/stream/<n>/<path>`` refers to; never anything outside root ``n``."""
+        if len(parts) < 3 or not parts[1].isdigit() or int(parts[1]) >= len(self.roots):
+            raise HttpError(404, 'no such track')
+        root = self.roots[int(parts[1])]
+        filepath = os.path.realpath(os.path.join(root, *(unquote(p) for p in parts[2:])))
+        if os.path.commonpath([root, filepath]) != root or not filepath.lower().endswith(EXTENSIONS) \
+                or not os.path.isfile(filepath):
+            raise HttpError(404, 'no such track')
+        return filepath
+
+    def ncm_header(self, filepath):
+        """``(audio_offset, keystream, format)`` of an ``.ncm``, cached while the file is unchanged."""
+        st = os.stat(filepath)
+        key = (filepath, st.st_size, st.st_mtime_ns)
+        with self.lock:
+            cached = self.headers.get(key)
+            if cached is not None:
+                self.headers.move_to_end(key)
+                return cached
+        with metrics.stage('stream_header'), open(filepath, 'rb') as f:
+            header = ncmdump.read_header(f)
+        cached = (header.audio_offset, ncmdump.make_keystream(header.key_box), header.meta_data.get('format', 'mp3'))
+        with self.lock:
+            self.headers[key] = cached
+            while len(self.headers) > HEADER_CACHE_SIZE:
+                self.headers.popitem(last=False)
+        return cached
+
+    # --- HTTP ---
+
+    async def handle_connection(self, reader, writer):
+        writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_BYTES)
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    method, path, headers, _ = await read_request(reader)
+                    keep_alive = headers.get('connection', '').lower() != 'close'
+                    await self.dispatch(method, path, headers, writer, keep_alive)
+                except HttpError as e:
+                    keep_alive = False
+                    await self.respond(writer, e.status, {'error': str(e)}, keep_alive=False)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            # Headers may be out already, so all that's left is to hang up
+            log.exception('Stream failed')
+        finally:
+            del self.connections[task]
+            writer.close()
+
+    async def dispatch(self, method, path, headers, writer, keep_alive):
+        loop = asyncio.get_running_loop()
+        parts = [p for p in path.split('/') if p]
+        if method not in ('GET', 'HEAD'):
+            raise HttpError(405, 'use GET or HEAD')
+
+        if parts == ['health']:
+            return await self.respond(writer, 200, {'status': 'ok', 'streams': self.streams, 'roots': self.roots},
+                                      keep_alive=keep_alive)
+        if parts == ['metrics']:
+            return await self.respond(writer, 200, metrics.to_prometheus(), 'text/plain; version=0.0.4',
+                                      keep_alive=keep_alive)
+        if parts in (['tracks'], ['playlist.m3u']):
+            tracks = await loop.run_in_executor(None, self.list_tracks)
+            if parts == ['tracks']:
+                return await self.respond(writer, 200, tracks, keep_alive=keep_alive)
+            base = f'http://{headers.get("host", "localhost")}'
+            lines = ['#EXTM3U'] + [f'#EXTINF:-1,{t["name"]}\n{base}{t["url"]}' for t in tracks]
+            return await self.respond(writer, 200, '\n'.join(lines) + '\n', 'audio/x-mpegurl',
+                                      keep_alive=keep_alive)
+        if parts and parts[0] == 'stream':
+            filepath = self.resolve(parts)
+            return await self.stream(method, filepath, headers, writer, keep_alive)
+        raise HttpError(404, 'not found')
+
+    def write_head(self, writer, status, fields, keep_alive):
+        lines = [f'HTTP/1.1 {status} {STATUS_TEXT.get(status, "Error")}']
+        lines += [f'{name}: {value}' for name, value in fields.items()]
+        lines.append(f'Connection: {"keep-alive" if keep_alive else "close"}')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    async def respond(self, writer, status, payload, content_type='application/json', keep_alive=True):
+        if not isinstance(payload, str):
+            payload = json.dumps(payload, ensure_ascii=False)
+        data = payload.encode('utf-8')
+        self.write_head(writer, status, {'Content-Type': content_type, 'Content-Length': len(data)}, keep_alive)
+        writer.write(data)
+        await writer.drain()
+
+    async def stream(self, method, filepath, headers, writer, keep_alive):
+        loop = asyncio.get_running_loop()
+        if filepath.lower().endswith('.ncm'):
+            try:
+                audio_offset, keystream, fmt = await loop.run_in_executor(None, self.ncm_header, filepath)
+            except Exception as e:
+                raise HttpError(500, f'cannot read "{os.path.basename(filepath)}": {type(e).__name__}: {e}')
+        else:
+            audio_offset, keystream, fmt = 0, None, filepath.rsplit('.', 1)[-1].lower()
+        size = os.path.getsize(filepath) - audio_offset
+
+        fields = {'Content-Type': CONTENT_TYPES.get(fmt, 'application/octet-stream'), 'Accept-Ranges': 'bytes'}
+        try:
+            requested = parse_range(headers.get('range'), size)
+        except ValueError:
+            fields.update({'Content-Range': f'bytes */{size}', 'Content-Length': 0})
+            self.write_head(writer, 416, fields, keep_alive)
+            return await writer.drain()
+        start, end = requested or (0, size)
+        fields['Content-Length'] = end - start
+        if requested:
+            fields['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+        kind = 'ncm' if keystream is not None else 'file'
+        metrics.inc('stream_requests_total', kind=kind, ranged='yes' if requested else 'no')
+
+        if method == 'HEAD' or start == end:
+            self.write_head(writer, 206 if requested else 200, fields, keep_alive)
+            return await writer.drain()
+        if self.streams >= self.max_streams:
+            raise HttpError(503, f'already serving {self.streams} streams')
+        self.write_head(writer, 206 if requested else 200, fields, keep_alive)
+        self.streams += 1
+        try:
+            with open(filepath, 'rb') as f:
+                if keystream is None:
+                    await loop.sendfile(writer.transport, f, start, end - start)
+                else:
+                    await self.send_decrypted(f, audio_offset, start, end, keystream, writer)
+        finally:
+            self.streams -= 1
+        metrics.add_bytes('stream', end - start)
+
+    async def send_decrypted(self, f, audio_offset, start, end, keystream, writer):
+        loop = asyncio.get_running_loop()
+
+        def read_block(pos):
+            # A fresh buffer per block: the transport may still hold the last one
+            f.seek(audio_offset + pos)
+            block = bytearray(min(BLOCK_SIZE, end - pos))
+            n = f.readinto(block)
+            del block[n:]
+            ncmdump.apply_keystream(block, pos, keystream)
+            return block
+
+        pos = start
+        while pos < end:
+            block = await loop.run_in_executor(None, read_block, pos)
+            if not block:
+                raise ConnectionError(f'"{f.name}" shrank while streaming')
+            writer.write(block)
+            await writer.drain()
+            pos += len(block)
+
+
+async def serve(roots, host='127.0.0.1', port=8766, max_streams=32):
+    import signal
+
+    server = StreamServer(roots, max_streams)
+    await server.start(host, port)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    await server.close()
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    log.setLevel(logging.INFO)
+    log.addHandler(ncmdump.handler)
+    parser = ArgumentParser(description='stream library tracks and .ncm files over HTTP')
+    parser.add_argument('roots', metavar='roots', type=str, nargs='*', default=['output'],
+                        help='directories to serve (default: output)')
+    parser.add_argument('--host', metavar='', type=str, default='127.0.0.1',
+                        help='address to bind, 0.0.0.0 for the whole LAN (default: 127.0.0.1)')
+    parser.add_argument('--port', metavar='', type=int, default=8766, help='TCP port (default: 8766)')
+    parser.add_argument('--max-streams', metavar='', type=int, default=32,
+                        help='concurrent streams before answering 503 (default: 32)')
+    args = parser.parse_args()
+    for root in args.roots:
+        if not os.path.isdir(root):
+            parser.error(f'not a directory: {root}')
+
+    asyncio.run(serve(args.roots, args.host, args.port, args.max_streams))
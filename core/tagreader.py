@@ -0,0 +1,295 @@
+"""Single-pass tag reader for MP3 (ID3v2) and FLAC files.
+
+Reads the ID3v2 frame headers, the first MPEG frame (for the Xing/Info or
+VBRI header) or the FLAC metadata blocks, and nothing else: lyrics and
+cover frames are not decoded, only located, so a library scan touches a
+few KB per file. ``load_lyrics``/``load_cover`` read them later from the
+returned ``(offset, size, kind)`` references.
+
+``read_tags`` returns None for files it doesn't handle (ID3v2 with
+whole-tag unsynchronisation, compressed or encrypted frames, no MPEG sync
+near the start); callers fall back to mutagen for those.
+"""
+import os
+import struct
+
+# Text frames we need, per ID3v2 major version
+ID3_FRAMES = {
+    2: {'TT2': 'title', 'TP1': 'artist', 'TAL': 'album', 'ULT': 'lyrics', 'PIC': 'cover'},
+    3: {'TIT2': 'title', 'TPE1': 'artist', 'TALB': 'album', 'USLT': 'lyrics', 'APIC': 'cover'},
+    4: {'TIT2': 'title', 'TPE1': 'artist', 'TALB': 'album', 'USLT': 'lyrics', 'APIC': 'cover'},
+}
+ID3_ENCODINGS = ('latin-1', 'utf-16', 'utf-16-be', 'utf-8')
+
+# MPEG header tables, indexed [version][layer] where version is 1 for
+# MPEG-1 and 2 for MPEG-2/2.5; layer is 1..3
+MPEG_BITRATES = {
+    1: {1: (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+        2: (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+        3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)},
+    2: {1: (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+        2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+        3: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)},
+}
+MPEG_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+# How far past the ID3 tag to look for the first frame
+SYNC_READ_BYTES = 4 * 1024
+SYNC_SCAN_BYTES = 64 * 1024
+
+VORBIS_FIELDS = {'TITLE': 'title', 'ARTIST': 'artist', 'ALBUM': 'album',
+                 'LYRICS': 'lyrics', 'UNSYNCEDLYRICS': 'lyrics'}
+
+
+def _syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def _split_text(data, encoding):
+    """Split ``data`` at the first encoding-appropriate NUL: ``(text, rest)``."""
+    if encoding in (1, 2):
+        i = 0
+        while True:
+            i = data.find(b'\0\0', i)
+            if i < 0 or i % 2 == 0:
+                break
+            i += 1
+        if i < 0:
+            return data, b''
+        return data[:i], data[i + 2:]
+    head, _, rest = data.partition(b'\0')
+    return head, rest
+
+
+def _decode(data, encoding):
+    if encoding >= len(ID3_ENCODINGS):
+        raise ValueError(f'bad text encoding {encoding}')
+    if encoding == 1 and not data:
+        return ''
+    return data.decode(ID3_ENCODINGS[encoding], errors='replace')
+
+
+def _text_frame(data):
+    if not data:
+        return ''
+    encoding = data[0]
+    text, _ = _split_text(data[1:], encoding)
+    return _decode(text, encoding).rstrip('\0')
+
+
+def _read_id3(f, info):
+    """Parse the ID3v2 tag at the current position; returns the offset after it or None."""
+    start = f.tell()
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        f.seek(start)
+        return start
+    major, flags = header[3], header[5]
+    if major not in ID3_FRAMES or flags & 0x80:
+        # Unknown version or whole-tag unsynchronisation
+        return None
+    size = _syncsafe(header[6:10])
+    end = start + 10 + size + (10 if flags & 0x10 else 0)
+    pos = start + 10
+    if flags & 0x40:
+        ext = f.read(4)
+        ext_size = _syncsafe(ext) if major == 4 else struct.unpack('>I', ext)[0] + 4
+        pos += ext_size
+    frames = ID3_FRAMES[major]
+    head_len = 6 if major == 2 else 10
+    tag_end = start + 10 + size
+
+    while pos + head_len <= tag_end:
+        f.seek(pos)
+        head = f.read(head_len)
+        if len(head) < head_len or head[0] == 0:
+            break  # padding
+        if major == 2:
+            frame_id, frame_size, frame_flags = head[:3].decode('latin-1'), int.from_bytes(head[3:6], 'big'), 0
+        else:
+            frame_id = head[:4].decode('latin-1')
+            frame_size = _syncsafe(head[4:8]) if major == 4 else struct.unpack('>I', head[4:8])[0]
+            frame_flags = head[9]
+        body = pos + head_len
+        pos = body + frame_size
+        if pos > tag_end:
+            break
+        field = frames.get(frame_id)
+        if field is None or (field in ('lyrics', 'cover') and field + '_ref' in info):
+            continue
+        # v2.3: compression/encryption; v2.4: compression/encryption/unsync/length
+        if frame_flags & (0xC0 if major == 3 else 0x0F):
+            return None
+        if field in ('lyrics', 'cover'):
+            info[field + '_ref'] = (body, frame_size, f'id3v2.{major}')
+        elif field not in info:
+            info[field] = _text_frame(f.read(frame_size))
+    return end
+
+
+def _find_sync(data):
+    """Index of the first plausible MPEG audio frame header in ``data``, or None."""
+    i = 0
+    while True:
+        i = data.find(b'\xff', i)
+        if i < 0 or i + 4 > len(data):
+            return None
+        b1, b2 = data[i + 1], data[i + 2]
+        version_bits, layer_bits = (b1 >> 3) & 3, (b1 >> 1) & 3
+        bitrate_index, rate_index = b2 >> 4, (b2 >> 2) & 3
+        if (b1 & 0xE0) == 0xE0 and version_bits != 1 and layer_bits and bitrate_index not in (0, 15) and rate_index != 3:
+            return i
+        i += 1
+
+
+def _mpeg_duration(f, audio_start, file_size):
+    # The first frame almost always follows the tag directly; only scan
+    # further when there is junk in between
+    for scan in (SYNC_READ_BYTES, SYNC_SCAN_BYTES):
+        f.seek(audio_start)
+        data = f.read(scan)
+        i = _find_sync(data)
+        if i is not None:
+            break
+    else:
+        return None
+
+    b1, b2, b3 = data[i + 1], data[i + 2], data[i + 3]
+    version_bits, layer_bits = (b1 >> 3) & 3, (b1 >> 1) & 3
+    bitrate_index, rate_index = b2 >> 4, (b2 >> 2) & 3
+    version = 1 if version_bits == 3 else 2
+    layer = 4 - layer_bits
+    sample_rate = MPEG_SAMPLE_RATES[version_bits][rate_index]
+    bitrate = MPEG_BITRATES[version][layer][bitrate_index] * 1000
+    mono = (b3 >> 6) == 3
+    if layer == 1:
+        samples = 384
+    elif layer == 2 or version == 1:
+        samples = 1152
+    else:
+        samples = 576
+
+    frame = data[i:i + 200]
+    side_info = (17 if mono else 32) if version == 1 else (9 if mono else 17)
+    xing = 4 + side_info
+    if frame[xing:xing + 4] in (b'Xing', b'Info'):
+        flags = struct.unpack('>I', frame[xing + 4:xing + 8])[0]
+        if flags & 1:
+            frames = struct.unpack('>I', frame[xing + 8:xing + 12])[0]
+            return frames * samples / sample_rate
+    if frame[36:40] == b'VBRI':
+        frames = struct.unpack('>I', frame[50:54])[0]
+        return frames * samples / sample_rate
+
+    # CBR: estimate from the audio size, minus a trailing ID3v1 tag
+    audio_bytes = file_size - (audio_start + i)
+    f.seek(max(0, file_size - 128))
+    if f.read(3) == b'TAG':
+        audio_bytes -= 128
+    return audio_bytes * 8 / bitrate
+
+
+def _read_flac(f, start, info):
+    f.seek(start + 4)
+    while True:
+        head = f.read(4)
+        if len(head) < 4:
+            return None
+        last, block_type, length = head[0] & 0x80, head[0] & 0x7F, int.from_bytes(head[1:4], 'big')
+        body = f.tell()
+        if block_type == 0:
+            streaminfo = f.read(length)
+            packed = int.from_bytes(streaminfo[10:18], 'big')
+            sample_rate, total = packed >> 44, packed & ((1 << 36) - 1)
+            info['duration'] = total / sample_rate if sample_rate else 0.0
+        elif block_type == 4:
+            _read_vorbis(f.read(length), body, info)
+        elif block_type == 6 and 'cover_ref' not in info:
+            info['cover_ref'] = (body, length, 'flac')
+        f.seek(body + length)
+        if last:
+            return info
+
+
+def _read_vorbis(block, offset, info):
+    vendor_len = struct.unpack_from('<I', block, 0)[0]
+    pos = 4 + vendor_len
+    count = struct.unpack_from('<I', block, pos)[0]
+    pos += 4
+    for _ in range(count):
+        length = struct.unpack_from('<I', block, pos)[0]
+        pos += 4
+        entry = block[pos:pos + length]
+        key, sep, value = entry.partition(b'=')
+        field = VORBIS_FIELDS.get(key.decode('ascii', errors='replace').upper()) if sep else None
+        if field == 'lyrics':
+            if 'lyrics_ref' not in info:
+                value_at = pos + len(key) + 1
+                info['lyrics_ref'] = (offset + value_at, length - len(key) - 1, 'utf8')
+        elif field and field not in info:
+            info[field] = value.decode('utf-8', errors='replace')
+        pos += length
+
+
+def read_tags(path):
+    """Title, artist, album, duration and lyrics/cover references of ``path``, or None.
+
+    Raises OSError/ValueError/struct.error for unreadable or corrupt files.
+    """
+    info = {}
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        audio_start = _read_id3(f, info)
+        if audio_start is None:
+            return None
+        f.seek(audio_start)
+        if f.read(4) == b'fLaC':
+            if _read_flac(f, audio_start, info) is None:
+                return None
+        else:
+            info['duration'] = _mpeg_duration(f, audio_start, file_size)
+            if info['duration'] is None:
+                return None
+    return info
+
+
+def _read_ref(path, ref):
+    offset, size, _ = ref
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read(size)
+    if len(data) < size:
+        raise ValueError('truncated frame')
+    return data
+
+
+def load_lyrics(path, ref):
+    """Decode the lyrics frame found by ``read_tags``."""
+    data = _read_ref(path, ref)
+    if ref[2] == 'utf8':
+        return data.decode('utf-8', errors='replace')
+    # encoding, 3-byte language, description, text
+    encoding = data[0]
+    _, text = _split_text(data[4:], encoding)
+    return _decode(text, encoding).rstrip('\0')
+
+
+def load_cover(path, ref):
+    """Image bytes of the picture frame/block found by ``read_tags``."""
+    data = _read_ref(path, ref)
+    kind = ref[2]
+    if kind == 'flac':
+        pos = 4
+        mime_len = struct.unpack_from('>I', data, pos)[0]
+        pos += 4 + mime_len
+        desc_len = struct.unpack_from('>I', data, pos)[0]
+        pos += 4 + desc_len + 16
+        data_len = struct.unpack_from('>I', data, pos)[0]
+        return data[pos + 4:pos + 4 + data_len]
+    encoding = data[0]
+    if kind == 'id3v2.2':
+        rest = data[1 + 3 + 1:]
+    else:
+        _, rest = data[1:].split(b'\0', 1)
+        rest = rest[1:]  # picture type
+    _, image = _split_text(rest, encoding)
+    return image
@@ -0,0 +1,388 @@
+"""Watch folders and feed new ``.ncm`` arrivals into the import pipeline.
+
+On Linux the folders are watched with inotify (through ``ctypes``, no extra
+dependency); elsewhere, or with ``--poll``, they are rescanned every few
+seconds. Either way a file is only handed on once its size has stopped
+changing for ``settle`` seconds, so half-synced files are never converted::
+
+    python -m core.watch ~/Sync/ncm -o output --settle 3
+
+Existing files are left alone unless ``--initial-scan`` is given; work per
+event is proportional to the files that actually arrived.
+"""
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import logging
+import threading
+from abc import ABC, abstractmethod
+
+from core import ncmdump
+
+log = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Debouncer:
+    """Holds changed paths until their size has been stable for ``settle`` seconds."""
+
+    def __init__(self, settle=2.0):
+        self.settle = settle
+        self.pending = {}
+
+    def touch(self, path, now=None):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        self.pending[path] = (time.monotonic() if now is None else now, size)
+
+    def discard(self, path):
+        self.pending.pop(path, None)
+
+    def ready(self, now=None):
+        """Return ``[(path, size)]`` for files that have settled."""
+        now = time.monotonic() if now is None else now
+        settled = []
+        for path, (changed, size) in list(self.pending.items()):
+            if now - changed < self.settle:
+                continue
+            try:
+                current = os.path.getsize(path)
+            except OSError:
+                # Deleted or renamed away before it settled
+                del self.pending[path]
+                continue
+            if current != size:
+                # Still growing: wait another settle period
+                self.pending[path] = (now, current)
+                continue
+            del self.pending[path]
+            settled.append((path, size))
+        return settled
+
+
+class Watcher(ABC):
+    """Yields ``(filepath, size)`` for settled arrivals, and ``None`` on idle ticks.
+
+    The idle ticks let a consumer such as ``batch.run_pipeline`` handle
+    finished work while no new files are coming in. Iteration ends after
+    ``stop()``. Subclasses implement ``start`` and ``wait``.
+    """
+
+    def __init__(self, paths, include=None, exclude=None, settle=2.0, interval=1.0, initial_scan=False):
+        self.roots = [os.path.abspath(p) for p in paths]
+        for root in self.roots:
+            if not os.path.isdir(root):
+                raise ValueError(f'not a directory: {root}')
+        self.include = include
+        self.exclude = exclude
+        self.interval = interval
+        self.initial_scan = initial_scan
+        self.debouncer = Debouncer(settle)
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _root_of(self, path):
+        for root in self.roots:
+            if path == root or path.startswith(root + os.sep):
+                return root
+        return None
+
+    def wanted(self, path):
+        if not path.lower().endswith('.ncm'):
+            return False
+        root = self._root_of(path)
+        if root is None:
+            return False
+        relpath = os.path.relpath(path, root).replace(os.sep, '/')
+        if self.include and not ncmdump._matches(relpath, self.include):
+            return False
+        return not self.excluded(relpath)
+
+    def excluded(self, relpath):
+        # Same rule as iter_files: a pattern matching any parent directory prunes it
+        if not self.exclude:
+            return False
+        parts = relpath.split('/')
+        return any(ncmdump._matches('/'.join(parts[:i]), self.exclude) for i in range(1, len(parts) + 1))
+
+    def _scan(self, path):
+        if path in self.roots:
+            yield from ncmdump.iter_files(path, include=self.include, exclude=self.exclude)
+            return
+        # Patterns are relative to the watched root, not to this subdirectory
+        for fp, size in ncmdump.iter_files(path):
+            if self.wanted(fp):
+                yield fp, size
+
+    @abstractmethod
+    def start(self):
+        """Begin watching; must record the starting state before anything is yielded."""
+
+    @abstractmethod
+    def wait(self, timeout):
+        """Block for up to ``timeout`` seconds collecting events into the debouncer."""
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        self.start()
+        try:
+            if self.initial_scan:
+                for root in self.roots:
+                    for fp, _ in self._scan(root):
+                        self.debouncer.touch(fp, now=float('-inf'))
+            while not self.stopped.is_set():
+                self.wait(min(self.interval, self.debouncer.settle))
+                settled = self.debouncer.ready()
+                if settled:
+                    log.info(f'{len(settled)} new file(s) ready')
+                yield from settled
+                yield None
+        finally:
+            self.close()
+
+
+class InotifyWatcher(Watcher):
+    """Recursive watch using Linux inotify; one watch descriptor per directory."""
+
+    def start(self):
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add = libc.inotify_add_watch
+        self._add.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f'inotify_init1: {os.strerror(err)}')
+        self.dirs = {}
+        for root in self.roots:
+            self._watch_tree(root)
+        log.info(f'Watching {len(self.dirs)} director(ies) with inotify')
+
+    def _watch_dir(self, path):
+        import ctypes
+
+        wd = self._add(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                log.error('inotify watch limit reached; raise fs.inotify.max_user_watches or use --poll')
+            log.warning(f'Cannot watch "{path}": {os.strerror(err)}')
+            return False
+        self.dirs[wd] = path
+        return True
+
+    def _watch_tree(self, top):
+        # Watch before listing so nothing created in between is missed
+        stack = [top]
+        while stack:
+            directory = stack.pop()
+            if not self._watch_dir(directory):
+                continue
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            relpath = os.path.relpath(entry.path, self._root_of(entry.path)).replace(os.sep, '/')
+                            if not self.excluded(relpath):
+                                stack.append(entry.path)
+            except OSError as e:
+                log.warning(f'Cannot list "{directory}": {e}')
+
+    def _rescan(self):
+        # The kernel queue overflowed and events were lost; fall back to a
+        # full walk once. Already converted files are skipped by the pipeline.
+        log.warning('inotify queue overflow, rescanning watched folders')
+        for root in self.roots:
+            self._watch_tree(root)
+            for fp, _ in self._scan(root):
+                self.debouncer.touch(fp)
+
+    def wait(self, timeout):
+        try:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+        except InterruptedError:
+            return
+        if not readable:
+            return
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self._rescan()
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            directory = self.dirs.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    relpath = os.path.relpath(path, self._root_of(path)).replace(os.sep, '/')
+                    if self.excluded(relpath):
+                        continue
+                    # Files may already be inside (moved in, or written before the watch)
+                    self._watch_tree(path)
+                    for fp, _ in self._scan(path):
+                        self.debouncer.touch(fp)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.debouncer.discard(path)
+            elif self.wanted(path):
+                self.debouncer.touch(path)
+
+    def close(self):
+        if getattr(self, 'fd', -1) >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher(Watcher):
+    """Portable fallback: rescans every ``interval`` seconds and diffs sizes.
+
+    Only the directory walk scales with folder size; conversion still only
+    sees files that are new or whose size changed.
+    """
+
+    def __init__(self, paths, interval=5.0, **kwargs):
+        super().__init__(paths, interval=interval, **kwargs)
+        self.known = {}
+        self.next_scan = 0.0
+
+    def _snapshot(self):
+        files = {}
+        for root in self.roots:
+            try:
+                files.update(self._scan(root))
+            except (OSError, ValueError) as e:
+                log.warning(f'Cannot scan "{root}": {e}')
+        return files
+
+    def start(self):
+        self.known = self._snapshot()
+        self.next_scan = time.monotonic() + self.interval
+        log.info(f'Polling {len(self.roots)} folder(s) every {self.interval:g}s')
+
+    def wait(self, timeout):
+        now = time.monotonic()
+        if now < self.next_scan:
+            self.stopped.wait(min(timeout, self.next_scan - now))
+            return
+        current = self._snapshot()
+        for fp, size in current.items():
+            if self.known.get(fp) != size:
+                self.debouncer.touch(fp)
+        for fp in self.known.keys() - current.keys():
+            self.debouncer.discard(fp)
+        self.known = current
+        self.next_scan = time.monotonic() + self.interval
+
+
+def inotify_available():
+    if not sys.platform.startswith('linux'):
+        return False
+    import ctypes
+    import ctypes.util
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+        return hasattr(libc, 'inotify_init1')
+    except OSError:
+        return False
+
+
+def open_watcher(paths, poll=False, poll_interval=5.0, **kwargs):
+    """inotify where available, polling otherwise (or when ``poll`` is set)."""
+    if not poll and inotify_available():
+        return InotifyWatcher(paths, **kwargs)
+    return PollingWatcher(paths, interval=poll_interval, **kwargs)
+
+
+if __name__ == '__main__':
+    import signal
+    from argparse import ArgumentParser
+
+    from core import batch, profiling
+    from core.metrics import metrics
+
+    parser = ArgumentParser(description='watch folders and import new .ncm files as they arrive')
+    parser.add_argument('paths', metavar='paths', type=str, nargs='+', help='one or more folders to watch')
+    parser.add_argument('-o', '--output', metavar='', type=str, default='output',
+                        help='directory for converted files (default: output)')
+    parser.add_argument('-w', '--workers', metavar='', type=int, default=None,
+                        help='decrypt processes (default: CPU count)')
+    parser.add_argument('-t', '--tag-workers', metavar='', type=int, default=4,
+                        help='concurrent metadata lookups (default: 4)')
+    parser.add_argument('--db', metavar='', type=str, default=None,
+                        help='library index path (default: <output>/library.db)')
+    parser.add_argument('-i', '--include', metavar='', type=str, action='append',
+                        help='only convert files matching this glob pattern (repeatable)')
+    parser.add_argument('-x', '--exclude', metavar='', type=str, action='append',
+                        help='skip files and directories matching this glob pattern (repeatable)')
+    parser.add_argument('--settle', metavar='', type=float, default=2.0,
+                        help='seconds a file size must stay unchanged before import (default: 2)')
+    parser.add_argument('--poll', action='store_true', help='rescan periodically instead of using inotify')
+    parser.add_argument('--poll-interval', metavar='', type=float, default=5.0,
+                        help='seconds between rescans in polling mode (default: 5)')
+    parser.add_argument('--initial-scan', action='store_true',
+                        help='also import files already present when the watch starts')
+    parser.add_argument('--metrics-out', metavar='', type=str, default=None,
+                        help='write per-stage metrics to this file on exit (.prom for Prometheus text, JSON otherwise)')
+    parser.add_argument('--profile', metavar='', type=str, default=None,
+                        help=f'write cProfile/tracemalloc results for every process here (or set {profiling.ENV_VAR})')
+    parser.add_argument('--no-tag', action='store_true', help='skip online metadata lookup')
+    parser.add_argument('--no-index', action='store_true', help='skip the library index')
+    args = parser.parse_args()
+
+    watcher = open_watcher(args.paths, poll=args.poll, poll_interval=args.poll_interval,
+                           include=args.include, exclude=args.exclude, settle=args.settle,
+                           initial_scan=args.initial_scan)
+    # Stop taking new files, let in-flight work finish, then print the summary
+    signal.signal(signal.SIGINT, lambda *_: watcher.stop())
+    signal.signal(signal.SIGTERM, lambda *_: watcher.stop())
+
+    summary = batch.run_pipeline(
+        args.paths, output_dir=args.output, workers=args.workers, tag_workers=args.tag_workers,
+        tag=not args.no_tag, index=not args.no_index, db_path=args.db, profile=args.profile,
+        sources=watcher
+    )
+    if args.metrics_out:
+        metrics.dump(args.metrics_out, summary=summary)
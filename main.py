@@ -2,11 +2,14 @@ import sys
 from PySide6.QtCore import Qt
 from PySide6.QtWidgets import QApplication
 from ui.main_window import NCMPlayerApp
+from ui.watchdog import install_from_env
 
 if __name__ == '__main__':
     # Set attribute to enable high-DPI scaling for better visuals
     QApplication.setAttribute(Qt.AA_EnableHighDpiScaling)
     app = QApplication(sys.argv)
+    # Opt-in: NCM_STALL_WATCHDOG=50 logs main-thread stacks of stalls over 50 ms
+    watchdog = install_from_env(app)
     
     # All the application logic is now in NCMPlayerApp
     window = NCMPlayerApp()
@@ -0,0 +1,78 @@
+from PySide6.QtCore import Qt, QTimer
+from PySide6.QtWidgets import (
+    QDialog, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QTableWidget,
+    QTableWidgetItem, QHeaderView, QFileDialog
+)
+
+from core.metrics import metrics
+
+
+# 诊断面板：显示转换/补全各阶段的耗时统计
+class DiagnosticsDialog(QDialog):
+    COLUMNS = ["阶段", "次数", "平均 (ms)", "P95 (ms)", "总计 (s)"]
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("诊断")
+        self.resize(560, 420)
+        self.setObjectName("diagnosticsDialog")
+
+        layout = QVBoxLayout(self)
+
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        layout.addWidget(self.table)
+
+        self.counters_label = QLabel()
+        self.counters_label.setWordWrap(True)
+        layout.addWidget(self.counters_label)
+
+        buttons = QHBoxLayout()
+        buttons.addStretch()
+        export_button = QPushButton("导出...")
+        export_button.clicked.connect(self.export_metrics)
+        reset_button = QPushButton("清空")
+        reset_button.clicked.connect(self.reset_metrics)
+        buttons.addWidget(export_button)
+        buttons.addWidget(reset_button)
+        layout.addLayout(buttons)
+
+        # 导入在后台线程进行，定时刷新即可
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setInterval(1000)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.refresh_timer.start()
+        self.refresh()
+
+    def refresh(self):
+        stages = metrics.stage_summary()
+        self.table.setRowCount(len(stages))
+        for row, (stage, s) in enumerate(sorted(stages.items(), key=lambda kv: -kv[1]['total'])):
+            values = [stage, str(s['count']), f"{s['mean'] * 1000:.1f}",
+                      f"≤{s['p95'] * 1000:.0f}", f"{s['total']:.2f}"]
+            for col, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                if col:
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.table.setItem(row, col, item)
+
+        counters = metrics.snapshot()['counters']
+        lines = []
+        for name, labels, value in sorted(counters, key=lambda c: (c[0], sorted(c[1].items()))):
+            label_text = ", ".join(f"{k}={v}" for k, v in sorted(labels.items()))
+            lines.append(f"{name}{{{label_text}}} = {value:g}" if label_text else f"{name} = {value:g}")
+        self.counters_label.setText("\n".join(lines) or "暂无数据")
+
+    def export_metrics(self):
+        path, _ = QFileDialog.getSaveFileName(
+            self, "导出诊断数据", "metrics.json", "JSON (*.json);;Prometheus (*.prom)"
+        )
+        if path:
+            metrics.dump(path)
+
+    def reset_metrics(self):
+        metrics.reset()
+        self.refresh()
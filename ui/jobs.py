@@ -0,0 +1,140 @@
+import os
+import threading
+
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Signal
+
+from core.metadata import convert_ncm_to_mp3, update_and_embed_metadata, get_song_metadata
+
+DEFAULT_WORKERS = 2
+# 退出时最多等这么久；联网请求没有超时，不能无限等下去
+SHUTDOWN_TIMEOUT_MS = 3000
+
+
+class ImportSignals(QObject):
+    # 所有信号都以 .ncm 路径作为任务标识
+    progress = Signal(str, int)     # 百分比
+    finished = Signal(str, dict)    # 转换并补全后的歌曲信息
+    failed = Signal(str)
+    cancelled = Signal(str)
+
+
+# 单个导入任务：解密 -> 补全标签 -> 读取元数据
+class ImportJob(QRunnable):
+    def __init__(self, ncm_path, signals):
+        super().__init__()
+        # 调度器持有任务对象，tryTake 之后还要重新 start
+        self.setAutoDelete(False)
+        self.ncm_path = ncm_path
+        self.signals = signals
+        self.cancel_event = threading.Event()
+        self.total = max(1, os.path.getsize(ncm_path))
+        self.done = 0
+        self.percent = -1
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def report(self, n):
+        # 可能被多个解密线程调用；只在百分比变化时发信号
+        with self.lock:
+            self.done += n
+            percent = min(99, self.done * 100 // self.total)
+            if percent == self.percent:
+                return
+            self.percent = percent
+        self.signals.progress.emit(self.ncm_path, percent)
+
+    def enrich(self, converted_path):
+        """联网补全标签；被取消时立即返回 False，不再等还没返回的请求"""
+        # 请求本身打断不了，放在守护线程里跑；它在写标签前会检查取消，取消后不会再写文件
+        worker = threading.Thread(target=update_and_embed_metadata, args=(converted_path, "", ""),
+                                  kwargs={'cancel': self.cancel_event}, daemon=True)
+        worker.start()
+        while True:
+            worker.join(0.1)
+            if not worker.is_alive():
+                return True
+            if self.cancelled:
+                return False
+
+    def run(self):
+        path = self.ncm_path
+        try:
+            if self.cancelled:
+                self.signals.cancelled.emit(path)
+                return
+            converted_path = convert_ncm_to_mp3(path, progress=self.report, cancel=self.cancel_event)
+            if self.cancelled:
+                self.signals.cancelled.emit(path)
+                return
+            if not converted_path:
+                self.signals.failed.emit(path)
+                return
+            if not self.enrich(converted_path):
+                self.signals.cancelled.emit(path)
+                return
+            metadata = get_song_metadata(converted_path)
+            if metadata:
+                self.signals.finished.emit(path, metadata)
+            else:
+                self.signals.failed.emit(path)
+        except Exception:
+            self.signals.failed.emit(path)
+
+
+# 有上限的导入调度器：排队、优先级提升、取消和干净退出
+class ImportScheduler(QObject):
+    def __init__(self, max_workers=DEFAULT_WORKERS, parent=None):
+        super().__init__(parent)
+        self.signals = ImportSignals()
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_workers)
+        self.jobs = {}
+        self.next_priority = 0
+        for signal in (self.signals.finished, self.signals.failed, self.signals.cancelled):
+            signal.connect(self._forget)
+
+    def _forget(self, ncm_path, *args):
+        self.jobs.pop(ncm_path, None)
+
+    def submit(self, ncm_path):
+        if ncm_path in self.jobs:
+            return None
+        job = ImportJob(ncm_path, self.signals)
+        self.jobs[ncm_path] = job
+        self.pool.start(job, 0)
+        return job
+
+    def bump(self, ncm_path):
+        """Move a queued job to the front. Returns False if it is already running (or unknown)."""
+        job = self.jobs.get(ncm_path)
+        if job is None or not self.pool.tryTake(job):
+            return False
+        # 后点的排在更前面
+        self.next_priority += 1
+        self.pool.start(job, self.next_priority)
+        return True
+
+    def cancel(self, ncm_path):
+        job = self.jobs.get(ncm_path)
+        if job is None:
+            return
+        job.cancel()
+        if self.pool.tryTake(job):
+            # 还没开始运行，直接移出队列
+            self.signals.cancelled.emit(ncm_path)
+
+    def pending(self):
+        return len(self.jobs)
+
+    def shutdown(self, timeout_ms=-1):
+        """Cancel everything and wait for running jobs to stop (partial outputs are removed)."""
+        for job in list(self.jobs.values()):
+            job.cancel()
+        self.pool.clear()
+        return self.pool.waitForDone(timeout_ms)
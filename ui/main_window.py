@@ -1,17 +1,18 @@
 import os
 import sys
+import logging
 import traceback
 import threading
-import re
-import random
+import time
 
 # --- PySide6 Imports ---
 from PySide6.QtCore import (
-    Qt, QUrl, QSize, QPoint, QRect, QTimer, QPropertyAnimation, QEasingCurve, QObject, Signal
+    Qt, QUrl, QSize, QPoint, QRect, QTimer, QPropertyAnimation, QEasingCurve, QObject, Signal,
+    QBuffer, QByteArray, QIODevice
 )
 from PySide6.QtGui import (
     QGuiApplication, QPixmap, QIcon, QPainter, QColor, QBrush, 
-    QPainterPath, QFontDatabase, QAction, QFontMetrics
+    QPainterPath, QFontDatabase, QAction, QFontMetrics, QImage
 )
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
@@ -26,15 +27,24 @@ import qtawesome as qta
 # --- Local Imports ---
 from ui.style import STYLE_SHEET
 from ui.widgets import ElidedLabel, SongItemWidget
-from core.metadata import (
-    get_song_metadata, convert_ncm_to_mp3, 
-    update_and_embed_metadata, get_cover_data_from_tags
-)
+from ui.diagnostics import DiagnosticsDialog
+from ui.jobs import ImportScheduler, SHUTDOWN_TIMEOUT_MS
+from core.metadata import get_song_metadata, get_cover_data_from_tags
+from core import audiocache
+from core.library import LibraryIndex
+from core.playqueue import PlaybackQueue
+from core.session import SessionStore
+from core.lyrics import parse_lrc, line_at
+from core.metrics import metrics
+
+log = logging.getLogger(__name__)
 
 # Main Application Window
 class NCMPlayerApp(QMainWindow):
     # 定义信号用于跨线程通信
     song_processed = Signal(dict)
+    song_removed = Signal(str)
+    song_extras_loaded = Signal(str, object, list)
     def __init__(self):
         super().__init__()
         # Basic Setup
@@ -61,6 +71,18 @@ class NCMPlayerApp(QMainWindow):
         self.is_slider_pressed = False
         self.playback_modes = ['sequential', 'repeat_one', 'shuffle']
         self.current_playback_mode_index = 0
+        self.queue = PlaybackQueue()
+        self.parsed_lyrics = []
+        self.lyric_times = []
+        self.pending_position = 0
+        # 起播耗时：从点击到第一次进入 PlayingState
+        self.play_started_at = None
+        self.pending_lyric_time = None
+        # 可选：最近播放的歌曲缓存在内存里（NCM_AUDIO_CACHE_MB）
+        self.audio_cache = audiocache.from_env()
+        self.source_buffer = None
+        # 未命中缓存、正从文件播放的歌曲；开始播放后再在后台读进缓存
+        self.pending_cache_path = None
         
         # Media Player
         self.player = QMediaPlayer()
@@ -84,8 +106,23 @@ class NCMPlayerApp(QMainWindow):
         
         # 连接信号到槽函数
         self.song_processed.connect(self.add_song_to_playlist)
-        
-        self.load_existing_songs()
+        self.song_removed.connect(self.remove_song_from_playlist)
+        self.song_extras_loaded.connect(self.show_song_extras)
+
+        # 导入任务队列：限制并发，可取消，点击排队中的歌曲可优先导入
+        self.import_items = {}
+        self.import_scheduler = ImportScheduler(parent=self)
+        self.import_scheduler.signals.progress.connect(self.update_import_progress)
+        self.import_scheduler.signals.finished.connect(self.import_finished)
+        self.import_scheduler.signals.failed.connect(self.import_failed)
+        self.import_scheduler.signals.cancelled.connect(self.import_cancelled)
+        
+        # 先恢复上次的会话（不读取音频文件），再在后台扫描 output 目录
+        os.makedirs('output', exist_ok=True)
+        self.session = SessionStore(os.path.join('output', 'session.db'))
+        self.library = LibraryIndex(os.path.join('output', 'library.db'))
+        self.restore_session()
+        self.threaded_task(self.load_existing_songs, {song['path'] for song in self.playlist_data})
 
     def _create_ui(self):
         # --- Central Widget and Main Layout ---
@@ -122,8 +159,17 @@ class NCMPlayerApp(QMainWindow):
         self.search_input.textChanged.connect(self.filter_playlist)
         sidebar_layout.addWidget(self.search_input)
 
+        # 歌词搜索结果：点击直接跳到对应歌曲的那一句
+        self.lyric_results_widget = QListWidget()
+        self.lyric_results_widget.setObjectName("lyricResults")
+        self.lyric_results_widget.itemClicked.connect(self.play_lyric_hit)
+        self.lyric_results_widget.hide()
+        sidebar_layout.addWidget(self.lyric_results_widget)
+
         self.playlist_widget = QListWidget()
         self.playlist_widget.itemClicked.connect(self.play_from_list)
+        self.playlist_widget.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.playlist_widget.customContextMenuRequested.connect(self.show_import_menu)
         sidebar_layout.addWidget(self.playlist_widget)
         
         top_content_layout.addWidget(sidebar, 1)
@@ -243,7 +289,6 @@ class NCMPlayerApp(QMainWindow):
         
         main_layout.addWidget(player_controls_container)
 
-        self.playlist_widget.itemClicked.connect(self.play_from_list)
         self.lyrics_widget.itemClicked.connect(self.seek_from_lyric)
     
     def _create_title_bar(self):
@@ -267,6 +312,14 @@ class NCMPlayerApp(QMainWindow):
         
         layout.addStretch()
         
+        # 诊断面板按钮
+        self.diagnostics_btn = QPushButton()
+        self.diagnostics_btn.setIcon(qta.icon('fa5s.chart-bar', color='#B3B3B3'))
+        self.diagnostics_btn.setObjectName("windowControlBtn")
+        self.diagnostics_btn.setToolTip("诊断")
+        self.diagnostics_btn.clicked.connect(self.show_diagnostics)
+        layout.addWidget(self.diagnostics_btn)
+        
         # 窗口控制按钮
         self.minimize_btn = QPushButton()
         self.minimize_btn.setIcon(qta.icon('fa5s.minus', color='#B3B3B3'))
@@ -289,6 +342,14 @@ class NCMPlayerApp(QMainWindow):
         
         return title_bar
     
+    def show_diagnostics(self):
+        """打开诊断面板（非模态）"""
+        if not hasattr(self, 'diagnostics_dialog'):
+            self.diagnostics_dialog = DiagnosticsDialog(self)
+            self.diagnostics_dialog.setStyleSheet(STYLE_SHEET)
+        self.diagnostics_dialog.show()
+        self.diagnostics_dialog.raise_()
+    
     def toggle_maximize(self):
         """切换最大化状态"""
         if self.isMaximized():
@@ -331,6 +392,35 @@ class NCMPlayerApp(QMainWindow):
                 # 直接在显示文本中搜索
                 item_text = item.text().lower()
                 item.setHidden(search_text not in item_text)
+        self.search_lyrics(search_text)
+
+    def search_lyrics(self, search_text):
+        """在歌词全文索引中搜索，列出命中的歌词行"""
+        self.lyric_results_widget.clear()
+        hits = self.library.search_lyrics(search_text) if search_text else []
+        for hit in hits:
+            item = QListWidgetItem(f"“{hit['text']}”  {hit['title']} · {self.format_time(hit['time'])}")
+            item.setData(Qt.UserRole, (hit['path'], hit['time']))
+            self.lyric_results_widget.addItem(item)
+        self.lyric_results_widget.setVisible(bool(hits))
+
+    def play_lyric_hit(self, item):
+        path, time_ms = item.data(Qt.UserRole)
+        rows = [i for i, song in enumerate(self.playlist_data) if song['path'] == path]
+        if not rows:
+            return
+        if rows[0] != self.current_index:
+            # 歌词在后台加载，显示出来之后再跳到这一句
+            self.pending_lyric_time = time_ms
+            self.current_index = self.queue.jump(rows[0])
+            self.play_current_song()
+        else:
+            self.seek_to_lyric_time(time_ms)
+
+    def seek_to_lyric_time(self, time_ms):
+        line = max(0, line_at(self.lyric_times, time_ms))
+        if line < len(self.parsed_lyrics):
+            self.seek_from_lyric(self.lyrics_widget.item(line))
 
     def threaded_task(self, func, *args):
         # A simple threading helper
@@ -345,23 +435,54 @@ class NCMPlayerApp(QMainWindow):
             "",
             "NCM Files (*.ncm)"
         )
-        if file_paths:
-            self.threaded_task(self.process_files, file_paths)
-
-    def process_files(self, ncm_paths):
-        for path in ncm_paths:
+        for path in file_paths:
             file_to_check = os.path.basename(path).replace('.ncm', '.mp3')
             if any(file_to_check in song['path'] for song in self.playlist_data):
                 print(f"Skipping duplicate: {file_to_check}")
                 continue
-
-            converted_path = convert_ncm_to_mp3(path)
-            if converted_path:
-                update_and_embed_metadata(converted_path, "", "") # Let it search by filename
-                metadata = get_song_metadata(converted_path)
-                if metadata:
-                    # 发射信号，在主线程中处理UI更新
-                    self.song_processed.emit(metadata)
+            if self.import_scheduler.submit(path):
+                # 占位项总在列表末尾，真正的歌曲插在它们前面
+                item = QListWidgetItem()
+                item.setData(Qt.UserRole, path)
+                self.playlist_widget.addItem(item)
+                self.import_items[path] = item
+                self.update_import_progress(path, -1)
+
+    def import_name(self, ncm_path):
+        return os.path.basename(ncm_path).rsplit('.', 1)[0]
+
+    def update_import_progress(self, ncm_path, percent):
+        item = self.import_items.get(ncm_path)
+        if item is not None:
+            status = "等待中" if percent < 0 else f"导入中 {percent}%"
+            item.setText(f"{self.import_name(ncm_path)}  ({status})")
+
+    def take_import_item(self, ncm_path):
+        item = self.import_items.pop(ncm_path, None)
+        if item is not None:
+            self.playlist_widget.takeItem(self.playlist_widget.row(item))
+
+    def import_finished(self, ncm_path, metadata):
+        self.take_import_item(ncm_path)
+        self.add_song_to_playlist(metadata)
+        self.threaded_task(self.library.add, metadata)
+
+    def import_failed(self, ncm_path):
+        self.take_import_item(ncm_path)
+        log.warning(f'Import failed: "{ncm_path}"')
+
+    def import_cancelled(self, ncm_path):
+        self.take_import_item(ncm_path)
+
+    def show_import_menu(self, pos):
+        item = self.playlist_widget.itemAt(pos)
+        if item is None or item.data(Qt.UserRole) not in self.import_items:
+            return
+        ncm_path = item.data(Qt.UserRole)
+        menu = QMenu(self)
+        menu.addAction("优先导入", lambda: self.import_scheduler.bump(ncm_path))
+        menu.addAction("取消导入", lambda: self.import_scheduler.cancel(ncm_path))
+        menu.exec(self.playlist_widget.mapToGlobal(pos))
     
     def add_song_to_playlist(self, song_metadata):
         # 检查是否已存在相同的歌曲
@@ -370,15 +491,17 @@ class NCMPlayerApp(QMainWindow):
                 return  # 如果已存在，直接返回
         
         self.playlist_data.append(song_metadata)
+        self.queue.append()
         
-        # 直接在主线程中更新UI
+        # 直接在主线程中更新UI（插在导入占位项之前）
         display_text = f"{song_metadata['title']} - {song_metadata['artist']}"
         list_item = QListWidgetItem(display_text)
-        self.playlist_widget.addItem(list_item)
+        self.playlist_widget.insertItem(len(self.playlist_data) - 1, list_item)
         
-        print(f"Added song to playlist: {display_text}")  # 调试信息
+        log.debug(f"Added song to playlist: {display_text}")
 
-    def load_existing_songs(self):
+    def load_existing_songs(self, known_paths):
+        # 在后台线程运行：只读取会话里没有的歌曲，结果通过信号交给主线程
         output_dir = 'output'
         if not os.path.exists(output_dir):
             return
@@ -386,44 +509,184 @@ class NCMPlayerApp(QMainWindow):
         for filename in sorted(os.listdir(output_dir)):
             if filename.lower().endswith('.mp3'):
                 file_path = os.path.join(output_dir, filename)
+                if file_path in known_paths:
+                    # 歌词索引只为改动过的文件重读标签
+                    if not self.library.is_current(file_path):
+                        self.library.add_file(file_path)
+                    continue
                 metadata = get_song_metadata(file_path)
                 if metadata:
-                    self.playlist_data.append(metadata)
-                    display_text = f"{metadata['title']} - {metadata['artist']}"
-                    list_item = QListWidgetItem(display_text)
-                    self.playlist_widget.addItem(list_item)
+                    self.library.add(metadata)
+                    self.song_processed.emit(metadata)
+
+        for path in known_paths:
+            if not os.path.exists(path):
+                self.library.remove(path)
+                self.song_removed.emit(path)
+
+    def remove_song_from_playlist(self, path):
+        rows = [i for i, song in enumerate(self.playlist_data) if song['path'] == path]
+        if not rows:
+            return
+        row = rows[0]
+        if self.audio_cache is not None:
+            self.audio_cache.discard(path)
+        del self.playlist_data[row]
+        self.queue.remove(row)
+        self.playlist_widget.takeItem(row)
+        if row == self.current_index:
+            self.player.stop()
+            self.player.setSource(QUrl())
+            self.current_index = -1
+        elif row < self.current_index:
+            self.current_index -= 1
+
+    def restore_session(self):
+        playlist, state = self.session.load()
+        for song in playlist:
+            self.playlist_data.append(song)
+            self.playlist_widget.addItem(QListWidgetItem(f"{song['title']} - {song['artist']}"))
+        self.queue = PlaybackQueue.from_state(state, len(playlist))
+
+        mode = state.get('mode')
+        if mode in self.playback_modes:
+            self.current_playback_mode_index = self.playback_modes.index(mode)
+            self.update_playback_mode_icon()
+        self.queue.set_shuffle(self.playback_modes[self.current_playback_mode_index] == 'shuffle')
+        if state.get('volume') is not None:
+            self.volume_slider.setValue(int(state['volume']))
+
+        index = state.get('current_index', -1)
+        if 0 <= index < len(self.playlist_data):
+            self.current_index = index
+            self.play_current_song(autoplay=False, position=state.get('position') or 0)
+
+    def session_state(self):
+        return dict(
+            self.queue.state(),
+            current_index=self.current_index,
+            position=self.pending_position or self.player.position(),
+            mode=self.playback_modes[self.current_playback_mode_index],
+            volume=self.volume_slider.value(),
+        )
+
+    def save_session(self):
+        self.session.save(self.playlist_data, **self.session_state())
         
+
     def play_from_list(self, item):
-        self.current_index = self.playlist_widget.row(item)
+        row = self.playlist_widget.row(item)
+        if row >= len(self.playlist_data):
+            # 还在导入的歌曲：移到队列最前面
+            self.import_scheduler.bump(item.data(Qt.UserRole))
+            return
+        self.current_index = self.queue.jump(row)
         self.play_current_song()
         
-    def play_current_song(self):
+    def play_current_song(self, autoplay=True, position=0):
         if 0 <= self.current_index < len(self.playlist_data):
             song = self.playlist_data[self.current_index]
-            self.player.setSource(QUrl.fromLocalFile(song['path']))
-            self.player.play()
+            # 先起播，封面和歌词在后台准备好后再显示
+            started = time.perf_counter()
+            with metrics.stage('play_set_source'):
+                self.set_player_source(song['path'])
+            if autoplay:
+                self.play_started_at = started
+                self.pending_position = 0
+                with metrics.stage('play_call'):
+                    self.player.play()
+            else:
+                # 恢复会话：加载完成后跳到上次的位置，等用户点击播放
+                self.pending_position = position
+                self.progress_slider.setValue(position)
+                self.current_time_label.setText(self.format_time(position))
             
             self.title_label.setText(song['title'])
             self.artist_label.setText(song['artist'])
-            
-            # Cover pixmap is now loaded on demand
-            if song.get('cover_pixmap'):
-                 self.album_art_label.setPixmap(song['cover_pixmap'])
-            else:
-                cover_data = get_cover_data_from_tags(song['path'])
-                if cover_data:
-                    pixmap = QPixmap()
-                    pixmap.loadFromData(cover_data)
-                    song['cover_pixmap'] = pixmap.scaled(200, 200, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-                    self.album_art_label.setPixmap(song['cover_pixmap'])
-                else:
-                    self.album_art_label.setPixmap(QPixmap()) # Clear pixmap
-            
             self.playlist_widget.setCurrentRow(self.current_index)
-            
-            self.parsed_lyrics = self.parse_lrc(song.get('lyrics', ''))
+
+            self.album_art_label.setPixmap(song.get('cover_pixmap') or QPixmap())
+            self.parsed_lyrics = []
+            self.lyric_times = []
+            self.lyrics_widget.clear()
+            self.threaded_task(self.load_song_extras, song)
+
+            if autoplay:
+                self.lyrics_timer.start()
+                # 保存队列状态要写数据库，放到这次事件处理之后
+                QTimer.singleShot(0, self.save_playback_state)
+
+    def set_player_source(self, path):
+        self.pending_cache_path = None
+        data = self.audio_cache.get(path) if self.audio_cache is not None else None
+        if data is not None:
+            # 最近播放过：直接从内存播放，不再读取（可能在网络盘上的）文件
+            self.set_player_buffer(path, data)
+            return
+        # 未命中：立即从文件起播，真正开始播放之后再读进缓存，
+        # 不和起播抢读盘；恢复会话时不播放，也就不会在启动时读整个文件
+        self.set_player_file(path)
+        if self.audio_cache is not None:
+            self.pending_cache_path = path
+
+    def set_player_file(self, path):
+        old_buffer, self.source_buffer = self.source_buffer, None
+        self.player.setSource(QUrl.fromLocalFile(path))
+        if old_buffer is not None:
+            old_buffer.deleteLater()
+
+    def set_player_buffer(self, path, data):
+        old_buffer = self.source_buffer
+        self.source_buffer = QBuffer(self)
+        self.source_buffer.setData(QByteArray(data))
+        self.source_buffer.open(QIODevice.ReadOnly)
+        self.player.setSourceDevice(self.source_buffer, QUrl.fromLocalFile(path))
+        if old_buffer is not None:
+            old_buffer.deleteLater()
+
+    def cache_track(self, path):
+        # 在后台线程运行；放不进缓存的大文件 load 不会去读
+        try:
+            self.audio_cache.load(path)
+        except OSError as e:
+            log.warning(f'Caching "{path}" failed: {e}')
+
+    def save_playback_state(self):
+        with metrics.stage('play_save_state'):
+            self.session.save_state(**self.session_state())
+
+    def load_song_extras(self, song):
+        # 在后台线程运行：读取并缩放封面、解析歌词（QImage 可以在非 GUI 线程使用）
+        image = None
+        if not song.get('cover_pixmap'):
+            with metrics.stage('play_cover_load'):
+                cover_data = get_cover_data_from_tags(song['path'], song.get('cover_ref'))
+                if cover_data:
+                    image = QImage.fromData(cover_data)
+                    if not image.isNull():
+                        image = image.scaled(200, 200, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        with metrics.stage('play_lyrics_parse'):
+            parsed = parse_lrc(song.get('lyrics', ''))
+        self.song_extras_loaded.emit(song['path'], image, parsed)
+
+    def show_song_extras(self, path, image, parsed):
+        if not 0 <= self.current_index < len(self.playlist_data):
+            return
+        song = self.playlist_data[self.current_index]
+        if song['path'] != path:
+            return  # 已经切到别的歌了
+        if image is not None and not image.isNull():
+            song['cover_pixmap'] = QPixmap.fromImage(image)
+        self.album_art_label.setPixmap(song.get('cover_pixmap') or QPixmap())
+
+        with metrics.stage('play_lyrics_display'):
+            self.parsed_lyrics = parsed
+            self.lyric_times = [lyric['time'] for lyric in parsed]
             self.display_lyrics()
-            self.lyrics_timer.start()
+        if self.pending_lyric_time is not None:
+            self.seek_to_lyric_time(self.pending_lyric_time)
+            self.pending_lyric_time = None
+        self.update_lyrics_highlight()
 
     def update_position(self, pos):
         if self.is_slider_pressed:
@@ -444,8 +707,14 @@ class NCMPlayerApp(QMainWindow):
     def handle_playback_state_changed(self, state):
         """Handles changes in playback state (Playing, Paused, Stopped)."""
         if state == QMediaPlayer.PlayingState:
+            if self.play_started_at is not None:
+                metrics.add_time('play_click_to_playing', time.perf_counter() - self.play_started_at)
+                self.play_started_at = None
             self.play_pause_button.setIcon(qta.icon('fa5s.pause', color='black'))
             self.lyrics_timer.start()
+            if self.pending_cache_path is not None:
+                self.threaded_task(self.cache_track, self.pending_cache_path)
+                self.pending_cache_path = None
         else:  # Paused or Stopped
             self.play_pause_button.setIcon(qta.icon('fa5s.play', color='black'))
             self.lyrics_timer.stop()
@@ -454,8 +723,13 @@ class NCMPlayerApp(QMainWindow):
         """Handles changes in media status (e.g., end of media)."""
         if status == QMediaPlayer.EndOfMedia:
             self.handle_song_finished()
+        elif status == QMediaPlayer.LoadedMedia and self.pending_position:
+            self.player.setPosition(self.pending_position)
+            self.pending_position = 0
+            self.update_lyrics_highlight()
 
     def handle_player_error(self, error):
+        self.play_started_at = None
         print(f"Player Error: {self.player.errorString()}")
 
     def slider_pressed(self):
@@ -470,7 +744,7 @@ class NCMPlayerApp(QMainWindow):
     def toggle_play_pause(self):
         # If nothing is loaded yet, and we have songs, load and play the first one.
         if self.player.source().isEmpty() and self.playlist_data:
-            self.current_index = 0
+            self.current_index = self.queue.next()
             self.play_current_song()
             return
             
@@ -482,7 +756,8 @@ class NCMPlayerApp(QMainWindow):
 
     def next_song(self):
         if not self.playlist_data: return
-        self.current_index = (self.current_index + 1) % len(self.playlist_data)
+        # 顺序和随机模式都由播放队列决定下一首
+        self.current_index = self.queue.next()
         self.play_current_song()
         
     def prev_song(self):
@@ -490,7 +765,7 @@ class NCMPlayerApp(QMainWindow):
         if self.player.position() > 3000: # If more than 3s in, restart song
             self.player.setPosition(0)
         else:
-            self.current_index = (self.current_index - 1 + len(self.playlist_data)) % len(self.playlist_data)
+            self.current_index = self.queue.prev()
             self.play_current_song()
             
     def handle_song_finished(self):
@@ -499,20 +774,12 @@ class NCMPlayerApp(QMainWindow):
         if mode == 'repeat_one':
             self.player.setPosition(0)
             self.player.play()
-        elif mode == 'shuffle':
-            if len(self.playlist_data) > 1:
-                next_index = self.current_index
-                while next_index == self.current_index:
-                    next_index = random.randint(0, len(self.playlist_data) - 1)
-                self.current_index = next_index
-                self.play_current_song()
-            else:
-                self.next_song() # fallback for single song
-        else: # sequential
+        else: # sequential / shuffle
             self.next_song()
 
     def cycle_playback_mode(self):
         self.current_playback_mode_index = (self.current_playback_mode_index + 1) % len(self.playback_modes)
+        self.queue.set_shuffle(self.playback_modes[self.current_playback_mode_index] == 'shuffle')
         self.update_playback_mode_icon()
         
     def update_playback_mode_icon(self):
@@ -539,31 +806,14 @@ class NCMPlayerApp(QMainWindow):
         row = self.lyrics_widget.row(item)
         if 0 <= row < len(self.parsed_lyrics):
             time_ms = self.parsed_lyrics[row]['time']
-            self.player.setPosition(time_ms)
+            if self.player.mediaStatus() == QMediaPlayer.LoadingMedia:
+                # 刚切歌还没加载完，加载完成后再跳转
+                self.pending_position = time_ms
+            else:
+                self.player.setPosition(time_ms)
 
     def parse_lrc(self, lrc_content):
-        parsed = []
-        if not lrc_content:
-            return parsed
-
-        time_regex = re.compile(r'\[(\d{2}):(\d{2})\.(\d{2,3})\]')
-        
-        for line in lrc_content.split('\n'):
-            text = time_regex.sub('', line).strip()
-            if not text:
-                continue
-
-            for match in time_regex.finditer(line):
-                minutes = int(match.group(1))
-                seconds = int(match.group(2))
-                ms_str = match.group(3).ljust(3, '0')
-                ms = int(ms_str)
-                
-                time_in_ms = (minutes * 60 + seconds) * 1000 + ms
-                parsed.append({'time': time_in_ms, 'text': text})
-        
-        parsed.sort(key=lambda x: x['time'])
-        return parsed
+        return parse_lrc(lrc_content)
 
     def display_lyrics(self):
         self.lyrics_widget.clear()
@@ -583,13 +833,7 @@ class NCMPlayerApp(QMainWindow):
             return
 
         current_time = self.player.position()
-        
-        current_line = -1
-        for i, lyric in enumerate(self.parsed_lyrics):
-            if current_time >= lyric['time']:
-                current_line = i
-            else:
-                break
+        current_line = line_at(self.lyric_times, current_time)
         
         if current_line != self.lyrics_widget.currentRow():
             self.lyrics_widget.setCurrentRow(current_line)
@@ -637,6 +881,12 @@ class NCMPlayerApp(QMainWindow):
                 scrollbar.setValue(target_value)
 
     def closeEvent(self, event):
+        # 取消剩余导入并等待正在运行的任务退出（不会留下写了一半的文件）
+        if not self.import_scheduler.shutdown(SHUTDOWN_TIMEOUT_MS):
+            log.warning(f'Imports still running after {SHUTDOWN_TIMEOUT_MS} ms, closing anyway')
+        self.save_session()
+        self.session.close()
+        self.library.close()
         # Clean up the media player to avoid runtime errors on exit
         self.player.stop()
         self.player.setSource(QUrl())
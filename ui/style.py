@@ -137,6 +137,11 @@ STYLE_SHEET = f"""
     #mainArtist {{
         color: #B3B3B3; font-family: 'Inter', sans-serif; font-size: 18px; margin-top: 5px;
     }}
+    #lyricResults {{
+        max-height: 160px; border-bottom: 1px solid #333333; margin: 0 12px 8px 12px;
+    }}
+    #lyricResults::item {{ color: #888; padding: 4px 0; }}
+    #lyricResults::item:hover {{ color: white; }}
     #lyricsWidget {{ 
         font-size: 18px; text-align: center; border: none;
     }}
@@ -193,4 +198,22 @@ STYLE_SHEET = f"""
         background: transparent;
         outline: none;
     }}
-""" 
\ No newline at end of file
+
+    #diagnosticsDialog {{
+        background-color: #121212;
+    }}
+    QTableWidget {{
+        background-color: #0A0A0A;
+        alternate-background-color: #121212;
+        color: #B3B3B3;
+        gridline-color: #282828;
+        border: 1px solid #282828;
+        font-family: 'Inter', sans-serif;
+    }}
+    QHeaderView::section {{
+        background-color: #1A1A1A;
+        color: white;
+        border: none;
+        padding: 6px;
+    }}
+"""
\ No newline at end of file
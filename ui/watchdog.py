@@ -0,0 +1,132 @@
+"""Opt-in watchdog for stalls of the Qt event loop.
+
+Enabled with the ``NCM_STALL_WATCHDOG=MS`` environment variable, where
+``MS`` is the stall threshold in milliseconds (e.g. 50)::
+
+    NCM_STALL_WATCHDOG=50 python main.py
+
+A timer on the main thread stamps a heartbeat. A monitor thread notices
+when the heartbeat is older than the threshold and samples the main
+thread's Python stack at that moment. Stalls are grouped by that stack,
+and a summary of the worst ones is logged every ``report_interval``
+seconds and on exit. Durations also go into ``metrics`` as the
+``ui_stall`` stage, so they show up in the diagnostics dialog.
+"""
+import os
+import sys
+import time
+import logging
+import threading
+import traceback
+
+from PySide6.QtCore import Qt, QTimer
+
+from core.metrics import metrics
+
+ENV_VAR = 'NCM_STALL_WATCHDOG'
+REPORT_INTERVAL = 30.0
+STACK_DEPTH = 12
+TOP_STACKS = 5
+
+log = logging.getLogger(__name__)
+
+
+class StallWatchdog:
+    def __init__(self, threshold_ms=50, report_interval=REPORT_INTERVAL, parent=None):
+        self.threshold = threshold_ms / 1000
+        self.report_interval = report_interval
+        self.thread_id = threading.get_ident()
+        self.last_beat = time.perf_counter()
+        self.lock = threading.Lock()
+        self.stalls = {}
+
+        # Beat twice per threshold so an idle loop never looks stalled
+        self.timer = QTimer(parent)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.setInterval(max(5, int(threshold_ms / 2)))
+        self.timer.timeout.connect(self.beat)
+        self.interval = self.timer.interval() / 1000
+
+        self.stop_event = threading.Event()
+        self.monitor = threading.Thread(target=self.run, name='stall-watchdog', daemon=True)
+
+    def start(self):
+        self.last_beat = time.perf_counter()
+        self.timer.start()
+        self.monitor.start()
+        return self
+
+    def stop(self):
+        if self.stop_event.is_set():
+            return
+        self.timer.stop()
+        self.stop_event.set()
+        self.monitor.join()
+        self.report()
+
+    def beat(self):
+        self.last_beat = time.perf_counter()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return ()
+        return tuple(traceback.extract_stack(frame, limit=STACK_DEPTH))
+
+    def run(self):
+        poll = max(0.005, self.threshold / 4)
+        next_report = time.perf_counter() + self.report_interval
+        stalled_beat, stack = None, None
+        while not self.stop_event.wait(poll):
+            beat = self.last_beat
+            now = time.perf_counter()
+            if stalled_beat is not None and beat != stalled_beat:
+                # Loop is back: the stall lasted from the missed beat until now
+                self.record(stack, beat - stalled_beat - self.interval)
+                stalled_beat, stack = None, None
+            elif stalled_beat is None and now - beat > self.interval + self.threshold:
+                stalled_beat, stack = beat, self.sample()
+            if now >= next_report:
+                self.report()
+                next_report = now + self.report_interval
+
+    def record(self, stack, seconds):
+        metrics.add_time('ui_stall', seconds)
+        signature = tuple((fs.filename, fs.name) for fs in stack)
+        with self.lock:
+            entry = self.stalls.get(signature)
+            if entry is None:
+                entry = self.stalls[signature] = {'count': 0, 'total': 0.0, 'max': 0.0, 'stack': stack}
+            entry['count'] += 1
+            entry['total'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+
+    def report(self):
+        with self.lock:
+            stalls, self.stalls = self.stalls, {}
+        if not stalls:
+            return
+        count = sum(s['count'] for s in stalls.values())
+        total = sum(s['total'] for s in stalls.values())
+        worst = max(s['max'] for s in stalls.values())
+        lines = [f'{count} UI stall(s) over {self.threshold * 1000:.0f} ms, '
+                 f'{total * 1000:.0f} ms in total, worst {worst * 1000:.0f} ms:']
+        for s in sorted(stalls.values(), key=lambda s: -s['total'])[:TOP_STACKS]:
+            lines.append(f"  {s['count']}x, {s['total'] * 1000:.0f} ms total, {s['max'] * 1000:.0f} ms max, at:")
+            lines.extend(f'    {fs.filename}:{fs.lineno} in {fs.name}' for fs in s['stack'])
+        log.warning('\n'.join(lines))
+
+
+def install_from_env(app):
+    """Start a watchdog if ``NCM_STALL_WATCHDOG`` is set; stops when ``app`` quits."""
+    value = os.environ.get(ENV_VAR)
+    if not value:
+        return None
+    try:
+        threshold_ms = float(value)
+    except ValueError:
+        log.warning(f'{ENV_VAR} should be a threshold in ms, got "{value}"')
+        return None
+    watchdog = StallWatchdog(threshold_ms, parent=app).start()
+    app.aboutToQuit.connect(watchdog.stop)
+    return watchdog